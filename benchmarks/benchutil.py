@@ -0,0 +1,69 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# Helpers shared by the benchmarks. Every benchmark produces result rows:
+#   {"benchmark": name, "case": case, "metric": metric, "value": value, "unit": unit}
+# printed as a table, and appended as JSON lines to the --output file if given,
+# so results of several runs and machines can be collected and compared.
+
+import json
+import os
+import platform
+import sys
+import time
+from optparse import OptionParser
+
+# Benchmarks run from a checkout, without installing the package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+def option_parser(usage='%prog [options]'):
+    '''
+    Returns an OptionParser with the options common to all the benchmarks.
+    '''
+    parser = OptionParser(usage=usage)
+    parser.add_option('-o', '--output', help='append the results as JSON lines to this file')
+    parser.add_option('-r', '--repeat', type='int', default=3, help='repetitions of every measurement, the best is kept')
+    return parser
+
+def best_time(function, repeat=3):
+    '''
+    Returns the shortest time of *repeat* calls of *function*, in seconds.
+    '''
+    best = None
+    for i in xrange(repeat):
+        started = time.time()
+        function()
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def result(benchmark, case, metric, value, unit):
+    return {
+        'benchmark': benchmark,
+        'case': case,
+        'metric': metric,
+        'value': value,
+        'unit': unit,
+    }
+
+def emit(results, output=None):
+    '''
+    Prints the results as a table, and appends them to the *output* file if given.
+    '''
+    for row in results:
+        print '%-20s %-32s %-16s %14.3f %s' % (row['benchmark'], row['case'], row['metric'], row['value'], row['unit'])
+    if output:
+        environment = {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'time': int(time.time()),
+        }
+        f = open(output, 'a')
+        try:
+            for row in results:
+                row = dict(row)
+                row.update(environment)
+                f.write(json.dumps(row) + '\n')
+        finally:
+            f.close()
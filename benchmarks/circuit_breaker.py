@@ -0,0 +1,115 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# Checks that the circuit breaker recovers when its half-open probe ends before connecting (deadline exceeded while
+# computing the timeouts or waiting for the rate limiter), that flushData keeps the data refused by the open breaker
+# without passing it to the on_open callback, and measures the time to fail fast while it's open:
+#   python benchmarks/circuit_breaker.py [--sends 10000] [--output results.jsonl]
+
+import socket
+import sys
+import time
+
+from benchutil import option_parser, best_time, result, emit
+from faketrapper import FakeTrapper
+from pyZabbixSender.breaker import CircuitBreaker
+from pyZabbixSender.sy import syZabbixSender
+from pyZabbixSender.pyZabbixSender import pyZabbixSender
+
+COOLDOWN = 0.2
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def delivered(response):
+    if isinstance(response[0], bool):
+        return response[0]
+    return response[0] == pyZabbixSender.RC_OK
+
+def check(sender_class, name, limited):
+    '''
+    Opens the breaker of a new endpoint, lets the probe expire before connecting once the cooldown is over,
+    and returns the list of errors if the next send doesn't close the breaker.
+    '''
+    port = free_port()
+    sender = sender_class('127.0.0.1', port)
+    breaker = sender.useCircuitBreaker(failures=1, cooldown=COOLDOWN)
+    if limited:
+        sender.useRateLimiter(connections_per_second=1, name='check %s %d' % (name, port))
+    sender.addData('host', 'key', 1)
+    sender.sendData()
+    errors = []
+    if breaker.state != CircuitBreaker.OPEN:
+        errors.append('%s: breaker %s after a refused connection' % (name, breaker.state))
+    trapper = FakeTrapper(port).start()
+    try:
+        time.sleep(COOLDOWN * 1.5)
+        # Without the limiter the deadline is exceeded computing the timeouts, with it while waiting for the limiter
+        sender.sendData(deadline=-1 if not limited else 0.1)
+        for i in xrange(2):
+            response = sender.sendData()[0]
+            if not delivered(response):
+                errors.append('%s: send failed after the probe expired: %r' % (name, response[1]))
+                break
+        if breaker.state != CircuitBreaker.CLOSED:
+            errors.append('%s: breaker %s after the probe expired' % (name, breaker.state))
+    finally:
+        trapper.stop()
+    return errors
+
+def check_spool(sender_class, name):
+    '''
+    Flushes data while the breaker is open, and returns the list of errors if the data is not kept in the sender,
+    or if it's also passed to the on_open callback (it would be sent twice once spooled).
+    '''
+    spool = []
+    sender = sender_class('127.0.0.1', free_port())
+    sender.useCircuitBreaker(failures=1, cooldown=3600, on_open=spool.append)
+    sender.useRetries(backoff=0.001)
+    sender.addData('host', 'key', 0)
+    sender.sendData()
+    sender.clearData()
+    sender.addData('host', 'key', 1)
+    sender.addData('host', 'key', 2)
+    for i in xrange(3):
+        sender.flushData(max_data_per_conn=1)
+    errors = []
+    if spool:
+        errors.append('%s: %d packets spooled by flushData' % (name, len(spool)))
+    if len(sender.getData()) != 2:
+        errors.append('%s: %d data points kept by flushData instead of 2' % (name, len(sender.getData())))
+    if sender.retry_policy.getStats()['retries']:
+        errors.append('%s: packets retried while the breaker is open' % name)
+    return errors
+
+def main():
+    parser = option_parser()
+    parser.add_option('-n', '--sends', type='int', default=10000, help='sends refused while the breaker is open')
+    options, args = parser.parse_args()
+
+    errors = []
+    for sender_class, name in ((syZabbixSender, 'syZabbixSender'), (pyZabbixSender, 'pyZabbixSender')):
+        for limited in (False, True):
+            errors.extend(check(sender_class, '%s%s' % (name, ' with limiter' if limited else ''), limited))
+        errors.extend(check_spool(sender_class, name))
+    for error in errors:
+        sys.stderr.write('%s\n' % error)
+
+    sender = syZabbixSender('127.0.0.1', free_port())
+    sender.useCircuitBreaker(failures=1, cooldown=3600)
+    sender.addData('host', 'key', 1)
+    sender.sendData()
+    elapsed = best_time(lambda: [sender.sendData() for i in xrange(options.sends)], options.repeat)
+    results = [
+        result('circuit_breaker', 'checks', 'errors', len(errors), 'errors'),
+        result('circuit_breaker', 'breaker open', 'time per send', elapsed / options.sends * 1e6, 'us'),
+    ]
+    emit(results, options.output)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
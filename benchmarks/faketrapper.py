@@ -0,0 +1,142 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# Stand-in for a Zabbix trapper, to run the benchmarks without a Zabbix server.
+# It accepts "sender data" packets, in clear or with TLS, and replies like the server:
+#   python benchmarks/faketrapper.py [--port 10051] [--tls-cert cert.pem --tls-key key.pem]
+
+import json
+import os
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+class FakeTrapper:
+    '''
+    Threaded trapper listening on *port* (0 picks a free one, see *port* attribute after *start*).
+    It counts the connections, packets and data points received, and waits *delay* seconds before replying.
+    '''
+    def __init__(self, port=0, interface='127.0.0.1', certfile=None, keyfile=None, delay=0):
+        self.interface = interface
+        self.port = port
+        self.delay = delay
+        self.context = None
+        if certfile:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.context.load_cert_chain(certfile, keyfile)
+        self.connections = 0
+        self.packets = 0
+        self.items = 0
+        self.errors = 0
+        self._active = 0
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.interface, self.port))
+        self._sock.listen(1024)
+        self.port = self._sock.getsockname()[1]
+        t = threading.Thread(target=self._accept)
+        t.setDaemon(True)
+        t.start()
+        return self
+
+    def stop(self, timeout=1.0):
+        '''
+        Stops listening, and waits for the connections in progress for *timeout* seconds at most.
+        '''
+        self._sock.close()
+        expires = time.time() + timeout
+        while self._active and time.time() < expires:
+            time.sleep(0.01)
+
+    def _accept(self):
+        while True:
+            try:
+                conn, address = self._sock.accept()
+            except socket.error:
+                return
+            self._lock.acquire()
+            self._active += 1
+            self._lock.release()
+            t = threading.Thread(target=self._handle, args=(conn,))
+            t.setDaemon(True)
+            t.start()
+
+    def _recv(self, conn, size):
+        chunks = []
+        while size > 0:
+            chunk = conn.recv(min(size, 1 << 20))
+            if not chunk:
+                raise IOError('connection closed')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def _handle(self, conn):
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.context is not None:
+                conn = self.context.wrap_socket(conn, server_side=True)
+            header = self._recv(conn, 13)
+            if header[:5] != 'ZBXD\1':
+                raise IOError('wrong magic')
+            packet = json.loads(self._recv(conn, struct.unpack('<q', header[5:13])[0]))
+            count = len(packet.get('data', ()))
+            if self.delay:
+                time.sleep(self.delay)
+            reply = json.dumps({
+                'response': 'success',
+                'info': 'processed: %d; failed: 0; total: %d; seconds spent: 0.000050' % (count, count),
+            })
+            conn.sendall('ZBXD\1' + struct.pack('<q', len(reply)) + reply)
+            self._lock.acquire()
+            try:
+                self.connections += 1
+                self.packets += 1
+                self.items += count
+            finally:
+                self._lock.release()
+        except Exception:
+            self.errors += 1
+        finally:
+            conn.close()
+            self._lock.acquire()
+            self._active -= 1
+            self._lock.release()
+
+def make_certificate(directory):
+    '''
+    Creates a self-signed certificate for "localhost" with the openssl command, and returns the (certfile, keyfile) paths.
+    '''
+    certfile = os.path.join(directory, 'faketrapper.crt')
+    keyfile = os.path.join(directory, 'faketrapper.key')
+    if not os.path.exists(certfile):
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '30',
+            '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile],
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    return certfile, keyfile
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-p', '--port', type='int', default=10051, help='port to listen on')
+    parser.add_option('-i', '--interface', default='127.0.0.1', help='interface to listen on')
+    parser.add_option('--tls-cert', help='certificate file, enables TLS')
+    parser.add_option('--tls-key', help='private key file')
+    parser.add_option('--delay', type='float', default=0, help='seconds to wait before replying')
+    options, args = parser.parse_args()
+    trapper = FakeTrapper(options.port, options.interface, options.tls_cert, options.tls_key, options.delay).start()
+    sys.stderr.write('Listening on %s:%d\n' % (options.interface, trapper.port))
+    while True:
+        time.sleep(10)
+        sys.stderr.write('connections: %d, items: %d, errors: %d\n' % (trapper.connections, trapper.items, trapper.errors))
+
+if __name__ == '__main__':
+    main()
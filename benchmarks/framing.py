@@ -0,0 +1,118 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# Checks the incremental frame decoder with random splits and corrupted headers, and compares its
+# throughput with the former parser of txZabbixSender, which concatenated the pending data to every chunk:
+#   python benchmarks/framing.py [--size 64] [--chunk 65536] [--rounds 2000] [--output results.jsonl]
+
+import random
+import struct
+import sys
+
+from benchutil import option_parser, best_time, result, emit
+from pyZabbixSender.framing import FrameDecoder, FrameError, HEADER_SIZE, frame
+
+class ConcatenatingDecoder:
+    '''
+    The former parser: the pending data is concatenated to each chunk received, which is quadratic
+    in the size of a frame received in many chunks.
+    '''
+    def __init__(self):
+        self.tail = ''
+        self.length = None
+
+    def feed(self, data):
+        frames = []
+        data = self.tail + data
+        while True:
+            if self.length is None:
+                if len(data) < HEADER_SIZE:
+                    break
+                self.length = struct.unpack('<q', data[5:HEADER_SIZE])[0]
+                data = data[HEADER_SIZE:]
+            if len(data) < self.length:
+                break
+            frames.append(data[:self.length])
+            data = data[self.length:]
+            self.length = None
+        self.tail = data
+        return frames
+
+def split(data, rnd, max_chunk):
+    '''
+    Splits *data* in chunks of random sizes, some of them empty.
+    '''
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rnd.randint(0, max_chunk)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+def check(rounds, seed=1):
+    '''
+    Returns the list of errors found decoding random streams of frames.
+    '''
+    rnd = random.Random(seed)
+    errors = []
+    for i in xrange(rounds):
+        payloads = [''.join(chr(rnd.randint(0, 255)) for j in xrange(rnd.choice((0, 1, 13, rnd.randint(0, 5000)))))
+                    for k in xrange(rnd.randint(1, 5))]
+        stream = ''.join(frame(payload) for payload in payloads)
+        decoder = FrameDecoder()
+        decoded = []
+        for chunk in split(stream, rnd, rnd.choice((1, 7, 100, 10000))):
+            decoded.extend(decoder.feed(chunk))
+        if decoded != payloads or decoder.pending():
+            errors.append('round %d: %d frames decoded instead of %d' % (i, len(decoded), len(payloads)))
+
+        # A corrupted header must be rejected, never decoded as a frame
+        position = rnd.randint(0, 4)
+        corrupted = bytearray(frame(payloads[0]))
+        corrupted[position] ^= rnd.randint(1, 255)
+        try:
+            FrameDecoder().feed(str(corrupted))
+        except FrameError:
+            pass
+        else:
+            errors.append('round %d: corrupted byte %d accepted' % (i, position))
+
+    # The announced size is checked before buffering the data
+    try:
+        FrameDecoder(max_frame=1024).feed(frame('x' * 1025)[:HEADER_SIZE])
+    except FrameError:
+        pass
+    else:
+        errors.append('frame bigger than max_frame accepted')
+    return errors
+
+def decode(decoder_class, chunks):
+    decoder = decoder_class()
+    for chunk in chunks:
+        frames = decoder.feed(chunk)
+    return frames
+
+def main():
+    parser = option_parser()
+    parser.add_option('-s', '--size', type='int', default=64, help='size of the frame in MiB')
+    parser.add_option('-c', '--chunk', type='int', default=65536, help='size of the chunks received')
+    parser.add_option('--rounds', type='int', default=2000, help='rounds of the random checks')
+    options, args = parser.parse_args()
+
+    errors = check(options.rounds)
+    for error in errors:
+        sys.stderr.write('%s\n' % error)
+
+    stream = frame('x' * (options.size << 20))
+    chunks = [stream[pos:pos + options.chunk] for pos in xrange(0, len(stream), options.chunk)]
+    results = [result('framing', 'random checks', 'errors', len(errors), 'errors')]
+    for name, decoder_class in (('FrameDecoder', FrameDecoder), ('concatenating', ConcatenatingDecoder)):
+        elapsed = best_time(lambda: decode(decoder_class, chunks), options.repeat)
+        results.append(result('framing', '%s %d MiB in %d B chunks' % (name, options.size, options.chunk),
+            'throughput', len(stream) / elapsed / (1 << 20), 'MiB/s'))
+    emit(results, options.output)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# Compares the JSON backends installed, encoding packets and decoding responses:
+#   python benchmarks/json_backends.py [--items 100000] [--output results.jsonl]
+
+import random
+
+from benchutil import option_parser, best_time, result, emit
+from pyZabbixSender import jsoncodec
+from pyZabbixSender.pyZabbixSenderBase import encode_packet
+
+def make_items(count, seed=1):
+    '''
+    Returns a realistic mix of data points: mostly numbers, some short strings and some log lines.
+    '''
+    rnd = random.Random(seed)
+    items = []
+    clock = 1500000000
+    for i in xrange(count):
+        kind = rnd.random()
+        if kind < 0.5:
+            value = rnd.random() * 1000
+        elif kind < 0.8:
+            value = rnd.randint(0, 1 << 40)
+        elif kind < 0.95:
+            value = rnd.choice(['up', 'down', 'degraded', u'état inconnu'])
+        else:
+            value = 'GET /api/v1/items?id=%d HTTP/1.1 200 %d "Mozilla/5.0"' % (i, rnd.randint(100, 100000))
+        items.append({
+            'host': 'host-%04d.example.com' % (i % 1000),
+            'key': 'app.metric[%d,%s]' % (i % 50, 'avg' if i % 2 else 'max'),
+            'value': value,
+            'clock': clock + i // 1000,
+        })
+    return items
+
+def main():
+    parser = option_parser()
+    parser.add_option('-n', '--items', type='int', default=100000, help='data points per packet')
+    options, args = parser.parse_args()
+
+    packet = {'request': 'sender data', 'data': make_items(options.items)}
+    response = '{"response":"success","info":"processed: %d; failed: 0; total: %d; seconds spent: 0.123456"}' % (options.items, options.items)
+    results = []
+    for backend in jsoncodec.available_backends():
+        jsoncodec.use_backend(backend)
+        encoded = encode_packet(packet)
+        elapsed = best_time(lambda: encode_packet(packet), options.repeat)
+        results.append(result('json_backends', '%s encode' % backend, 'items/s', options.items / elapsed, 'items/s'))
+        results.append(result('json_backends', '%s encode' % backend, 'throughput', len(encoded) / elapsed / (1 << 20), 'MiB/s'))
+        elapsed = best_time(lambda: jsoncodec.loads(encoded), options.repeat)
+        results.append(result('json_backends', '%s decode' % backend, 'throughput', len(encoded) / elapsed / (1 << 20), 'MiB/s'))
+        elapsed = best_time(lambda: [jsoncodec.loads(response) for i in xrange(10000)], options.repeat)
+        results.append(result('json_backends', '%s decode response' % backend, 'responses/s', 10000 / elapsed, 'responses/s'))
+    jsoncodec.use_backend()
+    emit(results, options.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# Synthetic load generator, to size Zabbix trappers and proxies. Workers send realistic item streams with their own
+# connections, at a target rate, and the achieved throughput and latency distribution are reported:
+#   python benchmarks/loadgen.py [--server zabbix:10051] [--connections 8] [--rate 50000] [--duration 30]
+#       [--hosts 1000] [--keys 50] [--types float=50,int=30,str=15,log=5] [--value-size 64] [--clock-skew 5]
+#       [--batch 1000] [--output results.jsonl]
+# Without --server, a local fake trapper is started (see faketrapper.py), so it runs offline.
+
+import random
+import threading
+import time
+
+from benchutil import option_parser, result, emit
+from faketrapper import FakeTrapper
+from pyZabbixSender.selfmon import percentile
+
+VALUE_TYPES = ('float', 'int', 'str', 'log')
+
+class ItemStream:
+    '''
+    Endless stream of data points of *hosts* x *keys* items, polled in turn like by agents, starting at item *offset*.
+    Values are drawn from the *types* mix (a dict of weights), with text values of about *value_size* characters.
+    Clocks are the current time shifted by up to *clock_skew* seconds either way, or omitted if *clock_skew* is None.
+    '''
+    def __init__(self, hosts=1000, keys=50, types=None, value_size=64, clock_skew=0, offset=0, seed=1):
+        self.rnd = random.Random(seed)
+        self.hosts = ['loadgen-%05d' % i for i in xrange(hosts)]
+        self.keys = ['loadgen.item[%d]' % i for i in xrange(keys)]
+        self.clock_skew = clock_skew
+        self.position = offset
+        types = types or {'float': 1}
+        # Types and values are drawn from pools built once, so generating data is not the bottleneck
+        self.type_pool = [kind for kind in VALUE_TYPES for i in xrange(int(types.get(kind, 0)))] or ['float']
+        words = ['GET', 'POST', '/api/v1/items', 'OK', 'error', 'timeout', 'user=%d', 'status=200', 'latency=%dms']
+        self.text_pool = []
+        for i in xrange(256):
+            text = ''
+            while len(text) < value_size:
+                text += self.rnd.choice(words).replace('%d', str(self.rnd.randint(0, 99999))) + ' '
+            self.text_pool.append(text[:value_size])
+
+    def value(self, kind):
+        rnd = self.rnd
+        if kind == 'float':
+            return round(rnd.random() * 1000, 6)
+        if kind == 'int':
+            return rnd.randint(0, 1 << 40)
+        text = rnd.choice(self.text_pool)
+        if kind == 'log':
+            return '%s [%d] %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), rnd.randint(1, 65535), text)
+        return text
+
+    def batch(self, count):
+        '''
+        Returns the next *count* data points, as (host, key, value, clock) tuples.
+        '''
+        rnd = self.rnd
+        keys = len(self.keys)
+        total = len(self.hosts) * keys
+        now = time.time()
+        items = []
+        for i in xrange(count):
+            item = self.position % total
+            self.position += 1
+            clock = None
+            if self.clock_skew is not None:
+                clock = int(now + rnd.uniform(-self.clock_skew, self.clock_skew))
+            items.append((self.hosts[item // keys], self.keys[item % keys], self.value(rnd.choice(self.type_pool)), clock))
+        return items
+
+class Worker(threading.Thread):
+    '''
+    Sends batches of *stream* with its own sender until *stop_at*, paced to *rate* data points per second (0 is as fast as possible).
+    *succeeded* tells if a result of *sendData* is a success (results differ between the senders).
+    Latency is measured from the time the batch was due, so a server falling behind shows up in it (no coordinated omission),
+    and service time is the duration of the send itself. Every send completed is kept in *sends*, as (finished, processed, bytes_sent)
+    tuples, where *processed* is the number of data points processed by the server.
+    '''
+    def __init__(self, sender, succeeded, stream, batch, rate, stop_at):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.sender = sender
+        self.succeeded = succeeded
+        self.stream = stream
+        self.batch_size = batch
+        self.interval = float(batch) / rate if rate else 0
+        self.stop_at = stop_at
+        self.packets = 0
+        self.errors = 0
+        self.sends = []
+        self.latencies = []
+        self.service_times = []
+        sender.addObserver(self._observe)
+
+    def _observe(self, record):
+        self.sends.append((record.started + record.duration, record.processed or 0, record.bytes_sent))
+        self.service_times.append(record.duration)
+
+    def run(self):
+        sender = self.sender
+        due = time.time()
+        while due < self.stop_at:
+            now = time.time()
+            if due > now:
+                time.sleep(due - now)
+            sender.clearData()
+            for host, key, value, clock in self.stream.batch(self.batch_size):
+                sender.addData(host, key, value, clock)
+            for response in sender.sendData():
+                self.packets += 1
+                if not self.succeeded(response):
+                    self.errors += 1
+            self.latencies.append(time.time() - due)
+            if self.interval:
+                due += self.interval
+            else:
+                due = time.time()
+
+def window_rate(sends, index=None):
+    '''
+    Returns the rate of the sends (of their value at *index*, or of the sends themselves) over the window between the first
+    and the last send completed. The first send is not counted, as it was done before the window.
+    '''
+    if len(sends) < 2:
+        return 0.0
+    window = sends[-1][0] - sends[0][0]
+    if window <= 0:
+        return 0.0
+    if index is None:
+        return (len(sends) - 1) / window
+    return sum([send[index] for send in sends[1:]]) / window
+
+def parse_types(text):
+    '''
+    Parses a value type mix like "float=50,int=30,str=15,log=5".
+    '''
+    types = {}
+    for part in text.split(','):
+        kind, weight = part.split('=')
+        if kind not in VALUE_TYPES:
+            raise ValueError('Unknown value type: %s' % kind)
+        types[kind] = int(weight)
+    return types
+
+def distribution(name, case, values, unit_scale=1000.0, unit='ms'):
+    values = sorted(values)
+    if not values:
+        return []
+    return [result('loadgen', case, '%s %s' % (name, label), percentile(values, fraction) * unit_scale, unit)
+            for label, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))]
+
+def main():
+    parser = option_parser()
+    parser.add_option('-s', '--server', help='trapper or proxy as host:port, a local fake trapper if omitted')
+    parser.add_option('--sender', default='sy', help='sender class: sy or legacy')
+    parser.add_option('-c', '--connections', type='int', default=8, help='concurrent connections (worker threads)')
+    parser.add_option('--rate', type='float', default=0, help='target data points per second, 0 is as fast as possible')
+    parser.add_option('-d', '--duration', type='float', default=10, help='seconds to run')
+    parser.add_option('-b', '--batch', type='int', default=1000, help='data points per packet')
+    parser.add_option('--hosts', type='int', default=1000, help='number of hosts')
+    parser.add_option('--keys', type='int', default=50, help='number of keys per host')
+    parser.add_option('--types', default='float=50,int=30,str=15,log=5', help='value type mix, as weights')
+    parser.add_option('--value-size', type='int', default=64, help='size of text values')
+    parser.add_option('--clock-skew', type='float', default=0, help='maximum clock shift in seconds, either way')
+    parser.add_option('--no-clock', action='store_true', help='send data points without clock')
+    parser.add_option('--delay', type='float', default=0, help='reply delay of the local fake trapper, in seconds')
+    options, args = parser.parse_args()
+
+    trapper = None
+    if options.server:
+        host, port = options.server.rsplit(':', 1)
+        port = int(port)
+    else:
+        trapper = FakeTrapper(delay=options.delay).start()
+        host, port = '127.0.0.1', trapper.port
+    if options.sender == 'legacy':
+        from pyZabbixSender.pyZabbixSender import pyZabbixSender as sender_class
+        succeeded = lambda response: response[0] in (sender_class.RC_OK, sender_class.RC_ERR_FAIL_SEND)
+    else:
+        from pyZabbixSender.sy import syZabbixSender as sender_class
+        succeeded = lambda response: response[0]
+
+    types = parse_types(options.types)
+    total = options.hosts * options.keys
+    stop_at = time.time() + options.duration
+    workers = []
+    for i in xrange(options.connections):
+        stream = ItemStream(options.hosts, options.keys, types, options.value_size,
+            None if options.no_clock else options.clock_skew, offset=i * total // options.connections, seed=i)
+        workers.append(Worker(sender_class(host, port), succeeded, stream, options.batch, options.rate / options.connections, stop_at))
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if trapper is not None:
+        trapper.stop()
+
+    # Rates are measured over the sends completed by every worker, with the data points processed by the server
+    errors = sum([worker.errors for worker in workers])
+    case = '%d conn, %d/pkt, %s' % (options.connections, options.batch, ('%d/s' % options.rate) if options.rate else 'max rate')
+    results = [
+        result('loadgen', case, 'throughput', sum([window_rate(worker.sends, 1) for worker in workers]), 'items/s'),
+        result('loadgen', case, 'packets', sum([window_rate(worker.sends) for worker in workers]), 'packets/s'),
+        result('loadgen', case, 'bandwidth', sum([window_rate(worker.sends, 2) for worker in workers]) / (1 << 20), 'MiB/s'),
+        result('loadgen', case, 'errors', errors, 'packets'),
+        result('loadgen', case, 'processed', sum([send[1] for worker in workers for send in worker.sends]), 'items'),
+    ]
+    if options.rate:
+        results.append(result('loadgen', case, 'target', options.rate, 'items/s'))
+    results.extend(distribution('latency', case, sum([worker.latencies for worker in workers], [])))
+    results.extend(distribution('service', case, sum([worker.service_times for worker in workers], [])))
+    if trapper is not None:
+        results.append(result('loadgen', case, 'trapper received', trapper.items, 'items'))
+        results.append(result('loadgen', case, 'trapper errors', trapper.errors, 'connections'))
+    emit(results, options.output)
+
+if __name__ == '__main__':
+    main()
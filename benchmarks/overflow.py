@@ -0,0 +1,194 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# Checks the overflow policies of setCapacity against a simple reference model, with random additions, removals,
+# packets put back after failed sends and clears, and measures the time of addData on full internal data:
+#   python benchmarks/overflow.py [--items 100000] [--adds 20000] [--rounds 300] [--output results.jsonl]
+
+import random
+import sys
+
+from benchutil import option_parser, best_time, result, emit
+from pyZabbixSender.sy import syZabbixSender
+
+POLICIES = (syZabbixSender.OVERFLOW_DROP_PRIORITY, syZabbixSender.OVERFLOW_DROP_OLDEST, syZabbixSender.OVERFLOW_DROP_NEWEST)
+LANES = (syZabbixSender.PRIORITY_LOW, syZabbixSender.PRIORITY_NORMAL, syZabbixSender.PRIORITY_NORMAL, syZabbixSender.PRIORITY_HIGH)
+
+class ReferenceData:
+    '''
+    The internal data as described by setCapacity: lists of data points by lane, where data points are dropped
+    by scanning the lists, without buckets nor data points marked as dropped.
+    '''
+    def __init__(self, max_items, policy, priority_of):
+        self.max_items = max_items
+        self.policy = policy
+        self.priority_of = priority_of
+        self.by_priority = policy == syZabbixSender.OVERFLOW_DROP_PRIORITY and priority_of is not None
+        self.dropped = {'oldest': 0, 'newest': 0, 'priority': 0, 'timeout': 0}
+        self.lane_dropped = {}
+        self.clear()
+
+    def clear(self):
+        self.lanes = {syZabbixSender.PRIORITY_NORMAL: []}
+
+    def count(self):
+        return sum(map(len, self.lanes.values()))
+
+    def drop(self, lane, counter):
+        self.dropped[counter] += 1
+        self.lane_dropped[lane] = self.lane_dropped.get(lane, 0) + 1
+
+    def add(self, obj, lane):
+        counter = 'newest' if self.policy == syZabbixSender.OVERFLOW_DROP_NEWEST else 'priority' if self.by_priority else 'oldest'
+        while self.count() >= self.max_items:
+            lowest = min([priority for priority, data in self.lanes.items() if data])
+            data = self.lanes[lowest]
+            if lowest > lane:
+                self.drop(lane, counter)
+                return False
+            if self.policy == syZabbixSender.OVERFLOW_DROP_NEWEST:
+                if lowest == lane:
+                    self.drop(lane, counter)
+                    return False
+                data.pop()
+            elif self.by_priority:
+                lowest_priority = min(map(self.priority_of, data))
+                if lowest == lane and self.priority_of(obj) < lowest_priority:
+                    self.drop(lane, counter)
+                    return False
+                data.pop(map(self.priority_of, data).index(lowest_priority))
+            else:
+                data.pop(0)
+            self.drop(lowest, counter)
+        self.lanes.setdefault(lane, []).append(obj)
+        return True
+
+    def remove(self, obj, lane):
+        data = self.lanes.get(lane, [])
+        if obj not in data:
+            return False
+        data.remove(obj)
+        return True
+
+    def requeue(self, packets):
+        for priority, data in reversed(packets):
+            if data:
+                self.lanes.setdefault(priority, [])[:0] = data
+
+    def data(self):
+        result = []
+        for priority in sorted(self.lanes, reverse=True):
+            result.extend(self.lanes[priority])
+        return result
+
+    def stats(self):
+        stats = self.dropped.copy()
+        stats['items'] = self.count()
+        stats['bytes'] = sum([40 + len(obj['host']) + len(obj['key']) + len(str(obj['value'])) for obj in self.data()])
+        lanes = {}
+        for priority in set(self.lanes.keys()) | set(self.lane_dropped.keys()):
+            lanes[priority] = {'items': len(self.lanes.get(priority, ())), 'dropped': self.lane_dropped.get(priority, 0)}
+        stats['lanes'] = lanes
+        return stats
+
+def points(data):
+    return [{'host': obj['host'], 'key': obj['key'], 'value': obj['value']} for obj in data]
+
+def check_round(seed, policy, steps=600):
+    '''
+    Applies random operations to a sender and to the reference model, and returns the first difference, or None.
+    Data points of different lanes have different keys, so removing one is not ambiguous.
+    '''
+    rnd = random.Random(seed)
+    max_items = rnd.choice((5, 20, 50))
+    priority_of = (lambda obj: obj['value'] % 4) if rnd.random() < 0.8 else None
+    sender = syZabbixSender()
+    sender.setCapacity(max_items=max_items, policy=policy, priority=priority_of)
+    reference = ReferenceData(max_items, policy, priority_of)
+    for step in xrange(steps):
+        r = rnd.random()
+        if r < 0.8:
+            lane = rnd.choice(LANES)
+            obj = {'host': 'h', 'key': 'k%d' % lane, 'value': rnd.randint(0, 30)}
+            if sender.addData(obj['host'], obj['key'], obj['value'], priority=lane) != reference.add(obj, lane):
+                return 'step %d: addData %r in lane %d accepted differently' % (step, obj, lane)
+        elif r < 0.88:
+            data = reference.data()
+            if data:
+                obj = rnd.choice(data)
+                lane = int(obj['key'][1:])
+                if sender.removeDataPoint(obj) != reference.remove(obj, lane):
+                    return 'step %d: removeDataPoint %r removed differently' % (step, obj)
+        elif r < 0.93:
+            # Sends failing for some of the packets, which are put back
+            expected = reference.data()
+            packets = sender._takePackets(None, 7)
+            taken = [obj for packet in packets for obj in points(packet['data'])]
+            if sorted(taken) != sorted(expected):
+                return 'step %d: packets hold %r instead of %r' % (step, taken, expected)
+            kept = [packet for packet in packets if rnd.random() < 0.5]
+            sender._requeue(kept)
+            reference.clear()
+            reference.requeue([(packet.priority, points(packet['data'])) for packet in kept])
+        elif r < 0.95:
+            sender.clearData()
+            reference.clear()
+        else:
+            if points(sender.getData()) != reference.data():
+                return 'step %d: getData differs' % step
+    if points(sender.getData()) != reference.data():
+        return 'end: getData differs'
+    stats = sender.getDropStats()
+    if stats != reference.stats():
+        return 'end: getDropStats %r instead of %r' % (stats, reference.stats())
+    return None
+
+def check(rounds):
+    '''
+    Runs *rounds* random rounds with every policy, and returns the differences found.
+    '''
+    errors = []
+    for policy in POLICIES:
+        for seed in xrange(rounds):
+            try:
+                error = check_round(seed, policy)
+            except Exception, e:
+                error = 'failed: %r' % e
+            if error:
+                errors.append('%s, seed %d: %s' % (policy, seed, error))
+    return errors
+
+def full_sender(policy, items):
+    sender = syZabbixSender()
+    if policy:
+        sender.setCapacity(max_items=items, policy=policy,
+            priority=(lambda obj: obj['value'] % 3) if policy == syZabbixSender.OVERFLOW_DROP_PRIORITY else None)
+    for i in xrange(items):
+        sender.addData('h', 'k', i)
+    return sender
+
+def adds(sender, count):
+    for i in xrange(count):
+        sender.addData('h', 'k', i)
+
+def main():
+    parser = option_parser()
+    parser.add_option('-n', '--items', type='int', default=100000, help='capacity of the internal data')
+    parser.add_option('-a', '--adds', type='int', default=20000, help='data points added per measure')
+    parser.add_option('--rounds', type='int', default=300, help='rounds of the random checks per policy')
+    options, args = parser.parse_args()
+
+    errors = check(options.rounds)
+    for error in errors:
+        sys.stderr.write('%s\n' % error)
+
+    results = [result('overflow', 'random checks', 'errors', len(errors), 'errors')]
+    for policy in POLICIES + (None,):
+        sender = full_sender(policy, options.items)
+        elapsed = best_time(lambda: adds(sender, options.adds), options.repeat) / options.adds
+        results.append(result('overflow', '%s, %d items' % (policy or 'unlimited', options.items), 'time per addData', elapsed * 1e6, 'us'))
+    emit(results, options.output)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# Measures the speedup of encoding chunks in a process pool (see useProcessPool) versus the number of processes:
+#   python benchmarks/pool_encoding.py [--items 1000000] [--chunk 10000] [--output results.jsonl]
+
+import multiprocessing
+
+from benchutil import option_parser, best_time, result, emit
+from json_backends import make_items
+from pyZabbixSender.sy import syZabbixSender
+from pyZabbixSender.pyZabbixSenderBase import encode_packet, frame
+
+def encode_all(sender, chunk):
+    '''
+    Encodes all the chunks like sendData does, without sending them.
+    '''
+    size = 0
+    for packet, data in sender._framedPackets(max_data_per_conn=chunk):
+        if data is None:
+            data = frame(encode_packet(packet))
+        size += len(data)
+    return size
+
+def main():
+    parser = option_parser()
+    parser.add_option('-n', '--items', type='int', default=1000000, help='data points to encode')
+    parser.add_option('-c', '--chunk', type='int', default=10000, help='data points per packet (max_data_per_conn)')
+    options, args = parser.parse_args()
+
+    sender = syZabbixSender()
+    for obj in make_items(options.items):
+        sender.addData(obj['host'], obj['key'], obj['value'], obj['clock'])
+
+    results = []
+    serial = best_time(lambda: encode_all(sender, options.chunk), options.repeat)
+    results.append(result('pool_encoding', 'no pool', 'items/s', options.items / serial, 'items/s'))
+    processes = 1
+    cores = multiprocessing.cpu_count()
+    while True:
+        pool = sender.useProcessPool(processes)
+        encode_all(sender, options.chunk)    # Starts the workers
+        elapsed = best_time(lambda: encode_all(sender, options.chunk), options.repeat)
+        sender.stopProcessPool()
+        case = '%d processes' % processes
+        results.append(result('pool_encoding', case, 'items/s', options.items / elapsed, 'items/s'))
+        results.append(result('pool_encoding', case, 'speedup', serial / elapsed, 'x'))
+        if processes >= cores:
+            break
+        processes = min(processes * 2, cores)
+    emit(results, options.output)
+
+if __name__ == '__main__':
+    main()
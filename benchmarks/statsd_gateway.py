@@ -0,0 +1,139 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# Measures the UDP packets per second the StatsD gateway receives and aggregates end to end, sending to a local
+# fake trapper with txZabbixSender, and checks that the aggregated counters and data points reach the trapper:
+#   python benchmarks/statsd_gateway.py [--packets 1000000] [--lines 4] [--names 1000] [--interval 1] [--output results.jsonl]
+# Datagrams are sent as fast as possible by another process, the datagrams the system drops are reported as lost.
+# Needs Twisted.
+
+import multiprocessing
+import socket
+import sys
+import time
+
+from twisted.internet import reactor, task
+
+from benchutil import option_parser, result, emit
+from faketrapper import FakeTrapper
+from pyZabbixSender.statsd import StatsdAggregator, StatsdGateway
+from pyZabbixSender.tx import txZabbixSender
+
+class CheckedAggregator(StatsdAggregator):
+    '''
+    Aggregator counting the datagrams received, with the times of the first and last ones, the sum of the counters
+    and the data points flushed.
+    '''
+    def __init__(self, *args, **kwargs):
+        StatsdAggregator.__init__(self, *args, **kwargs)
+        self.datagrams = 0
+        self.first = None
+        self.last = None
+        self.counted = 0.0
+        self.added = 0
+
+    def feed(self, datagram):
+        self.last = time.time()
+        if self.first is None:
+            self.first = self.last
+        self.datagrams += 1
+        StatsdAggregator.feed(self, datagram)
+
+    def flush(self, sender, clock=None):
+        self.counted += sum(self.counters.itervalues())
+        added = StatsdAggregator.flush(self, sender, clock)
+        self.added += added
+        return added
+
+def datagrams(lines, names, count=256):
+    '''
+    Returns *count* datagrams of *lines* metrics each, half counters and half timers, over *names* names.
+    '''
+    result = []
+    name = 0
+    for i in xrange(count):
+        metrics = []
+        for j in xrange(lines):
+            if j % 2:
+                metrics.append('bench.timer%d:%d|ms' % (name % names, (i * 7 + j) % 500))
+            else:
+                metrics.append('bench.counter%d:1|c' % (name % names))
+            name += 1
+        result.append('\n'.join(metrics))
+    return result
+
+def blast(port, packets, lines, names, sent):
+    '''
+    Sends *packets* datagrams to the gateway, and the time spent in *sent*.
+    '''
+    pool = datagrams(lines, names)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = ('127.0.0.1', port)
+    size = len(pool)
+    started = time.time()
+    for i in xrange(packets):
+        try:
+            sock.sendto(pool[i % size], address)
+        except socket.error:
+            pass    # Full buffer, the datagram is lost
+    sent.value = time.time() - started
+
+def main():
+    parser = option_parser()
+    parser.add_option('-n', '--packets', type='int', default=1000000, help='datagrams sent')
+    parser.add_option('-l', '--lines', type='int', default=4, help='metrics per datagram')
+    parser.add_option('--names', type='int', default=1000, help='distinct metric names')
+    parser.add_option('-i', '--interval', type='float', default=1.0, help='flush interval of the gateway')
+    options, args = parser.parse_args()
+
+    trapper = FakeTrapper().start()
+    aggregator = CheckedAggregator(default_host='statsd-bench')
+    gateway = StatsdGateway(txZabbixSender('127.0.0.1', trapper.port), aggregator, interval=options.interval)
+    port = gateway.listen(0, interface='127.0.0.1').getHost().port
+    sent = multiprocessing.Value('d', 0.0)
+    sender = multiprocessing.Process(target=blast, args=(port, options.packets, options.lines, options.names, sent))
+    sender.start()
+
+    state = {'received': -1}
+    def finished(result):
+        reactor.stop()
+    def wait():
+        # Done once the sender exited, nothing was received since the previous check, and no flush is in progress
+        if sender.is_alive() or aggregator.datagrams != state['received'] or gateway.flushing:
+            state['received'] = aggregator.datagrams
+            return
+        waiting.stop()
+        gateway.stop()
+        gateway.flush().addBoth(finished)
+    waiting = task.LoopingCall(wait)
+    waiting.start(0.5, now=False)
+    reactor.run()
+    sender.join()
+    trapper.stop()
+
+    counters = (options.lines + 1) // 2
+    errors = []
+    if aggregator.counted != aggregator.datagrams * counters:
+        errors.append('counters: %d counted for %d received' % (aggregator.counted, aggregator.datagrams * counters))
+    if trapper.items != aggregator.added:
+        errors.append('trapper: %d data points received for %d flushed' % (trapper.items, aggregator.added))
+    if trapper.errors:
+        errors.append('trapper: %d errors' % trapper.errors)
+    for error in errors:
+        sys.stderr.write('%s\n' % error)
+
+    case = '%d metrics per datagram' % options.lines
+    elapsed = (aggregator.last - aggregator.first) if aggregator.datagrams > 1 else 0
+    results = [
+        result('statsd_gateway', case, 'sent', options.packets / sent.value if sent.value else 0, 'packets/s'),
+        result('statsd_gateway', case, 'received', (aggregator.datagrams - 1) / elapsed if elapsed else 0, 'packets/s'),
+        result('statsd_gateway', case, 'metrics', aggregator.metrics / elapsed if elapsed else 0, 'metrics/s'),
+        result('statsd_gateway', case, 'lost', 100.0 * (options.packets - aggregator.datagrams) / options.packets, '%'),
+        result('statsd_gateway', case, 'data points', aggregator.added, 'items'),
+        result('statsd_gateway', 'aggregation checks', 'errors', len(errors), 'errors'),
+    ]
+    emit(results, options.output)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,39 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# Compares TLS connections per second with and without session resumption, against the fake trapper:
+#   python benchmarks/tls_resumption.py [--connections 500] [--output results.jsonl]
+
+import tempfile
+
+from benchutil import option_parser, best_time, result, emit
+from faketrapper import FakeTrapper, make_certificate
+from pyZabbixSender.sy import syZabbixSender
+from pyZabbixSender.tls import sessions_supported
+
+def main():
+    parser = option_parser()
+    parser.add_option('-n', '--connections', type='int', default=500, help='connections (one data point each)')
+    options, args = parser.parse_args()
+
+    certfile, keyfile = make_certificate(tempfile.gettempdir())
+    trapper = FakeTrapper(certfile=certfile, keyfile=keyfile).start()
+    sender = syZabbixSender('localhost', trapper.port)
+    for i in xrange(options.connections):
+        sender.addData('host', 'key[%d]' % i, i)
+
+    results = []
+    for reuse in (False, True):
+        tls = sender.useTLS(ca_file=certfile, session_reuse=reuse)
+        elapsed = best_time(lambda: sender.sendData(max_data_per_conn=1), options.repeat)
+        case = 'session reuse' if reuse else 'full handshakes'
+        stats = tls.getStats()
+        results.append(result('tls_resumption', case, 'connections/s', options.connections / elapsed, 'conn/s'))
+        results.append(result('tls_resumption', case, 'resumed', 100.0 * stats['resumed'] / (stats['resumed'] + stats['handshakes']), '%'))
+    trapper.stop()
+    if not sessions_supported():
+        print 'TLS sessions are not resumed without pyOpenSSL'
+    emit(results, options.output)
+
+if __name__ == '__main__':
+    main()
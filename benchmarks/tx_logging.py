@@ -0,0 +1,71 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# Measures the logging overhead of txZabbixSender per packet sent, with a log file observer like under twistd:
+#   python benchmarks/tx_logging.py [--items 10000] [--sends 200] [--output results.jsonl]
+# Needs Twisted.
+
+import logging
+import os
+
+from twisted.python import log
+
+from benchutil import option_parser, best_time, result, emit
+from json_backends import make_items
+from pyZabbixSender import tx
+
+class NullTransport:
+    def write(self, data):
+        pass
+
+    def loseConnection(self):
+        pass
+
+class EagerProtocol(tx.SenderProtocol):
+    '''
+    Logs like the former protocol did: every packet formatted in full, whatever the level.
+    '''
+    def send_packet(self, packet):
+        log.msg("Sending a packet: %s" % packet)
+        tx.SenderProtocol.send_packet(self, packet)
+        log.msg("Packet sent")
+
+def sends(protocol_class, packet, count):
+    protocol = protocol_class(None)
+    protocol.transport = NullTransport()
+    for i in xrange(count):
+        protocol.send_packet(packet)
+
+def main():
+    parser = option_parser()
+    parser.add_option('-n', '--items', type='int', default=10000, help='data points per packet')
+    parser.add_option('-s', '--sends', type='int', default=200, help='packets sent per measure')
+    options, args = parser.parse_args()
+
+    packet = {'request': 'sender data', 'data': make_items(options.items)}
+    devnull = open(os.devnull, 'w')
+    log.startLoggingWithObserver(log.FileLogObserver(devnull).emit, setStdout=False)
+
+    cases = (
+        ('no logging', tx.SenderProtocol, logging.CRITICAL),
+        ('default level', tx.SenderProtocol, tx.log_level),
+        ('debug level with preview', tx.SenderProtocol, logging.DEBUG),
+        ('former eager formatting', EagerProtocol, logging.CRITICAL),
+    )
+    results = []
+    baseline = None
+    for name, protocol_class, level in cases:
+        default_level = tx.log_level
+        tx.set_log_level(level)
+        try:
+            elapsed = best_time(lambda: sends(protocol_class, packet, options.sends), options.repeat) / options.sends
+        finally:
+            tx.set_log_level(default_level)
+        if baseline is None:
+            baseline = elapsed
+        results.append(result('tx_logging', '%s, %d items' % (name, options.items), 'time per send', elapsed * 1e6, 'us'))
+        results.append(result('tx_logging', '%s, %d items' % (name, options.items), 'logging overhead', (elapsed - baseline) * 1e6, 'us'))
+    emit(results, options.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from itertools import islice
+
+from pyZabbixSenderBase import pyZabbixSenderBase, SenderPacket
+from sy import syZabbixSender
+from ring import RingBuffer
+from framing import frame
+from retry import RETRY, PERMANENT
+import jsoncodec
+
+class MemoryBuffer:
+    '''
+    Buffer of records kept in memory, with the interface of *RingBuffer*: records are only removed by *commit*.
+    Records beyond *capacity* (a number of records, unlimited if None) are dropped and counted.
+    '''
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self._records = deque()
+        self._read = 0          # Offset of the first record
+        self._written = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def put(self, payload):
+        self._lock.acquire()
+        try:
+            if self.capacity is not None and len(self._records) >= self.capacity:
+                self._dropped += 1
+                return False
+            self._records.append(payload)
+            self._written += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def read(self, max_records=None):
+        self._lock.acquire()
+        try:
+            count = len(self._records)
+            if max_records is not None:
+                count = min(count, max_records)
+            # Indexing a deque is linear, so the records are iterated
+            return [(payload, self._read + i + 1) for i, payload in enumerate(islice(self._records, count))]
+        finally:
+            self._lock.release()
+
+    def commit(self, offset):
+        self._lock.acquire()
+        try:
+            for i in xrange(min(offset - self._read, len(self._records))):
+                self._records.popleft()
+            self._read = max(self._read, offset)
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        return {
+            'capacity': self.capacity,
+            'used': len(self._records),
+            'written': self._written,
+            'dropped': self._dropped,
+        }
+
+    def close(self):
+        pass
+
+
+class agentZabbixSender(syZabbixSender):
+    '''
+    This class sends data like an active agent, with "agent data" requests: every value has an *id*, increasing within
+    the *session* of the sender, and its *clock* and *ns*. The server remembers the last id processed in every session
+    and ignores the values with a lower or equal id, so a packet can be sent again safely when its response is lost
+    (after a timeout, a reset connection...), without duplicating history.
+
+    Values wait in a buffer until they are sent: a *RingBuffer* file if *buffer_path* is given, so they survive a
+    restart of the process, or a *MemoryBuffer* otherwise. With a file, the session and the next id are saved in
+    *buffer_path* + ".state", so the values sent again after a restart are still recognized by the server.
+    Ids are reserved by blocks of *id_block*, so the state file is written once per block only.
+
+    Values are sent in the order they were added, as the server would ignore values with a lower id than the ones already
+    processed. A buffer file must not be shared by several processes.
+    '''
+    def __init__(self, server=pyZabbixSenderBase.ZABBIX_SERVER, port=pyZabbixSenderBase.ZABBIX_PORT, buffer_path=None, capacity=None, id_block=1000, verbose=False):
+        '''
+        #####Description:
+        This is the constructor, to obtain an object of type agentZabbixSender, linked to work with a specific server/port.
+
+        #####Parameters:
+        * **server**: [in] [string] [optional] This is the server domain name or IP. *Default value: "127.0.0.1"*
+        * **port**: [in] [integer] [optional] This is the port open in the server to receive zabbix traps. *Default value: 10051*
+        * **buffer_path**: [in] [string] [optional] The file of the persistent buffer. If omitted, values are buffered in memory. *Default value: None*
+        * **capacity**: [in] [integer] [optional] The size of the buffer: in bytes for a file (16 MiB if None), in values in memory (unlimited if None). *Default value: None*
+        * **id_block**: [in] [integer] [optional] The number of ids reserved at once in the state file. *Default value: 1000*
+        * **verbose**: [in] [boolean] [optional] This is to allow the library to write some output to stderr when finds an error. *Default value: False*
+
+        #####Return:
+        It returns an agentZabbixSender object.
+        '''
+        syZabbixSender.__init__(self, server, port, verbose=verbose)
+        self.id_block = id_block
+        self._id_lock = threading.Lock()
+        self._state_path = None
+        if buffer_path is None:
+            self.buffer = MemoryBuffer(capacity)
+            self.session = uuid.uuid4().hex
+            self._next_id = self._reserved_id = 1
+        else:
+            self.buffer = RingBuffer(buffer_path, capacity or 16 << 20)
+            self._state_path = buffer_path + '.state'
+            self._loadState()
+
+    def _loadState(self):
+        '''
+        Reads the session and the next id from the state file, or starts a new session.
+        '''
+        try:
+            f = open(self._state_path)
+            try:
+                state = jsoncodec.loads(f.read())
+            finally:
+                f.close()
+            self.session = str(state['session'])
+            self._next_id = self._reserved_id = int(state['next_id'])
+        except (IOError, ValueError, KeyError):
+            self.session = uuid.uuid4().hex
+            self._next_id = self._reserved_id = 1
+            self._saveState(1)
+
+    def _saveState(self, next_id):
+        '''
+        Writes the session and *next_id* to the state file, replacing it atomically.
+        '''
+        tmp_path = self._state_path + '.tmp'
+        f = open(tmp_path, 'w')
+        try:
+            f.write(jsoncodec.dumps({'session': self.session, 'next_id': next_id}))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, self._state_path)
+
+    def _newId(self):
+        '''
+        Returns the id of a new value, reserving a new block of ids first if needed. Called with the id lock held.
+        '''
+        value_id = self._next_id
+        if value_id >= self._reserved_id:
+            self._reserved_id = value_id + self.id_block
+            if self._state_path is not None:
+                self._saveState(self._reserved_id)
+        self._next_id = value_id + 1
+        return value_id
+
+    def addData(self, host, key, value, clock=None):
+        '''
+        #####Description:
+        Adds host, key, value and optionally clock to the buffer of values to be sent later, with a new id.
+
+        #####Parameters:
+        * **host**: [in] [string] [mandatory] The host which the data is associated to.
+        * **key**: [in] [string] [mandatory] The key of the active item in the Zabbix server.
+        * **value**: [in] [any] [mandatory] The value you want to send.
+        * **clock**: [in] [integer or float] [optional] The Unix timestamp of the value, with the nanoseconds taken from its fractional part.
+          If omitted, the current time is used. *Default value: None*
+
+        #####Return:
+        It returns True if the value was stored, and False if it was dropped because the buffer is full.
+        '''
+        if clock is None:
+            clock = time.time()
+        seconds = int(clock)
+        obj = {
+            'host': host,
+            'key': key,
+            'value': value,
+            'clock': seconds,
+            'ns': int((clock - seconds) * 1e9),
+        }
+        self._id_lock.acquire()
+        try:
+            obj['id'] = self._newId()
+            return self.buffer.put(jsoncodec.dumps(obj))
+        finally:
+            self._id_lock.release()
+
+    def addDataArray(self, host, key, values, clocks=None):
+        '''
+        #####Description:
+        Adds a series of values of one host and key, calling *addData* for every value.
+
+        #####Return:
+        The number of values stored.
+        '''
+        if clocks is not None and len(clocks) != len(values):
+            raise ValueError('values and clocks must have the same length')
+        count = 0
+        for i in xrange(len(values)):
+            if self.addData(host, key, values[i], clocks[i] if clocks is not None else None):
+                count += 1
+        return count
+
+    def _agentPacket(self, payloads):
+        '''
+        Returns the "agent data" packet of the encoded values, and its framed data. Only the values are kept in the packet
+        dict given to the observers. The values stay in the buffer until they are delivered, so the packet is *kept*.
+        '''
+        now = time.time()
+        clock = int(now)
+        data_to_send = frame('{"request":"agent data","session":"%s","data":[%s],"clock":%d,"ns":%d}' % (
+            self.session, ','.join(payloads), clock, int((now - clock) * 1e9)))
+        packet = SenderPacket({'request': 'agent data', 'session': self.session, 'data': payloads, 'clock': clock})
+        packet.kept = True
+        return packet, data_to_send
+
+    def _sendChunk(self, payloads, expires=None):
+        '''
+        Sends the values, retrying with the same ids and session while the errors are retryable. Returns *(result, msg)*.
+        '''
+        policy = self._retryPolicy()
+        policy.budget.deposit()
+        attempts = 1
+        while True:
+            packet, data_to_send = self._agentPacket(payloads)
+            try:
+                return True, self.send_packet(packet, expires, data_to_send)
+            except Exception, ex:
+                outcome = policy.classify(ex)
+                if outcome == RETRY:
+                    due = time.time() + policy.delay(attempts)
+                    if (expires is None or due < expires) and policy.retry(attempts):
+                        if self.self_monitor is not None:
+                            self.self_monitor.retry()
+                        time.sleep(max(0, due - time.time()))
+                        attempts += 1
+                        continue
+                elif outcome == PERMANENT:
+                    policy.failed()
+                return False, ex
+
+    def sendData(self, packet_clock=None, max_data_per_conn=None, deadline=None, max_records=None):
+        '''
+        #####Description:
+        Sends the buffered values to the Zabbix server, in chunks of *max_data_per_conn* values, and removes them from the buffer
+        as soon as their chunk is delivered. Failed chunks are sent again with the same ids while the error is retryable (see *useRetries*),
+        so the server processes every value once even if a response is lost.
+
+        Chunks are sent in order: after a chunk finally fails, the next ones are not sent, and all of them stay in the buffer
+        for the next call.
+
+        #####Parameters:
+        * **packet_clock**: [in] [integer] [optional] Ignored, kept for compatibility with the other senders: the packet clock of "agent data"
+          requests is the time of the send, which the server uses to correct the clocks of the values. *Default value: None*
+        * **max_data_per_conn**: [in] [integer] [optional] The maximum number of values sent in one single connection. If omitted, all values are sent at once. *Default value: None*
+        * **deadline**: [in] [float] [optional] Limits the time of the whole operation, in seconds, retries included. *Default value: None*
+        * **max_records**: [in] [integer] [optional] The maximum number of values taken from the buffer. *Default value: None*
+
+        #####Return:
+        A list of *(result, msg)* associated to each chunk sent, like *syZabbixSender.sendData*, where *msg* is the result of its last attempt.
+        '''
+        expires = time.time() + deadline if deadline is not None else None
+        records = self.buffer.read(max_records)
+        size = max_data_per_conn or len(records) or 1
+        responses = []
+        for start in xrange(0, len(records), size):
+            chunk = records[start:start + size]
+            payloads = [payload for payload, offset in chunk if payload is not None]
+            if payloads:
+                response = self._sendChunk(payloads, expires)
+                responses.append(response)
+                if not response[0]:
+                    break
+            # A None payload is a corrupted record, its offset skips it
+            self.buffer.commit(chunk[-1][1])
+        return responses
+
+    flushData = sendData
+
+    def sendDataOneByOne(self, deadline=None):
+        '''
+        #####Description:
+        Sends the buffered values one by one, see *sendData*.
+        '''
+        return self.sendData(max_data_per_conn=1, deadline=deadline)
+
+    def getData(self):
+        '''
+        #####Description:
+        Returns the buffered values, as dicts with their *id*, *clock* and *ns*.
+        '''
+        return [jsoncodec.loads(payload) for payload, offset in self.buffer.read() if payload is not None]
+
+    def printData(self):
+        '''
+        #####Description:
+        Print buffered values (to stdout), so you can see what will be sent if "sendData" is called.
+        '''
+        data = self.getData()
+        for elem in data:
+            print str(elem)
+        print 'Count: %d' % len(data)
+
+    def _dataCount(self):
+        return len(self.buffer.read())
+
+    def clearData(self):
+        '''
+        #####Description:
+        Removes all the buffered values without sending them. The ids go on increasing.
+        '''
+        records = self.buffer.read()
+        if records:
+            self.buffer.commit(records[-1][1])
+
+    def close(self):
+        '''
+        Closes the buffer.
+        '''
+        self.buffer.close()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import threading
+import time
+
+class CircuitOpen(Exception):
+    '''
+    Raised instead of connecting while the circuit breaker of the server is open.
+    '''
+    pass
+
+class CircuitBreaker:
+    '''
+    Tracks consecutive connection failures to one server (endpoint).
+
+    After *failures* consecutive failures the breaker opens, and connections are
+    refused immediately during *cooldown* seconds. Then a single probe connection is
+    let through (half-open state): its success closes the breaker, its failure
+    opens it again for another cooldown period.
+    '''
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failures=5, cooldown=30.0):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.rejected = 0
+        self.transitions = {
+            self.OPEN: 0,
+            self.HALF_OPEN: 0,
+            self.CLOSED: 0,
+        }
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        self.state = state
+        self.transitions[state] += 1
+        if state == self.OPEN:
+            self.opened_at = time.time()
+
+    def allow(self):
+        '''
+        Returns True if a connection may be attempted now.
+        '''
+        self._lock.acquire()
+        try:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.cooldown:
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+        finally:
+            self._lock.release()
+
+    def success(self):
+        '''
+        Records a successful connection.
+        '''
+        self._lock.acquire()
+        try:
+            self.consecutive_failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                self._transition(self.CLOSED)
+        finally:
+            self._lock.release()
+
+    def failure(self):
+        '''
+        Records a failed connection.
+        '''
+        self._lock.acquire()
+        try:
+            self.consecutive_failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.consecutive_failures >= self.failures):
+                self._transition(self.OPEN)
+        finally:
+            self._lock.release()
+
+    def abandon(self):
+        '''
+        Records a connection allowed by *allow* but not attempted (the deadline was exceeded before connecting...),
+        so the half-open state lets another probe through.
+        '''
+        self._lock.acquire()
+        try:
+            self._probing = False
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        '''
+        Returns a dict with the breaker state and counters, for monitoring purposes.
+        '''
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'opened_at': self.opened_at,
+            'rejected': self.rejected,
+            'transitions': self.transitions.copy(),
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(server, port, failures=5, cooldown=30.0):
+    '''
+    Returns the circuit breaker shared by all senders of the *server*:*port* endpoint
+    in this process, creating it if needed.
+    '''
+    _breakers_lock.acquire()
+    try:
+        breaker = _breakers.get((server, port))
+        if breaker is None:
+            breaker = _breakers[(server, port)] = CircuitBreaker(failures, cooldown)
+        else:
+            breaker.failures = failures
+            breaker.cooldown = cooldown
+        return breaker
+    finally:
+        _breakers_lock.release()
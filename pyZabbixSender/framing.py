@@ -0,0 +1,139 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import struct
+
+from net import recv_exact, read_at
+
+# Header of the Zabbix protocol: "ZBXD", flags (1 = Zabbix protocol), and the length of the data
+HEADER = struct.Struct('<4sBQ')
+HEADER_SIZE = HEADER.size
+MAGIC = 'ZBXD'
+FLAGS = 0x01
+MAX_FRAME = 1 << 30     # Like ZBX_MAX_RECV_DATA_SIZE in the Zabbix server
+
+class InvalidResponse(Exception):
+    pass
+
+class FrameError(InvalidResponse):
+    '''
+    Raised when the data received is not a valid Zabbix protocol frame.
+    '''
+    pass
+
+def frame(data):
+    '''
+    Returns the encoded packet with the protocol header, ready to be sent.
+    '''
+    return HEADER.pack(MAGIC, FLAGS, len(data)) + str(data)
+
+def parse_header(header, offset=0, max_frame=MAX_FRAME):
+    '''
+    Returns the length of the data following the header at *offset* of *header* (a string or a bytearray).
+    Raises FrameError if it's not a valid header.
+    '''
+    magic, flags, length = HEADER.unpack_from(header, offset)
+    if magic != MAGIC:
+        raise FrameError('Wrong magic: %r' % str(header[offset:offset + HEADER_SIZE]))
+    if flags != FLAGS:
+        raise FrameError('Unsupported protocol flags: %#x' % flags)
+    if length > max_frame:
+        raise FrameError('Frame too big: %d bytes, the maximum is %d' % (length, max_frame))
+    return length
+
+class FrameDecoder:
+    '''
+    Incremental decoder of a stream of frames, independent of the transport: data is given to *feed*
+    as it's received, in chunks of any size, and complete frames are returned.
+
+    Data is appended to a buffer, and consumed data is only removed from it when it's more than the half
+    of the buffer, so the work done is proportional to the data received whatever the chunks are.
+    '''
+    def __init__(self, max_frame=MAX_FRAME):
+        self.max_frame = max_frame
+        self._buffer = bytearray()
+        self._pos = 0
+        self._length = None     # Data length of the current frame, once its header is decoded
+
+    def feed(self, data):
+        '''
+        Adds received data, and returns the list of payloads of the frames completed.
+        Raises FrameError if the data is not valid.
+        '''
+        buf = self._buffer
+        buf.extend(data)
+        frames = []
+        while True:
+            available = len(buf) - self._pos
+            if self._length is None:
+                if available < HEADER_SIZE:
+                    break
+                self._length = parse_header(buf, self._pos, self.max_frame)
+                self._pos += HEADER_SIZE
+                available -= HEADER_SIZE
+            if available < self._length:
+                break
+            end = self._pos + self._length
+            frames.append(str(buf[self._pos:end]))
+            self._pos = end
+            self._length = None
+        if self._pos == len(buf):
+            del buf[:]
+            self._pos = 0
+        elif self._pos > len(buf) // 2:
+            del buf[:self._pos]
+            self._pos = 0
+        return frames
+
+    def needed(self):
+        '''
+        Returns the number of bytes still needed to complete the current header or frame.
+        '''
+        available = len(self._buffer) - self._pos
+        if self._length is None:
+            return HEADER_SIZE - available
+        return self._length - available
+
+    def pending(self):
+        '''
+        Returns the number of bytes received and not returned in a frame yet.
+        '''
+        return len(self._buffer) - self._pos
+
+def read_frame(sock, timeout=None, expires=None, max_frame=MAX_FRAME, on_header=None):
+    '''
+    Reads a frame from a blocking socket and returns its payload. *timeout* and *expires* are passed to *recv_exact*.
+    *on_header* is called when the header is received, if given.
+    '''
+    decoder = FrameDecoder(max_frame)
+    frames = decoder.feed(recv_exact(sock, HEADER_SIZE, timeout, expires))
+    if on_header is not None:
+        on_header()
+    while not frames:
+        frames = decoder.feed(recv_exact(sock, decoder.needed(), timeout, expires))
+    return frames[0]
+
+def framed_length(header):
+    '''
+    Returns the total length of the framed packet starting with the *header*.
+    Raises ValueError if it's not the header of a packet.
+    '''
+    if len(header) < HEADER_SIZE:
+        raise ValueError('Not a framed packet: %r' % header)
+    try:
+        return HEADER_SIZE + parse_header(header)
+    except FrameError, ex:
+        raise ValueError('Not a framed packet: %s' % ex)
+
+def framed_offsets(fd):
+    '''
+    Yields the offsets of the framed packets stored one after another in the file *fd*.
+    '''
+    offset = 0
+    while True:
+        header = read_at(fd, offset, HEADER_SIZE)
+        if not header:
+            return
+        length = framed_length(header)
+        yield offset
+        offset += length
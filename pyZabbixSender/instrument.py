@@ -0,0 +1,200 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import threading
+import time
+
+PHASES = ('throttle', 'encode', 'connect', 'write', 'wait', 'parse')
+
+class SendRecord:
+    '''
+    Timings and counters of a single send (one packet, one connection).
+
+    Phase durations are in seconds:
+    * **throttle**: waiting for the rate limiter
+    * **encode**: building the JSON packet and its header
+    * **connect**: establishing the connection
+    * **write**: writing the packet to the socket
+    * **wait**: waiting for the server reply
+    * **parse**: reading and parsing the reply
+
+    *latency* is the time since the first data point of the packet's lane was added until the send completed (see *addData*).
+    '''
+    def __init__(self, items=0, priority=None, enqueued=None):
+        self.started = self._last = time.time()
+        self.priority = priority
+        self.enqueued = enqueued
+        self.latency = None
+        self.throttle = self.encode = self.connect = self.write = self.wait = self.parse = 0.0
+        self.duration = 0.0
+        self.items = items
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.processed = None
+        self.failed = None
+        self.seconds_spent = None
+        self.error = None
+
+    def mark(self, phase):
+        '''
+        Ends the *phase*, which started at the end of the previous one.
+        Time is added up if the phase is marked several times.
+        '''
+        now = time.time()
+        setattr(self, phase, getattr(self, phase) + now - self._last)
+        self._last = now
+
+    def finish(self):
+        now = time.time()
+        self.duration = now - self.started
+        if self.enqueued is not None:
+            self.latency = now - self.enqueued
+
+    def asDict(self):
+        result = {
+            'started': self.started,
+            'duration': self.duration,
+            'items': self.items,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'processed': self.processed,
+            'failed': self.failed,
+            'seconds_spent': self.seconds_spent,
+            'error': self.error,
+            'priority': self.priority,
+            'latency': self.latency,
+        }
+        for phase in PHASES:
+            result[phase] = getattr(self, phase)
+        return result
+
+    def __repr__(self):
+        return '<SendRecord %r>' % self.asDict()
+
+
+class SendStats:
+    '''
+    Cumulative statistics of the sends, to be registered as an observer with *addObserver()*.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.sends = 0
+            self.errors = 0
+            self.items = 0
+            self.processed = 0
+            self.failed = 0
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.seconds_spent = 0.0
+            self.duration = 0.0
+            self.max_duration = 0.0
+            self.phases = dict([(phase, 0.0) for phase in PHASES])
+        finally:
+            self._lock.release()
+
+    def __call__(self, record):
+        self._lock.acquire()
+        try:
+            self.sends += 1
+            if record.error is not None:
+                self.errors += 1
+            self.items += record.items
+            self.processed += record.processed or 0
+            self.failed += record.failed or 0
+            self.bytes_sent += record.bytes_sent
+            self.bytes_received += record.bytes_received
+            self.seconds_spent += record.seconds_spent or 0.0
+            self.duration += record.duration
+            if record.duration > self.max_duration:
+                self.max_duration = record.duration
+            for phase in PHASES:
+                self.phases[phase] += getattr(record, phase)
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        '''
+        Returns a dict with the counters and total time spent in every phase.
+        '''
+        self._lock.acquire()
+        try:
+            return {
+                'sends': self.sends,
+                'errors': self.errors,
+                'items': self.items,
+                'processed': self.processed,
+                'failed': self.failed,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'seconds_spent': self.seconds_spent,
+                'duration': self.duration,
+                'max_duration': self.max_duration,
+                'phases': self.phases.copy(),
+            }
+        finally:
+            self._lock.release()
+
+
+class LaneStats:
+    '''
+    Statistics of the sends of every priority lane, to be registered as an observer with *addObserver()*.
+    Latencies are kept since the last *reset()*.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.lanes = {}
+        finally:
+            self._lock.release()
+
+    def __call__(self, record):
+        if record.priority is None:
+            return
+        self._lock.acquire()
+        try:
+            lane = self.lanes.get(record.priority)
+            if lane is None:
+                lane = self.lanes[record.priority] = {
+                    'sends': 0,
+                    'errors': 0,
+                    'items': 0,
+                    'latency_total': 0.0,
+                    'latency_max': 0.0,
+                    'latency_last': None,
+                }
+            lane['sends'] += 1
+            if record.error is not None:
+                lane['errors'] += 1
+            lane['items'] += record.items
+            if record.latency is not None:
+                lane['latency_total'] += record.latency
+                lane['latency_last'] = record.latency
+                if record.latency > lane['latency_max']:
+                    lane['latency_max'] = record.latency
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        '''
+        Returns a dict of counters by priority: *sends*, *errors*, *items*, and *latency_avg*, *latency_max* and *latency_last* in seconds.
+        '''
+        self._lock.acquire()
+        try:
+            result = {}
+            for priority, lane in self.lanes.items():
+                stats = lane.copy()
+                total = stats.pop('latency_total')
+                stats['latency_avg'] = total / lane['sends']
+                result[priority] = stats
+            return result
+        finally:
+            self._lock.release()
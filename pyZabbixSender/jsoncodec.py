@@ -0,0 +1,100 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+# JSON backend used by all the senders to encode packets and decode responses.
+# The fastest library installed is used, see BACKENDS and use_backend().
+
+BACKENDS = ('ujson', 'rapidjson', 'simplejson', 'json')
+
+def _accepts(function, value, **kwargs):
+    '''
+    Returns True if *function* accepts the keyword arguments (they differ between library versions).
+    '''
+    try:
+        function(value, **kwargs)
+    except TypeError:
+        return False
+    return True
+
+def _load_ujson():
+    import ujson
+    dumps = ujson.dumps
+    loads = ujson.loads
+    # Old versions round floats to 9 digits by default
+    if _accepts(dumps, 0.1, double_precision=15):
+        dumps = lambda obj, _dumps=ujson.dumps: _dumps(obj, double_precision=15)
+    if _accepts(loads, '0.1', precise_float=True):
+        loads = lambda data, _loads=ujson.loads: _loads(data, precise_float=True)
+    return dumps, loads
+
+def _load_rapidjson():
+    import rapidjson
+    return rapidjson.dumps, rapidjson.loads
+
+def _load_simplejson():
+    import simplejson
+    return simplejson.dumps, simplejson.loads
+
+def _load_json():
+    import json
+    return json.dumps, json.loads
+
+_loaders = {
+    'ujson': _load_ujson,
+    'rapidjson': _load_rapidjson,
+    'simplejson': _load_simplejson,
+    'json': _load_json,
+}
+
+name = None
+dumps = None
+loads = None
+
+def available_backends():
+    '''
+    Returns the names of the backends which can be used, fastest first.
+    '''
+    result = []
+    for backend in BACKENDS:
+        try:
+            _loaders[backend]()
+        except ImportError:
+            continue
+        result.append(backend)
+    return result
+
+def use_backend(backend=None, encoder=None, decoder=None):
+    '''
+    #####Description:
+    Selects the JSON library used to encode packets and decode responses, in all the senders.
+
+    #####Parameters:
+    * **backend**: [in] [string] [optional] One of BACKENDS. If omitted, the first one installed is used. *Default value: None*
+    * **encoder**, **decoder**: [in] [callable] [optional] Custom functions like *json.dumps* and *json.loads*, to use instead of a known backend.
+      *backend* is then the name given to them. *Default value: None*
+
+    #####Return:
+    The name of the backend selected. ImportError is raised if the backend is not installed.
+    '''
+    global name, dumps, loads
+    if encoder is not None or decoder is not None:
+        if encoder is None or decoder is None:
+            raise ValueError('both encoder and decoder are required')
+        name, dumps, loads = backend or 'custom', encoder, decoder
+        return name
+    if backend is not None:
+        if backend not in _loaders:
+            raise ImportError('Unknown JSON backend: %s' % backend)
+        dumps, loads = _loaders[backend]()
+        name = backend
+        return name
+    for backend in BACKENDS:
+        try:
+            dumps, loads = _loaders[backend]()
+        except ImportError:
+            continue
+        name = backend
+        return name
+    raise ImportError('No JSON library available')
+
+use_backend()
@@ -0,0 +1,293 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import socket
+import select
+import ssl
+import errno
+import os
+import threading
+import time
+
+# The class is captured at import time, so the legacy sender patching
+# socket.socket for SOCKS proxies doesn't leak into direct connections.
+_socket_class = socket.socket
+
+# Zero-copy file sending: os.sendfile (Python 3.3+), or the pysendfile package
+_sendfile = getattr(os, 'sendfile', None)
+if _sendfile is None:
+    try:
+        from sendfile import sendfile as _sendfile
+    except ImportError:
+        _sendfile = None
+
+FILE_BLOCK_SIZE = 1 << 16   # Block size when copying a file without sendfile
+
+# Delay between racing connection attempts, as recommended by RFC 8305
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+class DeadlineExceeded(socket.timeout):
+    '''
+    Raised when the time given to a send operation is over.
+    '''
+    pass
+
+class AddressCache:
+    '''
+    Keeps the resolved addresses of a server for *ttl* seconds, so a DNS lookup
+    is not done for every connection. The cache is refreshed in the background
+    shortly before it expires, and keeps the old addresses if the refresh fails.
+    '''
+    REFRESH_AHEAD = 0.2    # Fraction of the ttl before expiration when a background refresh starts.
+
+    def __init__(self, host, port, ttl=60):
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self._addresses = None
+        self._expires = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _lookup(self):
+        infos = socket.getaddrinfo(self.host, self.port, socket.AF_UNSPEC, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        addresses = interleave_families(infos)
+        self._lock.acquire()
+        try:
+            self._addresses = addresses
+            self._expires = time.time() + self.ttl
+        finally:
+            self._lock.release()
+        return addresses
+
+    def _refresh(self):
+        try:
+            try:
+                self._lookup()
+            except socket.error:
+                pass    # Keep serving the old addresses until the next attempt
+        finally:
+            self._refreshing = False
+
+    def _refreshInBackground(self):
+        self._lock.acquire()
+        try:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        finally:
+            self._lock.release()
+        t = threading.Thread(target=self._refresh, name='zabbix-resolve-%s' % self.host)
+        t.setDaemon(True)
+        t.start()
+
+    def peek(self):
+        '''
+        Returns cached addresses without blocking, or None if nothing is cached yet.
+        Starts a background refresh when the cache is empty or about to expire.
+        '''
+        addresses = self._addresses
+        if addresses is None or time.time() >= self._expires - self.ttl * self.REFRESH_AHEAD:
+            self._refreshInBackground()
+        return addresses
+
+    def resolve(self):
+        '''
+        Returns a list of getaddrinfo() tuples for the server, resolving it only
+        when the cache is empty or expired.
+        '''
+        addresses = self._addresses
+        now = time.time()
+        if addresses is None or now >= self._expires:
+            return self._lookup()
+        if now >= self._expires - self.ttl * self.REFRESH_AHEAD:
+            self._refreshInBackground()
+        return addresses
+
+    def invalidate(self):
+        '''
+        Forgets cached addresses, so the next call resolves the server again.
+        '''
+        self._addresses = None
+        self._expires = 0
+
+
+def interleave_families(infos):
+    '''
+    Reorders getaddrinfo() results alternating address families, starting with
+    the family of the first (preferred) result, as described by RFC 8305.
+    '''
+    if not infos:
+        return []
+    first = [i for i in infos if i[0] == infos[0][0]]
+    other = [i for i in infos if i[0] != infos[0][0]]
+    result = []
+    while first or other:
+        if first:
+            result.append(first.pop(0))
+        if other:
+            result.append(other.pop(0))
+    return result
+
+
+def configure_socket(sock, nodelay=True, send_buffer_size=None):
+    '''
+    Applies sender socket options.
+    '''
+    if nodelay:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if send_buffer_size:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size)
+
+
+def open_connection(addresses, timeout=None, nodelay=True, send_buffer_size=None, attempt_delay=CONNECTION_ATTEMPT_DELAY):
+    '''
+    Connects to the first reachable address of the *addresses* list (getaddrinfo() tuples)
+    and returns a connected blocking socket with *timeout* set.
+
+    When both IPv4 and IPv6 addresses are present, attempts are raced ("happy eyeballs"):
+    a new attempt starts every *attempt_delay* seconds or as soon as the previous one fails,
+    and the first established connection wins. Otherwise addresses are tried one by one.
+    The *timeout* limits the whole connection setup.
+    '''
+    if len(set([a[0] for a in addresses])) < 2:
+        attempt_delay = None
+    queue = list(addresses)
+    pending = {}
+    winner = None
+    last_error = None
+    deadline = time.time() + timeout if timeout is not None else None
+    next_attempt = 0
+    try:
+        while queue or pending:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                raise socket.timeout('timed out')
+
+            if queue and (not pending or (attempt_delay is not None and now >= next_attempt)):
+                family, socktype, proto, canonname, sockaddr = queue.pop(0)
+                try:
+                    sock = _socket_class(family, socktype, proto)
+                    configure_socket(sock, nodelay, send_buffer_size)
+                    sock.setblocking(0)
+                    rc = sock.connect_ex(sockaddr)
+                except socket.error, err:
+                    last_error = err
+                    continue
+                if rc == 0:
+                    winner = sock
+                    break
+                if rc not in _IN_PROGRESS:
+                    sock.close()
+                    last_error = socket.error(rc, os.strerror(rc))
+                    continue
+                pending[sock] = sockaddr
+                if attempt_delay is not None:
+                    next_attempt = now + attempt_delay
+                continue
+
+            wait = None
+            if queue and attempt_delay is not None:
+                wait = max(0, next_attempt - now)
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+            socks = list(pending.keys())
+            _, writable, errored = select.select([], socks, socks, wait)
+            for sock in set(writable + errored):
+                del pending[sock]
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    winner = sock
+                    break
+                sock.close()
+                last_error = socket.error(err, os.strerror(err))
+                next_attempt = 0     # Don't wait for the delay when an attempt fails
+            if winner is not None:
+                break
+    finally:
+        for sock in pending:
+            sock.close()
+
+    if winner is None:
+        raise last_error or socket.error('No addresses to connect to')
+    winner.settimeout(timeout)
+    return winner
+
+
+def recv_exact(sock, size, timeout=None, expires=None):
+    '''
+    Reads exactly *size* bytes from *sock*, looping over short reads.
+    Every read waits for *timeout* seconds at most, and the whole operation
+    fails with DeadlineExceeded when the *expires* time (as returned by time.time()) is reached.
+    '''
+    chunks = []
+    received = 0
+    while received < size:
+        if expires is not None:
+            remaining = expires - time.time()
+            if remaining <= 0:
+                raise DeadlineExceeded('Deadline exceeded after receiving %d of %d bytes' % (received, size))
+            sock.settimeout(remaining if timeout is None else min(timeout, remaining))
+        try:
+            chunk = sock.recv(size - received)
+        except socket.timeout:
+            if expires is not None and time.time() >= expires:
+                raise DeadlineExceeded('Deadline exceeded after receiving %d of %d bytes' % (received, size))
+            raise
+        if not chunk:
+            raise socket.error(errno.ECONNRESET, 'Connection closed after receiving %d of %d bytes' % (received, size))
+        chunks.append(chunk)
+        received += len(chunk)
+    return ''.join(chunks)
+
+
+def read_at(fd, offset, size):
+    '''
+    Reads up to *size* bytes of the file *fd* at *offset*.
+    '''
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+def send_file(sock, fd, offset, count, timeout=None, expires=None):
+    '''
+    Sends *count* bytes of the file *fd* from *offset* to *sock*, with sendfile when available
+    (the data doesn't go through user space), or copying it by blocks.
+    Waits for *timeout* seconds at most when the socket is not writable, and fails with
+    DeadlineExceeded when the *expires* time (as returned by time.time()) is reached.
+    '''
+    if _sendfile is None or isinstance(sock, ssl.SSLSocket) or not isinstance(sock, _socket_class):   # TLS is done in user space
+        while count > 0:
+            block = read_at(fd, offset, min(count, FILE_BLOCK_SIZE))
+            if not block:
+                raise IOError('Unexpected end of file at offset %d' % offset)
+            if expires is not None:
+                remaining = expires - time.time()
+                if remaining <= 0:
+                    raise DeadlineExceeded('Deadline exceeded while sending the file')
+                sock.settimeout(remaining if timeout is None else min(timeout, remaining))
+            sock.sendall(block)
+            offset += len(block)
+            count -= len(block)
+        return
+    while count > 0:
+        try:
+            sent = _sendfile(sock.fileno(), fd, offset, count)
+        except (OSError, IOError), err:
+            if err.errno not in _IN_PROGRESS and err.errno != errno.EAGAIN:
+                raise
+            # The socket has a timeout, so it's non-blocking at the system level
+            wait = timeout
+            if expires is not None:
+                remaining = expires - time.time()
+                if remaining <= 0:
+                    raise DeadlineExceeded('Deadline exceeded while sending the file')
+                wait = remaining if wait is None else min(wait, remaining)
+            if not select.select([], [sock], [], wait)[1]:
+                raise socket.timeout('Timeout while sending the file')
+            continue
+        if not sent:
+            raise IOError('Unexpected end of file at offset %d' % offset)
+        offset += sent
+        count -= sent
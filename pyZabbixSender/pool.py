@@ -0,0 +1,41 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import multiprocessing
+from collections import deque
+
+class EncoderPool:
+    '''
+    Process pool running CPU bound work (encoding packets) in parallel, out of the GIL.
+
+    Jobs are submitted ahead, up to *window* jobs in flight, and results are returned
+    in order as they are consumed. This way the caller sends a packet while the next
+    ones are being encoded, and memory stays bounded whatever the number of jobs.
+    '''
+    def __init__(self, processes=None, window=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.window = window or 2 * self.processes
+        self._pool = None
+
+    def map(self, function, jobs):
+        '''
+        Yields the results of *function* (a module level function, so it can be pickled) applied to every job, in order.
+        '''
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        pending = deque()
+        for job in jobs:
+            pending.append(self._pool.apply_async(function, (job,)))
+            if len(pending) >= self.window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        '''
+        Stops the worker processes.
+        '''
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
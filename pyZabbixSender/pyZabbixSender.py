@@ -13,6 +13,7 @@ import sys
 import re
 
 from pyZabbixSenderBase import *
+from net import open_connection
 
 class pyZabbixSender(pyZabbixSenderBase):
     '''
@@ -26,43 +27,129 @@ class pyZabbixSender(pyZabbixSenderBase):
     RC_ERR_PARS_RESP =   2  # Error parsing server response
     RC_ERR_CONN      = 255  # Error talking to the server
     RC_ERR_INV_RESP  = 254  # Invalid response from server
+    RC_ERR_CIRCUIT   = 253  # Not sent, the circuit breaker is open
+    RC_ERR_DEADLINE  = 252  # The time given to the operation is over
 
-    def __send(self, mydata):
+    def __send(self, packet, expires=None, data_to_send=None, errors=None):
         '''
         This is the method that actually sends the data to the zabbix server.
+        The whole operation is limited by the *expires* time (as returned by time.time()) if given.
+        The packet is encoded unless it's given already framed in *data_to_send*.
+        The exception behind an RC_ERR_CONN result is appended to the *errors* list if given, to be classified.
+        '''
+        record = self._newRecord(packet)
+        result = self.__sendPacket(packet, expires, record, data_to_send, errors)
+        if record is not None:
+            if result[0] in (self.RC_OK, self.RC_ERR_FAIL_SEND):
+                self._finishRecord(record, result[1])
+            else:
+                self._finishRecord(record, error=result[1])
+        return result
+
+    def __sendPacket(self, packet, expires=None, record=None, data_to_send=None, errors=None):
+        '''
+        Sends the packet, measuring every phase in the *record* if given.
+        '''
+        if data_to_send is None:
+            data_to_send = frame(encode_packet(packet))
+        if record is not None:
+            record.mark('encode')
+            record.bytes_sent = len(data_to_send)
+        try:
+            self._checkCircuit(packet)
+            limiter = self._acquireLimiter(packet_size(packet), len(data_to_send), expires, record)
+        except CircuitOpen, err:
+            err_message = u'Not talking to server: %s\n' % str(err)
+            if self.verbose is True:
+                sys.stderr.write(err_message)
+            return self.RC_ERR_CIRCUIT, err_message
+        except DeadlineExceeded, err:
+            return self.RC_ERR_DEADLINE, u'%s\n' % str(err)
+        try:
+            return self.__talk(data_to_send, expires, record, errors)
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+    def __talk(self, data_to_send, expires=None, record=None, errors=None):
+        '''
+        Connects to the server, sends the framed data and parses the response.
         '''
-        socket.setdefaulttimeout(self.timeout)
-        data_length = len(mydata)
-        data_header = str(struct.pack('q', data_length))
-        data_to_send = 'ZBXD\1' + str(data_header) + str(mydata)
+        try:
+            connect_timeout, io_timeout = self._timeouts(expires)
+        except DeadlineExceeded, err:
+            self._abandonCircuit()
+            return self.RC_ERR_DEADLINE, u'%s\n' % str(err)
         try:
             if self.netproxy:
+                # The proxy resolves the server name itself
+                socket.setdefaulttimeout(connect_timeout)
 		if self.proxytype == 5:
                 	socks.set_default_proxy(socks.SOCKS5, self.netproxy, self.proxyport)
                 	socket.socket = socks.socksocket
 		else:
 			socks.set_default_proxy(socks.SOCKS4, self.netproxy, self.proxyport)
 			socket.socket = socks.socksocket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.zserver, self.zport))
-            sock.send(data_to_send)
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.connect((self.zserver, self.zport))
+            else:
+                cache = self._addressCache()
+                try:
+                    sock = open_connection(cache.resolve(), connect_timeout, self.tcp_nodelay, self.send_buffer_size)
+                except socket.error:
+                    cache.invalidate()
+                    raise
+            if self.tls is not None:
+                sock.settimeout(connect_timeout)
+                sock = self.tls.wrap(sock, self.zserver)
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.success()
+            if record is not None:
+                record.mark('connect')
+            sock.settimeout(io_timeout)
+            sock.sendall(data_to_send)
+            if record is not None:
+                record.mark('write')
         except Exception, err:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.failure()
             err_message = u'Error talking to server: %s\n' %str(err)
             sys.stderr.write(err_message)
+            if errors is not None:
+                errors.append(err)
             return self.RC_ERR_CONN, err_message
 
-        response_header = sock.recv(5)
-        if not response_header == 'ZBXD\1':
-            err_message = u'Invalid response from server [%s]. Malformed data?\n---\n%s\n---\n' % (repr(response_header),str(mydata))
-            sys.stderr.write(err_message)
-            return self.RC_ERR_INV_RESP, err_message
-
-        response_data_header = sock.recv(8)
-        response_data_header = response_data_header[:4]
-        response_len = struct.unpack('i', response_data_header)[0]
-        response_raw = sock.recv(response_len)
-        sock.close()
-        response = json.loads(response_raw)
+        try:
+            try:
+                on_header = (lambda: record.mark('wait')) if record is not None else None
+                response_raw = read_frame(sock, io_timeout, expires, on_header=on_header)
+                if self.tls is not None:
+                    self.tls.remember(sock)
+            except FrameError, err:
+                err_message = u'Invalid response from server [%s]. Malformed data?\n---\n%s\n---\n' % (str(err),data_to_send[HEADER_SIZE:])
+                sys.stderr.write(err_message)
+                return self.RC_ERR_INV_RESP, err_message
+            except DeadlineExceeded, err:
+                err_message = u'Error talking to server: %s\n' % str(err)
+                sys.stderr.write(err_message)
+                return self.RC_ERR_DEADLINE, err_message
+            except socket.timeout, err:
+                err_message = u'Error talking to server: %s\n' % str(err)
+                sys.stderr.write(err_message)
+                if errors is not None:
+                    errors.append(err)
+                return self.RC_ERR_CONN, err_message
+            except socket.error, err:
+                # The server closed the connection without a complete reply (like a trapper refusing the host)
+                err_message = u'Invalid response from server [%s]. Malformed data?\n---\n%s\n---\n' % (str(err),data_to_send[HEADER_SIZE:])
+                sys.stderr.write(err_message)
+                return self.RC_ERR_INV_RESP, err_message
+        finally:
+            sock.close()
+        response = jsoncodec.loads(response_raw)
+        if record is not None:
+            record.mark('parse')
+            record.bytes_received = HEADER_SIZE + len(response_raw)
         match = re.match('^.*failed.+?(\d+).*$', response['info'].lower() if 'info' in response else '')
         if match is None:
             err_message = u'Unable to parse server response - \n%s\n' % str(response)
@@ -72,12 +159,12 @@ class pyZabbixSender(pyZabbixSenderBase):
             fails = int(match.group(1))
             if fails > 0:
                 if self.verbose is True:
-                    err_message = u'Failures reported by zabbix when sending:\n%s\n' % str(mydata)
+                    err_message = u'Failures reported by zabbix when sending:\n%s\n' % data_to_send[HEADER_SIZE:]
                     sys.stderr.write(err_message)
                 return self.RC_ERR_FAIL_SEND, response
         return self.RC_OK, response
 
-    def sendData(self, packet_clock=None, max_data_per_conn=None):
+    def sendData(self, packet_clock=None, max_data_per_conn=None, deadline=None):
         '''
         #####Description:
         Sends data stored using *addData* method, to the Zabbix server.
@@ -98,36 +185,63 @@ class pyZabbixSender(pyZabbixSenderBase):
 
             If omitted, all data points will be sent in one single connection. *Default value: None*
 
+        * **deadline**: [in] [float] [optional] Limits the time of the whole operation, in seconds. When the time is over, the current "send" is interrupted
+          and the remaining ones are not performed, their return code is *RC_ERR_DEADLINE*. *Default value: None*
+
         Please note that **internal data is not deleted after *sendData* is executed**. You need to call *clearData* after sending it, if you want to remove currently stored data.
 
         #####Return:
         A list of *(return_code, msg_from_server)* associated to each "send" operation.
         '''
-        if not max_data_per_conn or max_data_per_conn > len(self._data):
-            max_data_per_conn = len(self._data)
-
+        self._prepareFlush()
+        expires = time.time() + deadline if deadline is not None else None
         responses = []
-        i = 0
-        while i*max_data_per_conn < len(self._data):
-
-            sender_data = {
-                "request": "sender data",
-                "data": [],
-            }
-            if packet_clock:
-                sender_data['clock'] = packet_clock
-
-            sender_data['data'] = self._data[i*max_data_per_conn:(i+1)*max_data_per_conn]
-            to_send = json.dumps(sender_data)
-
-            response = self.__send(to_send)
+        for sender_data, data_to_send in self._framedPackets(packet_clock, max_data_per_conn):
+            response = self.__send(sender_data, expires, data_to_send)
             responses.append(response)
-            i += 1
 
         return responses
 
 
-    def sendDataOneByOne(self):
+    def flushData(self, packet_clock=None, max_data_per_conn=None, deadline=None):
+        '''
+        #####Description:
+        Sends data stored using *addData* method like *sendData*, retrying the chunks which failed with a retryable error (see *useRetries*),
+        and removes the data sent from the internal data, so it drains chunk by chunk. The data of chunks still failing after the last retry
+        (or when the retry budget or the *deadline* is exhausted) is kept, to be sent by the next call. Chunks failed with a permanent error
+        (*RC_ERR_INV_RESP*, *RC_ERR_PARS_RESP*, or *RC_ERR_CONN* for errors like a certificate verification failure) are removed,
+        as sending them again won't help.
+
+        #####Parameters:
+        The same as *sendData*.
+
+        #####Return:
+        A list of *(return_code, msg_from_server)* associated to each chunk, like *sendData*, with the result of its last attempt.
+        '''
+        expires = time.time() + deadline if deadline is not None else None
+        policy = self._retryPolicy()
+        packets = self._takePackets(packet_clock, max_data_per_conn)
+        outcomes = {
+            self.RC_OK: DELIVERED,
+            self.RC_ERR_FAIL_SEND: DELIVERED,
+            self.RC_ERR_CONN: RETRY,
+            self.RC_ERR_CIRCUIT: EXPIRED,
+            self.RC_ERR_DEADLINE: EXPIRED,
+        }
+        def send(packet, expires, data_to_send):
+            errors = []
+            try:
+                result = self.__send(packet, expires, data_to_send, errors)
+            except Exception, err:
+                return policy.classify(err), (self.RC_ERR_CONN, u'Error talking to server: %s\n' % str(err))
+            if errors:
+                # RC_ERR_CONN covers refused connections as well as certificate or TLS setting errors
+                return policy.classify(errors[-1]), result
+            return outcomes.get(result[0], PERMANENT), result
+        return self._deliver(self._framedPackets(packets=packets), send, expires)
+
+
+    def sendDataOneByOne(self, deadline=None):
         '''
         #####Description:
         You can use this method to send all stored data, one by one, to determine which traps are not being handled correctly by the server.
@@ -139,17 +253,20 @@ class pyZabbixSender(pyZabbixSenderBase):
         This is primarily intended for debugging purposes.
 
         #####Parameters:
-        None
+        * **deadline**: [in] [float] [optional] Limits the time of the whole operation, in seconds, like in *sendData*. *Default value: None*
 
         #####Return:
         It returns an array of return codes (one for each individual "send") and the data sent: \[\[code\_1, data\_point\_1], \[code\_2, data\_point\_2\]\]
         '''
+        self._prepareFlush()
+        expires = time.time() + deadline if deadline is not None else None
         retarray = []
-        for i in self._data:
-            if 'clock' in i:
-                (retcode, retstring) = self.sendSingle(i['host'], i['key'], i['value'], i['clock'])
-            else:
-                (retcode, retstring) = self.sendSingle(i['host'], i['key'], i['value'])
+        for i in self._allData() + self._seriesDataPoints():
+            sender_data = {
+                "request": "sender data",
+                "data": [i],
+            }
+            (retcode, retstring) = self.__send(sender_data, expires)
 
             retarray.append((retcode, i))
         return retarray
@@ -182,8 +299,7 @@ class pyZabbixSender(pyZabbixSenderBase):
 
         obj = self._createDataPoint(host, key, value, clock)
         sender_data['data'].append(obj)
-        to_send = json.dumps(sender_data)
-        return self.__send(to_send)
+        return self.__send(sender_data)
 
 
     def sendSingleLikeProxy(self, host, key, value, clock=None, proxy=None):
@@ -219,8 +335,7 @@ class pyZabbixSender(pyZabbixSenderBase):
 
         obj = self._createDataPoint(host, key, value, clock)
         sender_data['data'].append(obj)
-        to_send = json.dumps(sender_data)
-        return self.__send(to_send)
+        return self.__send(sender_data)
 
 #####################################
 # --- Examples of usage ---
@@ -9,15 +9,29 @@ import struct
 import time
 import sys
 import re
+import threading
+import heapq
+from collections import deque
 
-# If you're using an old version of python that don't have json available,
-# you can use simplejson instead: https://simplejson.readthedocs.org/en/latest/
-try:
-    import json
-except ImportError:
-    import simplejson as json
+from net import AddressCache, DeadlineExceeded
+from framing import InvalidResponse, FrameError, FrameDecoder, HEADER_SIZE, MAX_FRAME, frame, framed_length, framed_offsets, read_frame
+from breaker import CircuitOpen, get_breaker
+from ratelimit import get_limiter
+from instrument import SendRecord, SendStats, LaneStats
+from selfmon import SelfMonitor
+from series import encode_series, tolist
+from pool import EncoderPool
+from tls import TLSConfig
+from retry import RetryPolicy, RetryBudget, DELIVERED, RETRY, EXPIRED, PERMANENT
 
-class InvalidResponse(Exception):
+# The fastest JSON library installed is used (simplejson if you're using an old version
+# of python that don't have json available), see jsoncodec.use_backend()
+import jsoncodec
+
+class BufferFull(Exception):
+    '''
+    Raised by *addData* when the internal data is full and no space was made before the timeout.
+    '''
     pass
 
 class pyZabbixSenderBase:
@@ -27,6 +41,17 @@ class pyZabbixSenderBase:
     ZABBIX_SERVER = "127.0.0.1"
     ZABBIX_PORT   = 10051
 
+    # Policies when the internal data is full, see setCapacity()
+    OVERFLOW_BLOCK         = 'block'
+    OVERFLOW_DROP_OLDEST   = 'drop_oldest'
+    OVERFLOW_DROP_NEWEST   = 'drop_newest'
+    OVERFLOW_DROP_PRIORITY = 'drop_priority'
+
+    # Priorities of the data points, see addData(). Any integer can be used, higher is more important.
+    PRIORITY_HIGH   = 1
+    PRIORITY_NORMAL = 0
+    PRIORITY_LOW    = -1
+
     def __init__(self, server=ZABBIX_SERVER, port=ZABBIX_PORT, proxytype=False, netproxy=False, proxyport=False, verbose=False):
         '''
         #####Description:
@@ -49,14 +74,505 @@ class pyZabbixSenderBase:
         self.proxyport = proxyport
         self.verbose = verbose
         self.timeout = 5         # Socket connection timeout.
-        self._data = []         # This is to store data to be sent later.
+        self.connect_timeout = None # Connection setup timeout. None uses "timeout".
+        self.io_timeout = None   # Timeout of every socket read or write. None uses "timeout".
+        self.resolve_ttl = 60    # Seconds to keep resolved server addresses. 0 resolves on every connection.
+        self.tcp_nodelay = True  # Disables Nagle's algorithm on sender sockets.
+        self.send_buffer_size = None # Socket send buffer size (SO_SNDBUF), None keeps the system default.
+        self._data = deque()    # This is to store data to be sent later (the lane of normal priority).
+        self._lanes = {self.PRIORITY_NORMAL: self._data}   # Data by priority, see addData()
+        self._lane_since = {}    # Time the first data point of every lane was added
+        self.lane_weights = {}   # See setLaneScheduling()
+        self.urgent_chunk_size = 100
+        self._series = []       # Arrays of data, see addDataArray()
+        self._series_count = 0
+        self._address_cache = None
+        self.circuit_breaker = None # See useCircuitBreaker()
+        self.on_circuit_open = None
+        self.rate_limiter = None # See useRateLimiter()
+        self._observers = []     # See addObserver()
+        self.self_monitor = None # See enableSelfMonitoring()
+        self.encoder_pool = None # See useProcessPool()
+        self.tls = None          # See useTLS()
+        self.retry_policy = None # See useRetries()
+        self.max_items = None    # Capacity of the internal data, see setCapacity()
+        self.max_bytes = None
+        self.overflow_policy = self.OVERFLOW_DROP_OLDEST
+        self.overflow_timeout = None
+        self.priority_of = None
+        self._bytes = 0
+        self._buckets = None     # Data points of every lane by their priority_of(), with OVERFLOW_DROP_PRIORITY
+        self._dropped_ids = set() # Data points dropped by priority still in their lane, see _dropLowest()
+        self._dead = {}          # Number of these data points by lane
+        self._space = None       # Condition signalled when space is made in the internal data
+        self._space_waiters = []
+        self._local = None       # Per-thread buffers, see enableConcurrentIngestion()
+        self._buffers = None
+        self._collect_lock = None
+        self.dropped = {
+            'oldest': 0,
+            'newest': 0,
+            'priority': 0,
+            'timeout': 0,
+        }
+        self.lane_dropped = {}   # Data points dropped by priority
 
 
     def __str__(self):
         '''
         This allows you to obtain a string representation of the internal data
         '''
-        return str(self._data)
+        self._collect()
+        return str(self._allData())
+
+
+    def _addressCache(self):
+        '''
+        Returns the address cache for the current server/port, recreating it if they were changed.
+        '''
+        cache = self._address_cache
+        if cache is None or cache.host != self.zserver or cache.port != self.zport:
+            cache = self._address_cache = AddressCache(self.zserver, self.zport, self.resolve_ttl)
+        cache.ttl = self.resolve_ttl
+        return cache
+
+
+    def useCircuitBreaker(self, failures=5, cooldown=30.0, on_open=None):
+        '''
+        #####Description:
+        Enables the circuit breaker for the server. After *failures* consecutive connection failures, sending fails immediately
+        (without waiting for the connection timeout) during *cooldown* seconds. Then a single connection is attempted to probe the server,
+        and sending is resumed if it succeeds.
+
+        The breaker is shared by all senders talking to the same server and port in the process.
+
+        #####Parameters:
+        * **failures**: [in] [integer] [optional] Number of consecutive connection failures opening the breaker. *Default value: 5*
+        * **cooldown**: [in] [float] [optional] Seconds to fail immediately before probing the server again. *Default value: 30.0*
+        * **on_open**: [in] [callable] [optional] Called with the packet (a dict with the "data" list) which could not be sent because the breaker is open,
+          for example to spool it. It's not called for the chunks of *flushData*, as their data is kept for its next call. *Default value: None*
+
+        #####Return:
+        The *CircuitBreaker* object. Its *getStats()* method returns the breaker state and transition counters for monitoring.
+        '''
+        self.circuit_breaker = get_breaker(self.zserver, self.zport, failures, cooldown)
+        self.on_circuit_open = on_open
+        return self.circuit_breaker
+
+
+    def useRateLimiter(self, items_per_second=None, bytes_per_second=None, connections_per_second=None, max_in_flight=None, name='default'):
+        '''
+        #####Description:
+        Paces sending to protect the Zabbix server from too many simultaneous connections. The limiter is shared by all
+        senders (of any flavour) using the same *name* in the process, so limits apply to all of them together.
+
+        #####Parameters:
+        * **items_per_second**: [in] [float] [optional] Maximum number of data points sent per second. *Default value: None (unlimited)*
+        * **bytes_per_second**: [in] [float] [optional] Maximum number of bytes sent per second. *Default value: None (unlimited)*
+        * **connections_per_second**: [in] [float] [optional] Maximum number of connections opened per second. *Default value: None (unlimited)*
+        * **max_in_flight**: [in] [integer] [optional] Maximum number of connections open at the same time. *Default value: None (unlimited)*
+        * **name**: [in] [string] [optional] Name of the shared limiter. *Default value: "default"*
+
+        If no limit is given, the shared limiter is used with the limits it already has.
+
+        #####Return:
+        The *RateLimiter* object. Its *getStats()* method returns counters for monitoring.
+        '''
+        limiter = get_limiter(name)
+        if items_per_second or bytes_per_second or connections_per_second or max_in_flight:
+            limiter.configure(items_per_second, bytes_per_second, connections_per_second, max_in_flight)
+        self.rate_limiter = limiter
+        return limiter
+
+
+    def useProcessPool(self, processes=None, window=None):
+        '''
+        #####Description:
+        Encodes packets in a pool of worker processes when sending data, to use several cores for huge batches (the GIL prevents doing it with threads).
+        Chunks are passed to the workers in a compact form, and come back as framed packets ready to be sent. While a packet is being sent,
+        the next ones are being encoded.
+
+        It's useful with *max_data_per_conn*, when there are many chunks to send. The asynchronous sender (txZabbixSender) doesn't use the pool.
+
+        #####Parameters:
+        * **processes**: [in] [integer] [optional] Number of worker processes. *Default value: number of cores*
+        * **window**: [in] [integer] [optional] Maximum number of chunks being encoded ahead of the one sent. *Default value: 2 * processes*
+
+        #####Return:
+        The *EncoderPool* object. Workers are started on the first send, and stopped by *stopProcessPool*.
+        '''
+        self.stopProcessPool()
+        self.encoder_pool = EncoderPool(processes, window)
+        return self.encoder_pool
+
+
+    def stopProcessPool(self):
+        '''
+        #####Description:
+        Stops the worker processes started by *useProcessPool*, and goes back to encoding packets in the sending thread.
+
+        #####Parameters:
+        None
+
+        #####Return:
+        None
+        '''
+        if self.encoder_pool is not None:
+            self.encoder_pool.close()
+            self.encoder_pool = None
+
+
+    def useTLS(self, ca_file=None, cert_file=None, key_file=None, psk_identity=None, psk=None, server_hostname=None, check_hostname=False, ciphers=None, session_reuse=True):
+        '''
+        #####Description:
+        Encrypts the connections to the server with TLS, authenticated by a certificate or by a pre-shared key (PSK), like the Zabbix
+        agent *TLSConnect* setting.
+
+        With a certificate, connections use pyOpenSSL when it's installed, and the TLS session is resumed by the next connections, so every
+        chunk doesn't do a full handshake (the ssl module of Python 2 can't resume sessions). PSK works only with the blocking senders
+        (syZabbixSender and pyZabbixSender), through the *sslpsk* package, and without session resumption. txZabbixSender needs pyOpenSSL
+        and supports certificates only.
+
+        #####Parameters:
+        * **ca_file**: [in] [string] [optional] CA certificates to verify the server certificate (*TLSCAFile*). *Default value: the system CAs*
+        * **cert_file**: [in] [string] [optional] Certificate of the sender (*TLSCertFile*), if the server requires it. *Default value: None*
+        * **key_file**: [in] [string] [optional] Private key of the certificate (*TLSKeyFile*). *Default value: None*
+        * **psk_identity**: [in] [string] [optional] PSK identity (*TLSPSKIdentity*). *Default value: None*
+        * **psk**: [in] [string] [optional] The pre-shared key, in hexadecimal like in the *TLSPSKFile*. *Default value: None*
+        * **server_hostname**: [in] [string] [optional] Name sent to the server (SNI) and checked in its certificate. *Default value: the server name*
+        * **check_hostname**: [in] [boolean] [optional] Checks that the server certificate matches the server name. *Default value: False*
+        * **ciphers**: [in] [string] [optional] OpenSSL cipher list. *Default value: None (OpenSSL defaults, or PSK ciphers)*
+        * **session_reuse**: [in] [boolean] [optional] Resumes TLS sessions (with a certificate and pyOpenSSL). *Default value: True*
+
+        #####Return:
+        The *TLSConfig* object. Its *getStats()* method returns the numbers of full handshakes and resumed sessions.
+        '''
+        self.tls = TLSConfig(ca_file, cert_file, key_file, psk_identity, psk, server_hostname, check_hostname, ciphers, session_reuse)
+        return self.tls
+
+
+    def useRetries(self, attempts=5, backoff=0.5, max_backoff=30.0, budget_ratio=0.2, budget_minimum=10):
+        '''
+        #####Description:
+        Sets how *flushData* retries the chunks which failed with a retryable error (connection refused or reset, timeouts).
+        Chunks failed with a permanent error (like a malformed response) are not retried. While the circuit breaker is open, chunks are
+        not retried either: their data is kept for the next call, like when the deadline is exceeded.
+
+        Retries wait an exponential backoff with jitter: the *n*-th retry of a chunk waits a random time between 0 and *backoff* * 2^(n - 1) seconds,
+        at most *max_backoff*. To avoid flooding a failing server, retries are limited by a budget: *budget_ratio* retries per chunk sent
+        for the first time, plus *budget_minimum* retries. The budget is shared by all the calls to *flushData*.
+
+        #####Parameters:
+        * **attempts**: [in] [integer] [optional] Maximum number of times a chunk is sent. *Default value: 5*
+        * **backoff**: [in] [float] [optional] Maximum wait before the first retry, in seconds. *Default value: 0.5*
+        * **max_backoff**: [in] [float] [optional] Maximum wait before any retry, in seconds. *Default value: 30.0*
+        * **budget_ratio**: [in] [float] [optional] Retries allowed per chunk sent. *Default value: 0.2*
+        * **budget_minimum**: [in] [integer] [optional] Retries allowed besides the ratio. *Default value: 10*
+
+        #####Return:
+        The *RetryPolicy* object. Its *getStats()* method returns the numbers of retries, of chunks given up, and of permanent failures.
+        '''
+        self.retry_policy = RetryPolicy(attempts, backoff, max_backoff, RetryBudget(budget_ratio, budget_minimum))
+        return self.retry_policy
+
+
+    def _retryPolicy(self):
+        if self.retry_policy is None:
+            self.useRetries()
+        return self.retry_policy
+
+
+    def _takePackets(self, packet_clock=None, max_data_per_conn=None):
+        '''
+        Returns the packets to send all the stored data, and removes it from the internal data: packets not delivered
+        are put back with *_requeue*. With concurrent ingestion, the buffers are not drained by other threads meanwhile,
+        so data added by other threads is kept. The packets are marked as *kept*, so they are not passed to the on_circuit_open callback.
+        '''
+        if self._collect_lock is not None:
+            self._collect_lock.acquire()
+        try:
+            self._prepareFlush()
+            packets = list(self._packets(packet_clock, max_data_per_conn))
+            self.clearData()
+        finally:
+            if self._collect_lock is not None:
+                self._collect_lock.release()
+        for packet in packets:
+            packet.kept = True
+        return packets
+
+
+    def _requeue(self, packets):
+        '''
+        Puts the data of the *packets* back in the internal data, before the data added meanwhile.
+        '''
+        for packet in reversed(packets):
+            priority = getattr(packet, 'priority', self.PRIORITY_NORMAL)
+            data = packet.get('data') or []
+            if data:
+                self._lane(priority).extendleft(reversed(data))
+                if self._buckets is not None:
+                    for obj in reversed(data):
+                        self._bucket(priority, obj).appendleft(obj)
+                if self._space is not None:
+                    self._bytes += sum([self._sizeOf(obj) for obj in data])
+            series = getattr(packet, 'series', None)
+            if series:
+                self._series[:0] = series
+                self._series_count += packet.series_count
+            enqueued = getattr(packet, 'enqueued', None)
+            if enqueued is not None and (data or series):
+                self._lane_since[priority] = min(enqueued, self._lane_since.get(priority, enqueued))
+
+
+    def _deliver(self, packets, send, expires=None):
+        '''
+        Sends the packets (*(packet, data_to_send)* pairs) with *send(packet, expires, data_to_send)*, which returns
+        the outcome (DELIVERED, RETRY, EXPIRED or PERMANENT) and the result. Retries are scheduled according to the retry policy,
+        and run as soon as they are due, between the first attempts of the next packets.
+
+        Returns the list of results, in the order of the packets. The data of the packets not delivered because of retryable errors
+        is put back in the internal data.
+        '''
+        policy = self._retryPolicy()
+        results = []
+        waiting = []        # Heap of (due, index, attempts, packet, data_to_send)
+        undelivered = []
+
+        def attempt(index, attempts, packet, data_to_send):
+            outcome, result = send(packet, expires, data_to_send)
+            if outcome == RETRY:
+                due = time.time() + policy.delay(attempts)
+                if (expires is None or due < expires) and policy.retry(attempts):
+                    if self.self_monitor is not None:
+                        self.self_monitor.retry()
+                    heapq.heappush(waiting, (due, index, attempts + 1, packet, data_to_send))
+                    return
+                undelivered.append((index, packet))
+            elif outcome == EXPIRED:
+                undelivered.append((index, packet))
+            elif outcome == PERMANENT:
+                policy.failed()
+            results[index] = result
+
+        def retryDue():
+            while waiting and waiting[0][0] <= time.time():
+                due, index, attempts, packet, data_to_send = heapq.heappop(waiting)
+                attempt(index, attempts, packet, data_to_send)
+
+        for packet, data_to_send in packets:
+            policy.budget.deposit()
+            retryDue()
+            results.append(None)
+            attempt(len(results) - 1, 1, packet, data_to_send)
+        while waiting:
+            delay = waiting[0][0] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            retryDue()
+        undelivered.sort()
+        self._requeue([packet for index, packet in undelivered])
+        return results
+
+
+    def addObserver(self, observer):
+        '''
+        #####Description:
+        Registers a callable to be called after every "send" operation (one packet, one connection), with a *SendRecord* object describing it:
+        * time spent in each phase: *throttle* (waiting for the rate limiter), *encode*, *connect*, *write*, *wait* (for the reply) and *parse*, in seconds
+        * *duration* of the whole operation
+        * *items* sent, *bytes_sent* and *bytes_received* on the wire
+        * *processed*, *failed* and *seconds_spent* as reported by the server
+        * *error*, the exception if the operation failed
+
+        Timings are only measured while some observer is registered.
+
+        #####Parameters:
+        * **observer**: [in] [callable] [mandatory] The callable receiving *SendRecord* objects. It should be fast, as it's called in the sending path.
+
+        #####Return:
+        None
+        '''
+        self._observers = self._observers + [observer]
+
+
+    def removeObserver(self, observer):
+        '''
+        #####Description:
+        Unregisters an observer registered with *addObserver*.
+
+        #####Parameters:
+        * **observer**: [in] [callable] [mandatory] The callable to unregister.
+
+        #####Return:
+        None
+        '''
+        self._observers = [o for o in self._observers if o is not observer]
+
+
+    def enableStats(self):
+        '''
+        #####Description:
+        Registers a *SendStats* observer, accumulating counters and time spent in every phase over all "send" operations.
+
+        #####Parameters:
+        None
+
+        #####Return:
+        The *SendStats* object. Its *getStats()* method returns a dict with the accumulated values.
+        '''
+        stats = SendStats()
+        self.addObserver(stats)
+        return stats
+
+
+    def enableLaneStats(self):
+        '''
+        #####Description:
+        Registers a *LaneStats* observer, accumulating the statistics of the "sends" of every priority lane (see *addData*), including
+        the latency of the data: the time since the first data point of the lane was added until the "send" completed.
+
+        #####Parameters:
+        None
+
+        #####Return:
+        The *LaneStats* object. Its *getStats()* method returns a dict of counters and latencies by priority.
+        '''
+        stats = LaneStats()
+        self.addObserver(stats)
+        return stats
+
+
+    def enableSelfMonitoring(self, host, interval=60, prefix='pyzabbixsender'):
+        '''
+        #####Description:
+        Makes the sender publish its own health metrics as data points, so they can be trended in Zabbix next to everything else.
+        Running counters are kept by an observer (see *addObserver*), and every *interval* seconds they are added to the
+        internal data when one of the *sendData* methods is called, so they are sent with the rest of the data.
+
+        The following keys are published (with the *prefix*): *sends*, *send_errors*, *items_sent*, *items_failed*, *bytes_sent*, *retries*
+        (cumulative counters), *queue_depth* (number of data points stored), and *latency_avg*, *latency_p50*, *latency_p99*, *latency_max*
+        (seconds per send, since the previous report). You need to define them as trapper items of the *host* in the Zabbix server.
+
+        #####Parameters:
+        * **host**: [in] [string] [mandatory] The host which the metrics are associated to.
+        * **interval**: [in] [float] [optional] Minimum number of seconds between reports. *Default value: 60*
+        * **prefix**: [in] [string] [optional] Prefix of the keys. *Default value: "pyzabbixsender"*
+
+        #####Return:
+        The *SelfMonitor* object.
+        '''
+        if self.self_monitor is not None:
+            self.removeObserver(self.self_monitor)
+        self.self_monitor = SelfMonitor(host, interval, prefix)
+        self.addObserver(self.self_monitor)
+        return self.self_monitor
+
+
+    def _injectSelfMonitoring(self):
+        '''
+        Adds the self-monitoring data points to the internal data, if it's time to report them.
+        '''
+        monitor = self.self_monitor
+        if monitor is None or not monitor.due():
+            return
+        clock = int(time.time())
+        for key, value in monitor.report(self._dataCount()):
+            self.addData(monitor.host, key, value, clock)
+
+
+    def _newRecord(self, packet):
+        '''
+        Returns a SendRecord to measure sending the packet, or None if nobody observes.
+        '''
+        if not self._observers:
+            return None
+        return SendRecord(packet_size(packet), getattr(packet, 'priority', None), getattr(packet, 'enqueued', None))
+
+
+    def _finishRecord(self, record, response=None, error=None):
+        '''
+        Completes the record with the server response or the error, and passes it to the observers.
+        '''
+        record.finish()
+        record.error = error
+        info = response.get('info') if isinstance(response, dict) else None
+        if isinstance(info, dict):
+            record.processed = info.get('processed')
+            record.failed = info.get('failed')
+            record.seconds_spent = info.get('seconds spent')
+        elif isinstance(info, basestring):
+            info = info.lower()
+            processed = PROCESSED_COUNTER.match(info)
+            failed = FAILED_COUNTER.match(info)
+            seconds_spent = SECONDS_SPENT.match(info)
+            record.processed = processed and int(processed.group(1))
+            record.failed = failed and int(failed.group(1))
+            record.seconds_spent = seconds_spent and float(seconds_spent.group(1))
+        for observer in self._observers:
+            try:
+                observer(record)
+            except Exception, ex:
+                if self.verbose is True:
+                    sys.stderr.write(u'Observer %r failed: %s\n' % (observer, ex))
+
+
+    def _timeouts(self, expires=None):
+        '''
+        Returns the (connect_timeout, io_timeout) pair, shortened to not go beyond
+        the *expires* time (as returned by time.time()).
+        Raises DeadlineExceeded if the time is already over.
+        '''
+        connect_timeout = self.connect_timeout if self.connect_timeout is not None else self.timeout
+        io_timeout = self.io_timeout if self.io_timeout is not None else self.timeout
+        if expires is not None:
+            remaining = expires - time.time()
+            if remaining <= 0:
+                raise DeadlineExceeded('Deadline exceeded, data has not been sent')
+            if connect_timeout is None or connect_timeout > remaining:
+                connect_timeout = remaining
+            if io_timeout is None or io_timeout > remaining:
+                io_timeout = remaining
+        return connect_timeout, io_timeout
+
+
+    def _checkCircuit(self, packet):
+        '''
+        Raises CircuitOpen if the circuit breaker doesn't allow to connect now.
+        The packet is passed to the on_circuit_open callback before, unless its data is *kept* by the sender.
+        '''
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            if self.on_circuit_open is not None and not getattr(packet, 'kept', False):
+                self.on_circuit_open(packet)
+            raise CircuitOpen('Circuit breaker for %s:%s is open' % (self.zserver, self.zport))
+
+
+    def _acquireLimiter(self, items, nbytes, expires=None, record=None):
+        '''
+        Waits for the rate limiter, if used, after *_checkCircuit*: when the limiter raises DeadlineExceeded,
+        the probe let through by the circuit breaker is released. Returns the limiter to release, or None.
+        '''
+        limiter = self.rate_limiter
+        if limiter is None:
+            return None
+        try:
+            limiter.acquire(items, nbytes, expires)
+        except Exception:
+            self._abandonCircuit()
+            raise
+        if record is not None:
+            record.mark('throttle')
+        return limiter
+
+
+    def _abandonCircuit(self):
+        '''
+        Releases the probe let through by *_checkCircuit* when the connection is not attempted, as neither
+        its success nor its failure will be recorded.
+        '''
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.abandon()
 
 
     def _createDataPoint(self, host, key, value, clock=None):
@@ -72,7 +588,7 @@ class pyZabbixSenderBase:
             obj['clock'] = clock
         return obj
 
-    def addData(self, host, key, value, clock=None):
+    def addData(self, host, key, value, clock=None, priority=PRIORITY_NORMAL):
         '''
         #####Description:
         Adds host, key, value and optionally clock to the internal list of data to be sent later, when calling one of the methods to actually send the data to the server.
@@ -88,11 +604,580 @@ class pyZabbixSenderBase:
 
             *Default value: None*
 
+        * **priority**: [in] [integer] [optional] The lane of the data point. Lanes above PRIORITY_NORMAL (like heartbeats and availability items)
+          are sent first when sending data, in their own small chunks, and data of lower lanes is dropped first when the internal data is full.
+          See *setLaneScheduling*. *Default value: PRIORITY_NORMAL*
+
         #####Return:
-        This method doesn't have a return.
+        It returns True if the data point was stored, and False if it was dropped because the internal data is full (see *setCapacity*).
         '''
         obj = self._createDataPoint(host, key, value, clock)
-        self._data.append(obj)
+        if self._local is not None:
+            if priority == self.PRIORITY_NORMAL:
+                buf = getattr(self._local, 'buffer', None)
+            else:
+                buf = getattr(self._local, 'lanes', {}).get(priority)
+            if buf is None:
+                buf = self._newThreadBuffer(priority)
+            buf.append(obj)
+            return True
+        if self._space is None:
+            lane = self._lanes.get(priority)
+            if not lane:
+                lane = self._lane(priority)
+            lane.append(obj)
+            return True
+        return self._addBounded(obj, priority)
+
+
+    def _lane(self, priority):
+        '''
+        Returns the list of data points of the *priority* lane, noting when its first data point is added.
+        '''
+        lane = self._lanes.get(priority)
+        if lane is None:
+            lane = self._lanes[priority] = deque()
+        if priority not in self._lane_since:
+            self._lane_since[priority] = time.time()
+        return lane
+
+
+    def _priorities(self):
+        '''
+        Returns the priorities of the lanes holding data, highest first.
+        '''
+        dead = self._dead
+        return sorted([priority for priority, lane in self._lanes.items() if len(lane) > dead.get(priority, 0)], reverse=True)
+
+
+    def _allData(self):
+        '''
+        Returns the data points of all the lanes, highest priority first (without data series).
+        '''
+        self._purgeDropped()
+        if len(self._lanes) == 1:
+            return list(self._data)
+        result = []
+        for priority in self._priorities():
+            result.extend(self._lanes[priority])
+        return result
+
+
+    def setLaneScheduling(self, weights=None, urgent_chunk_size=100):
+        '''
+        #####Description:
+        Sets how the priority lanes (see *addData*) share the "sends" when sending data:
+        * Lanes above PRIORITY_NORMAL are sent first, highest first, in chunks of at most *urgent_chunk_size* data points,
+          so they don't wait behind a backlog of bulk data.
+        * Then the other lanes take turns: every turn, each lane sends as many chunks as its weight, so lower lanes are not starved.
+          Data series (see *addDataArray*) belong to the lane of normal priority.
+
+        #####Parameters:
+        * **weights**: [in] [dict] [optional] Chunks sent per turn by every priority. *Default value: None (1 for every lane)*
+        * **urgent_chunk_size**: [in] [integer] [optional] Maximum data points per "send" of the lanes above PRIORITY_NORMAL,
+          also limited by *max_data_per_conn*. *Default value: 100*
+
+        #####Return:
+        None
+        '''
+        self.lane_weights = dict(weights or {})
+        self.urgent_chunk_size = urgent_chunk_size
+
+
+    def addDataArray(self, host, key, values, clocks=None):
+        '''
+        #####Description:
+        Adds a whole series of values of one host and key, to be sent later like the data added by *addData*. This is much faster than
+        calling *addData* for every value: arrays are stored as they are, and encoded in batches when the data is sent.
+
+        Arrays are kept by reference, so they must not be modified until the data is sent and cleared.
+        Series are not limited by *setCapacity*, and *addDataArray* should be called from the thread sending data when
+        *enableConcurrentIngestion* is used.
+
+        #####Parameters:
+        * **host**: [in] [string] [mandatory] The host which the data is associated to.
+        * **key**: [in] [string] [mandatory] The name of the trap associated to the host in the Zabbix server.
+        * **values**: [in] [array] [mandatory] The values, as a NumPy array, an array.array, or any sequence. NumPy is not needed to use this method.
+        * **clocks**: [in] [array] [optional] The Unix timestamps of the values, an array of the same length as *values*. If omitted, values are sent without clock,
+          like with *addData*. *Default value: None*
+
+        #####Return:
+        The number of data points added.
+        '''
+        count = len(values)
+        if clocks is not None and len(clocks) != count:
+            raise ValueError('values and clocks must have the same length')
+        if count:
+            self._series.append((host, key, values, clocks))
+            self._series_count += count
+            if self.PRIORITY_NORMAL not in self._lane_since:
+                self._lane_since[self.PRIORITY_NORMAL] = time.time()
+        return count
+
+
+    def addDataArrays(self, host, series, clocks=None):
+        '''
+        #####Description:
+        Adds the series of several keys of one host at once, see *addDataArray*.
+
+        #####Parameters:
+        * **host**: [in] [string] [mandatory] The host which the data is associated to.
+        * **series**: [in] [dict] [mandatory] The values of every key: a dict, or a list of *(key, values)* pairs.
+        * **clocks**: [in] [array] [optional] The Unix timestamps shared by all the series. *Default value: None*
+
+        #####Return:
+        The number of data points added.
+        '''
+        if isinstance(series, dict):
+            series = series.items()
+        count = 0
+        for key, values in series:
+            count += self.addDataArray(host, key, values, clocks)
+        return count
+
+
+    def enableConcurrentIngestion(self):
+        '''
+        #####Description:
+        Makes *addData* safe and scalable when called from many threads at the same time. Every thread appends data to its own buffer,
+        without locking. Buffers are drained together into the internal data when it's needed: when sending, or calling *getData*, *printData*,
+        *removeDataPoint* or *getDropStats*.
+
+        Use *flushData* to send the data in this mode: it takes the drained data and removes it at once, so data added by other threads
+        while sending is kept for the next call, without losing or duplicating anything. With *sendData* followed by *clearData*,
+        data drained in between (when another thread calls one of the methods above) would be removed without being sent.
+
+        When the capacity is limited (see *setCapacity*), it's applied when buffers are drained. The OVERFLOW_BLOCK policy can't be used in this mode.
+
+        #####Parameters:
+        None
+
+        #####Return:
+        None
+        '''
+        if self.overflow_policy == self.OVERFLOW_BLOCK and self._space is not None:
+            raise ValueError('OVERFLOW_BLOCK policy can not be used with concurrent ingestion')
+        if self._local is None:
+            self._buffers = []
+            self._collect_lock = threading.RLock()   # Held by _takePackets while it calls _collect and clearData
+            self._local = threading.local()
+
+
+    def _newThreadBuffer(self, priority=PRIORITY_NORMAL):
+        '''
+        Creates and registers the buffer of the current thread for the *priority* lane.
+        '''
+        buf = []
+        if priority == self.PRIORITY_NORMAL:
+            self._local.buffer = buf
+        else:
+            lanes = getattr(self._local, 'lanes', None)
+            if lanes is None:
+                lanes = self._local.lanes = {}
+            lanes[priority] = buf
+        self._collect_lock.acquire()
+        try:
+            self._buffers.append((threading.currentThread(), priority, buf))
+        finally:
+            self._collect_lock.release()
+        return buf
+
+
+    def _collect(self):
+        '''
+        Drains per-thread buffers into the internal data.
+        '''
+        if self._local is None:
+            return
+        self._collect_lock.acquire()
+        try:
+            alive = []
+            for thread, priority, buf in self._buffers:
+                # The owner thread may only append to the buffer meanwhile,
+                # so the items copied are exactly the items deleted.
+                n = len(buf)
+                if n:
+                    items = buf[:n]
+                    del buf[:n]
+                    if self._space is None:
+                        self._lane(priority).extend(items)
+                    else:
+                        for obj in items:
+                            self._addBounded(obj, priority)
+                if n or thread.isAlive():
+                    alive.append((thread, priority, buf))
+            self._buffers = alive
+        finally:
+            self._collect_lock.release()
+
+
+    def _prepareFlush(self):
+        '''
+        Prepares the internal data to be sent.
+        '''
+        self._collect()
+        self._injectSelfMonitoring()
+
+
+    def _dataCount(self):
+        '''
+        Returns the number of data points stored, including data series.
+        '''
+        return self._itemCount() + self._series_count
+
+
+    def _itemCount(self):
+        '''
+        Returns the number of data points stored in the lanes.
+        '''
+        dead = sum(self._dead.values()) if self._dead else 0
+        if len(self._lanes) == 1:
+            return len(self._data) - dead
+        return sum(map(len, self._lanes.values())) - dead
+
+
+    def _seriesDataPoints(self):
+        '''
+        Returns the data points of the data series, as dictionaries.
+        '''
+        result = []
+        for host, key, values, clocks in self._series:
+            values = tolist(values)
+            if clocks is None:
+                clocks = [None] * len(values)
+            else:
+                clocks = map(int, tolist(clocks))
+            for value, clock in zip(values, clocks):
+                result.append(self._createDataPoint(host, key, value, clock))
+        return result
+
+
+    def _packets(self, packet_clock=None, max_data_per_conn=None):
+        '''
+        Yields the "sender data" packets to send all the stored data, with up to *max_data_per_conn* data points each.
+        Lanes are scheduled as described in *setLaneScheduling*, and every packet holds data of a single lane.
+        '''
+        self._purgeDropped()
+        total = self._dataCount()
+        if not max_data_per_conn or max_data_per_conn > total:
+            max_data_per_conn = total
+        priorities = self._priorities()
+        if self._series and self.PRIORITY_NORMAL not in priorities:
+            priorities = sorted(priorities + [self.PRIORITY_NORMAL], reverse=True)
+        turns = []
+        for priority in priorities:
+            if priority > self.PRIORITY_NORMAL:
+                size = min(self.urgent_chunk_size or max_data_per_conn, max_data_per_conn)
+                for packet in self._lanePackets(priority, packet_clock, size):
+                    yield packet
+            else:
+                turns.append((self.lane_weights.get(priority, 1), self._lanePackets(priority, packet_clock, max_data_per_conn)))
+        while turns:
+            pending = []
+            for weight, packets in turns:
+                for i in xrange(max(1, weight)):
+                    packet = next(packets, None)
+                    if packet is None:
+                        break
+                    yield packet
+                else:
+                    pending.append((weight, packets))
+            turns = pending
+
+
+    def _lanePackets(self, priority, packet_clock, max_data_per_conn):
+        '''
+        Yields the packets of a lane. Slices of data series are attached to the packets of the normal lane,
+        to be encoded when the packet is.
+        '''
+        data = list(self._lanes.get(priority, ()))
+        series = self._series[:] if priority == self.PRIORITY_NORMAL else []
+        enqueued = self._lane_since.get(priority)
+        pos = 0
+        segment = 0
+        offset = 0
+        while pos < len(data) or segment < len(series):
+            packet = SenderPacket()
+            packet.priority = priority
+            packet.enqueued = enqueued
+            packet['request'] = 'sender data'
+            if packet_clock:
+                packet['clock'] = packet_clock
+            packet['data'] = data[pos:pos + max_data_per_conn]
+            pos += max_data_per_conn
+            room = max_data_per_conn - len(packet['data'])
+            while room and segment < len(series):
+                host, key, values, clocks = series[segment]
+                end = min(len(values), offset + room)
+                packet.series.append((host, key, values[offset:end], clocks[offset:end] if clocks is not None else None))
+                packet.series_count += end - offset
+                room -= end - offset
+                if end == len(values):
+                    segment += 1
+                    offset = 0
+                else:
+                    offset = end
+            yield packet
+
+
+    def _framedPackets(self, packet_clock=None, max_data_per_conn=None, packets=None):
+        '''
+        Yields *(packet, data)* pairs for the packets returned by *_packets* (or the *packets* given), where *data* is the framed packet
+        encoded by the process pool, or None if there is no pool and the sender has to encode it.
+        '''
+        if packets is None:
+            packets = self._packets(packet_clock, max_data_per_conn)
+        if self.encoder_pool is None:
+            for packet in packets:
+                yield packet, None
+            return
+        submitted = deque()
+        def jobs():
+            for packet in packets:
+                submitted.append(packet)
+                yield pack_chunk(packet)
+        for data in self.encoder_pool.map(encode_chunk, jobs()):
+            yield submitted.popleft(), data
+
+
+    def setCapacity(self, max_items=None, max_bytes=None, policy=OVERFLOW_DROP_OLDEST, timeout=None, priority=None):
+        '''
+        #####Description:
+        Limits the internal data, so memory stays bounded when data can't be sent (for example, during a server outage).
+        When adding data to the full storage, one of the following policies is applied:
+        * **OVERFLOW_BLOCK**: *addData* waits until some data is removed (by *clearData* or *removeDataPoint*, usually from another thread),
+          and raises *BufferFull* if it doesn't happen before the *timeout*.
+        * **OVERFLOW_DROP_OLDEST**: the oldest data points are dropped.
+        * **OVERFLOW_DROP_NEWEST**: the data point being added is dropped.
+        * **OVERFLOW_DROP_PRIORITY**: data points with the lowest *priority* are dropped (the oldest ones first). If the data point being added has the lowest priority, it is dropped.
+
+        Dropped data points are counted, see *getDropStats*.
+
+        #####Parameters:
+        * **max_items**: [in] [integer] [optional] Maximum number of data points stored. *Default value: None (unlimited)*
+        * **max_bytes**: [in] [integer] [optional] Maximum size of the data points stored, estimated as the size of their JSON form. *Default value: None (unlimited)*
+        * **policy**: [in] [string] [optional] One of the OVERFLOW_* policies described above. *Default value: OVERFLOW_DROP_OLDEST*
+        * **timeout**: [in] [float] [optional] Maximum seconds to wait with the OVERFLOW_BLOCK policy. *Default value: None (wait forever)*
+        * **priority**: [in] [callable] [optional] Function returning the priority (a number, higher is more important) of a data point, for the OVERFLOW_DROP_PRIORITY policy. *Default value: None (all data points are equal)*
+
+        If neither *max_items* nor *max_bytes* are specified, the capacity is unlimited.
+
+        #####Return:
+        None
+        '''
+        if policy == self.OVERFLOW_BLOCK and self._local is not None and (max_items or max_bytes):
+            raise ValueError('OVERFLOW_BLOCK policy can not be used with concurrent ingestion')
+        self._purgeDropped()
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.overflow_policy = policy
+        self.overflow_timeout = timeout
+        self.priority_of = priority
+        if max_items or max_bytes:
+            if self._space is None:
+                self._space = threading.Condition()
+            self._bytes = sum([self._sizeOf(obj) for obj in self._allData()])
+            self._buckets = None
+            if policy == self.OVERFLOW_DROP_PRIORITY and priority is not None:
+                self._buckets = {}
+                for lane_priority, lane in self._lanes.items():
+                    for obj in lane:
+                        self._bucket(lane_priority, obj).append(obj)
+        else:
+            self._space = None
+            self._buckets = None
+            self._freeSpace()
+
+
+    def getDropStats(self):
+        '''
+        #####Description:
+        Returns counters about the internal data capacity.
+
+        #####Parameters:
+        None
+
+        #####Return:
+        A dict with the number of data points dropped by each policy (*oldest*, *newest*, *priority*), the number of *addData* calls
+        which timed out waiting for space (*timeout*), the current number of data points (*items*) and their estimated size (*bytes*),
+        and the number of data points stored and dropped by priority (*lanes*, a dict of dicts with *items* and *dropped*).
+        '''
+        self._collect()
+        self._purgeDropped()
+        stats = self.dropped.copy()
+        stats['items'] = self._itemCount()
+        stats['bytes'] = self._bytes
+        lanes = {}
+        for priority in set(self._lanes.keys()) | set(self.lane_dropped.keys()):
+            lanes[priority] = {
+                'items': len(self._lanes.get(priority, ())),
+                'dropped': self.lane_dropped.get(priority, 0),
+            }
+        stats['lanes'] = lanes
+        return stats
+
+
+    def _sizeOf(self, obj):
+        '''
+        Estimates the size of the data point in the packet. Text values are measured as they are
+        (unicode values in characters), so they are not encoded.
+        '''
+        value = obj['value']
+        if not isinstance(value, basestring):
+            value = str(value)
+        return 40 + len(obj['host']) + len(obj['key']) + len(value)
+
+
+    def _full(self, size):
+        return (self.max_items and self._itemCount() >= self.max_items) or \
+            (self.max_bytes and self._bytes + size > self.max_bytes)
+
+
+    def _bucket(self, lane_priority, obj):
+        '''
+        Returns the deque of the data points of the lane with the same priority as *obj* (see OVERFLOW_DROP_PRIORITY).
+        '''
+        buckets = self._buckets.get(lane_priority)
+        if buckets is None:
+            buckets = self._buckets[lane_priority] = {}
+        priority = self.priority_of(obj)
+        bucket = buckets.get(priority)
+        if bucket is None:
+            bucket = buckets[priority] = deque()
+        return bucket
+
+
+    def _lowestBucket(self, lane_priority):
+        '''
+        Returns the lowest priority of the data points of the lane, and their deque (oldest first).
+        '''
+        buckets = self._buckets[lane_priority]
+        while True:
+            priority = min(buckets)
+            if buckets[priority]:
+                return priority, buckets[priority]
+            del buckets[priority]
+
+
+    def _dropLowest(self, lane_priority, bucket):
+        '''
+        Drops the oldest data point of the *bucket* from its lane, and returns it. It's only marked as dropped,
+        as removing it from the middle of the lane is slow: the lane is compacted when half of it is dropped data.
+        '''
+        obj = bucket.popleft()
+        self._dropped_ids.add(id(obj))
+        dead = self._dead.get(lane_priority, 0) + 1
+        self._dead[lane_priority] = dead
+        if dead * 2 > len(self._lanes[lane_priority]):
+            self._compactLane(lane_priority)
+        return obj
+
+
+    def _compactLane(self, lane_priority):
+        '''
+        Removes the data points marked as dropped from the lane, in place. Called with the space lock held.
+        '''
+        lane = self._lanes[lane_priority]
+        dropped = self._dropped_ids
+        for i in xrange(len(lane)):
+            obj = lane.popleft()
+            if id(obj) in dropped:
+                dropped.discard(id(obj))
+            else:
+                lane.append(obj)
+        del self._dead[lane_priority]
+
+
+    def _purgeDropped(self):
+        '''
+        Removes the data points marked as dropped from all the lanes, before reading them.
+        '''
+        if not self._dead:
+            return
+        self._space.acquire()
+        try:
+            for lane_priority in self._dead.keys():
+                self._compactLane(lane_priority)
+        finally:
+            self._space.release()
+
+
+    def _countDrop(self, priority, policy):
+        self.dropped[policy] += 1
+        self.lane_dropped[priority] = self.lane_dropped.get(priority, 0) + 1
+
+
+    def _addBounded(self, obj, priority=PRIORITY_NORMAL):
+        '''
+        Adds the data point applying the overflow policy. Returns True if the data point was stored.
+        Data of lower lanes is always dropped first: if the data point belongs to the lowest lane, the policy
+        applies to this lane, otherwise data of the lowest lane is dropped (its newest data with OVERFLOW_DROP_NEWEST).
+        '''
+        size = self._sizeOf(obj)
+        self._space.acquire()
+        try:
+            if self._full(size):
+                policy = self.overflow_policy
+                if policy == self.OVERFLOW_BLOCK:
+                    expires = time.time() + self.overflow_timeout if self.overflow_timeout is not None else None
+                    while self._full(size) and self._itemCount():
+                        if expires is None:
+                            self._space.wait()
+                            continue
+                        remaining = expires - time.time()
+                        if remaining <= 0:
+                            self.dropped['timeout'] += 1
+                            raise BufferFull('No space in the internal data after %s seconds' % self.overflow_timeout)
+                        self._space.wait(remaining)
+                else:
+                    by_priority = self._buckets is not None
+                    counter = 'newest' if policy == self.OVERFLOW_DROP_NEWEST else 'priority' if by_priority else 'oldest'
+                    while self._full(size) and self._itemCount():
+                        lowest = self._priorities()[-1]
+                        if lowest > priority:
+                            self._countDrop(priority, counter)
+                            return False
+                        data = self._lanes[lowest]
+                        if policy == self.OVERFLOW_DROP_NEWEST:
+                            if lowest == priority:
+                                self._countDrop(priority, 'newest')
+                                return False
+                            self._countDrop(lowest, 'newest')
+                            dropped = data.pop()
+                        elif by_priority:
+                            lowest_priority, bucket = self._lowestBucket(lowest)
+                            if lowest == priority and self.priority_of(obj) < lowest_priority:
+                                self._countDrop(priority, 'priority')
+                                return False
+                            self._countDrop(lowest, 'priority')
+                            dropped = self._dropLowest(lowest, bucket)
+                        else:
+                            self._countDrop(lowest, 'oldest')
+                            dropped = data.popleft()
+                        self._bytes -= self._sizeOf(dropped)
+            self._lane(priority).append(obj)
+            if self._buckets is not None:
+                self._bucket(priority, obj).append(obj)
+            self._bytes += size
+            return True
+        finally:
+            self._space.release()
+
+
+    def _freeSpace(self):
+        '''
+        Wakes up everybody waiting for space in the internal data.
+        '''
+        if self._space is not None:
+            self._space.acquire()
+            try:
+                self._space.notifyAll()
+            finally:
+                self._space.release()
+        waiters = self._space_waiters
+        self._space_waiters = []
+        for callback in waiters:
+            callback()
 
 
     def clearData(self):
@@ -106,7 +1191,23 @@ class pyZabbixSenderBase:
         #####Return:
         None
         '''
-        self._data = []
+        if self._collect_lock is not None:
+            self._collect_lock.acquire()
+        try:
+            self._data = deque()
+            self._lanes = {self.PRIORITY_NORMAL: self._data}
+            self._lane_since = {}
+            self._bytes = 0
+            if self._buckets is not None:
+                self._buckets = {}
+            self._dropped_ids = set()
+            self._dead = {}
+            self._series = []
+            self._series_count = 0
+        finally:
+            if self._collect_lock is not None:
+                self._collect_lock.release()
+        self._freeSpace()
 
 
     def getData(self):
@@ -122,10 +1223,11 @@ class pyZabbixSenderBase:
         #####Return:
         A copy of the internal data you added using the method *addData* (an array of dicts).
         '''
+        self._collect()
         copy_of_data = []
-        for data_point in self._data:
+        for data_point in self._allData():
             copy_of_data.append(data_point.copy())
-        return copy_of_data
+        return copy_of_data + self._seriesDataPoints()
 
 
     def printData(self):
@@ -139,9 +1241,10 @@ class pyZabbixSenderBase:
         #####Return:
         None
         '''
-        for elem in self._data:
+        self._collect()
+        for elem in self._allData() + self._seriesDataPoints():
             print str(elem)
-        print 'Count: %d' % len(self._data)
+        print 'Count: %d' % self._dataCount()
 
 
     def removeDataPoint(self, data_point):
@@ -157,14 +1260,83 @@ class pyZabbixSenderBase:
         #####Return:
         It returns True if data_point was found and deleted, and False if not.
         '''
-        if data_point in self._data:
-            self._data.remove(data_point)
-            return True
+        self._collect()
+        self._purgeDropped()
+        for priority, data in self._lanes.items():
+            if data_point in data:
+                data.remove(data_point)
+                if self._buckets is not None:
+                    # Equal data points are in the same bucket and in the same order, so the same one is removed
+                    self._bucket(priority, data_point).remove(data_point)
+                if self._space is not None:
+                    self._bytes -= self._sizeOf(data_point)
+                    self._freeSpace()
+                return True
 
         return False
 
+class SenderPacket(dict):
+    '''
+    Packet which data may include slices of data series (*series*, see *addDataArray*), encoded with the packet.
+    '''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.series = []
+        self.series_count = 0
+        self.kept = False       # The sender keeps the data if not delivered, see _takePackets()
+
+def packet_size(packet):
+    '''
+    Returns the number of data points in the packet.
+    '''
+    return len(packet.get('data', ())) + getattr(packet, 'series_count', 0)
+
+def encode_packet(packet):
+    '''
+    Serializes the packet as JSON, including the data series.
+    '''
+    series = getattr(packet, 'series', None)
+    if not series:
+        return jsoncodec.dumps(packet)
+    head = dict(packet)
+    data = head.pop('data', None)
+    fragments = [encode_series(host, key, values, clocks) for host, key, values, clocks in series]
+    if data:
+        fragments.insert(0, jsoncodec.dumps(data)[1:-1])
+    return '%s, "data": [%s]}' % (jsoncodec.dumps(head).rstrip()[:-1], ', '.join(fragments))
+
+def pack_chunk(packet):
+    '''
+    Returns the packet in a compact form, to be passed to a worker process: data points as tuples, and series slices.
+    '''
+    head = dict(packet)
+    rows = [(obj['host'], obj['key'], obj['value'], obj.get('clock')) for obj in head.pop('data', ())]
+    return head, rows, getattr(packet, 'series', [])
+
+def encode_chunk(job):
+    '''
+    Builds the packet packed by *pack_chunk* and returns it encoded and framed. It runs in the worker processes.
+    '''
+    head, rows, series = job
+    data = []
+    for host, key, value, clock in rows:
+        obj = {
+            'host': host,
+            'key': key,
+            'value': value,
+        }
+        if clock:
+            obj['clock'] = clock
+        data.append(obj)
+    packet = SenderPacket(head)
+    packet['data'] = data
+    for host, key, values, clocks in series:
+        packet.series.append((host, key, values, clocks))
+        packet.series_count += len(values)
+    return frame(encode_packet(packet))
+
 def recognize_response_raw(response_raw):
-    return recognize_response(json.loads(response_raw))
+    return recognize_response(jsoncodec.loads(response_raw))
 
 FAILED_COUNTER = re.compile('^.*failed.+?(\d+).*$')
 PROCESSED_COUNTER = re.compile('^.*processed.+?(\d+).*$')
@@ -176,7 +1348,7 @@ def recognize_response(response):
     seconds_spent = SECONDS_SPENT.match(response['info'].lower() if 'info' in response else '')
 
     if failed is None or processed is None:
-        raise InvalidResponse('Unable to parse server response',packet,response_raw)
+        raise InvalidResponse('Unable to parse server response',response)
     failed = int(failed.group(1))
     processed = int(processed.group(1))
     seconds_spent = float(seconds_spent.group(1)) if seconds_spent else None
@@ -0,0 +1,169 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import threading
+import time
+
+from net import DeadlineExceeded
+
+class TokenBucket:
+    '''
+    Token bucket refilled with *rate* tokens per second, up to *burst* tokens.
+
+    Tokens are reserved in advance: a reservation bigger than the available
+    tokens makes the balance negative, and the caller has to wait until it
+    is refilled. This way requests bigger than the burst are paced too.
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def reserve(self, amount, now):
+        '''
+        Takes *amount* tokens and returns the number of seconds to wait before using them.
+        '''
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimiter:
+    '''
+    Paces sending to a Zabbix server: limits items, bytes and connections per second
+    and the number of connections in flight. Any limit can be None (unlimited).
+
+    The limiter is thread-safe and can be shared by several senders of any flavour.
+    Blocking senders use *acquire()*/*release()*; asynchronous senders use
+    *enter()* to wait for an in-flight slot and *reserve()* to get the delay before
+    starting the connection.
+    '''
+    def __init__(self, items_per_second=None, bytes_per_second=None, connections_per_second=None, max_in_flight=None, burst=1.0):
+        self._buckets = []
+        self.configure(items_per_second, bytes_per_second, connections_per_second, max_in_flight, burst)
+        self.in_flight = 0
+        self.delayed = 0
+        self.delay_total = 0.0
+        self._waiters = []
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+    def configure(self, items_per_second=None, bytes_per_second=None, connections_per_second=None, max_in_flight=None, burst=1.0):
+        '''
+        Changes the limits. *burst* is the number of seconds worth of tokens that may be used at once.
+        '''
+        self.items_per_second = items_per_second
+        self.bytes_per_second = bytes_per_second
+        self.connections_per_second = connections_per_second
+        self.max_in_flight = max_in_flight
+        self._items = items_per_second and TokenBucket(items_per_second, items_per_second * burst)
+        self._bytes = bytes_per_second and TokenBucket(bytes_per_second, bytes_per_second * burst)
+        self._connections = connections_per_second and TokenBucket(connections_per_second, max(1, connections_per_second * burst))
+
+    def reserve(self, items=0, nbytes=0):
+        '''
+        Reserves tokens for one connection sending *items* items in *nbytes* bytes,
+        and returns the number of seconds to wait before connecting.
+        '''
+        self._lock.acquire()
+        try:
+            now = time.time()
+            delay = 0.0
+            for bucket, amount in ((self._items, items), (self._bytes, nbytes), (self._connections, 1)):
+                if bucket:
+                    delay = max(delay, bucket.reserve(amount, now))
+            if delay:
+                self.delayed += 1
+                self.delay_total += delay
+            return delay
+        finally:
+            self._lock.release()
+
+    def enter(self, callback):
+        '''
+        Calls *callback* when a connection may be started (immediately if an in-flight slot is free).
+        The slot is occupied until *release()* is called.
+        '''
+        self._lock.acquire()
+        try:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                self._waiters.append(callback)
+                return
+            self.in_flight += 1
+        finally:
+            self._lock.release()
+        callback()
+
+    def acquire(self, items=0, nbytes=0, expires=None):
+        '''
+        Blocks until a connection sending *items* items in *nbytes* bytes may be started.
+        Raises DeadlineExceeded if it's not possible before the *expires* time (as returned by time.time()).
+        '''
+        self._lock.acquire()
+        try:
+            while self.max_in_flight and self.in_flight >= self.max_in_flight:
+                if expires is None:
+                    self._cond.wait()
+                else:
+                    remaining = expires - time.time()
+                    if remaining <= 0:
+                        raise DeadlineExceeded('Deadline exceeded while waiting for the rate limiter')
+                    self._cond.wait(remaining)
+            self.in_flight += 1
+        finally:
+            self._lock.release()
+        delay = self.reserve(items, nbytes)
+        if expires is not None and time.time() + delay > expires:
+            self.release()
+            raise DeadlineExceeded('Deadline exceeded while waiting for the rate limiter')
+        if delay:
+            time.sleep(delay)
+
+    def release(self):
+        '''
+        Frees the in-flight slot taken by *acquire()* or *enter()*.
+        '''
+        self._lock.acquire()
+        try:
+            if self._waiters:
+                callback = self._waiters.pop(0)   # The slot is passed to the waiter
+            else:
+                callback = None
+                self.in_flight -= 1
+                self._cond.notify()
+        finally:
+            self._lock.release()
+        if callback is not None:
+            callback()
+
+    def getStats(self):
+        '''
+        Returns a dict with the limiter counters, for monitoring purposes.
+        '''
+        return {
+            'in_flight': self.in_flight,
+            'waiting': len(self._waiters),
+            'delayed': self.delayed,
+            'delay_total': self.delay_total,
+        }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(name='default'):
+    '''
+    Returns the rate limiter called *name*, shared by all senders in this process.
+    '''
+    _limiters_lock.acquire()
+    try:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = _limiters[name] = RateLimiter()
+        return limiter
+    finally:
+        _limiters_lock.release()
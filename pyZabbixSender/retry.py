@@ -0,0 +1,140 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import errno
+import random
+import socket
+import threading
+
+from breaker import CircuitOpen
+from framing import InvalidResponse
+from net import DeadlineExceeded
+
+# Outcomes of a send, see RetryPolicy.classify()
+DELIVERED = 'delivered'
+RETRY     = 'retry'       # Failed, but sending again may succeed (the server is restarting, overloaded...)
+EXPIRED   = 'expired'     # The time given to the operation is over or the breaker is open, the data is kept for later
+PERMANENT = 'permanent'   # Sending again won't help (malformed response)
+
+# Socket errors worth retrying
+RETRYABLE_ERRNOS = frozenset([getattr(errno, name) for name in (
+    'ECONNREFUSED', 'ECONNRESET', 'ECONNABORTED', 'ETIMEDOUT', 'EHOSTUNREACH', 'EHOSTDOWN',
+    'ENETUNREACH', 'ENETDOWN', 'ENETRESET', 'EPIPE', 'EAGAIN', 'EINTR',
+) if hasattr(errno, name)])
+
+class RetryBudget:
+    '''
+    Limits retries to a *ratio* of the first attempts, plus *minimum* retries, so a failing server is not flooded
+    with retries. Every first attempt deposits *ratio* tokens and every retry withdraws one. Tokens are earned
+    over the last *window* first attempts at most, so a long healthy period doesn't allow a storm of retries.
+    '''
+    def __init__(self, ratio=0.2, minimum=10, window=1000):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self.exhausted = 0
+        self._tokens = float(minimum)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        self._lock.acquire()
+        try:
+            self._tokens = min(self._tokens + self.ratio, self.minimum + self.ratio * self.window)
+        finally:
+            self._lock.release()
+
+    def withdraw(self):
+        '''
+        Returns True if a retry is allowed, taking a token.
+        '''
+        self._lock.acquire()
+        try:
+            if self._tokens < 1:
+                self.exhausted += 1
+                return False
+            self._tokens -= 1
+            return True
+        finally:
+            self._lock.release()
+
+    def available(self):
+        return int(self._tokens)
+
+class RetryPolicy:
+    '''
+    Retries of the chunks which failed with a retryable error, after an exponential backoff with full jitter:
+    the *n*-th retry waits a random time between 0 and *backoff* * 2^(n - 1) seconds, at most *max_backoff*.
+    A chunk is sent at most *attempts* times, and retries are limited by the *budget*.
+    '''
+    def __init__(self, attempts=5, backoff=0.5, max_backoff=30.0, budget=None):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget or RetryBudget()
+        self.retries = 0
+        self.gave_up = 0
+        self.permanent = 0
+        self._lock = threading.Lock()
+
+    def delay(self, attempt):
+        '''
+        Returns the seconds to wait before sending again a chunk sent *attempt* times.
+        '''
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** (attempt - 1))))
+
+    def classify(self, error, retryable=()):
+        '''
+        Returns the outcome (RETRY, EXPIRED or PERMANENT) of a send which failed with the exception *error*.
+        *retryable* are more exception types to retry (for example the errors of an asynchronous framework).
+        '''
+        if isinstance(error, (DeadlineExceeded, CircuitOpen)):
+            return EXPIRED
+        if isinstance(error, (socket.timeout, socket.gaierror) + tuple(retryable)):
+            return RETRY
+        if isinstance(error, InvalidResponse):
+            return PERMANENT
+        if isinstance(error, (socket.error, IOError, OSError)):
+            code = getattr(error, 'errno', None)
+            if code is None and error.args and isinstance(error.args[0], int):
+                code = error.args[0]
+            if code in RETRYABLE_ERRNOS:
+                return RETRY
+        return PERMANENT
+
+    def retry(self, attempt):
+        '''
+        Returns True if a chunk sent *attempt* times and failed with a retryable error can be sent again.
+        '''
+        allowed = attempt < self.attempts and self.budget.withdraw()
+        self._lock.acquire()
+        try:
+            if allowed:
+                self.retries += 1
+            else:
+                self.gave_up += 1
+        finally:
+            self._lock.release()
+        return allowed
+
+    def failed(self):
+        '''
+        Counts a chunk which failed with a permanent error.
+        '''
+        self._lock.acquire()
+        try:
+            self.permanent += 1
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        '''
+        Returns a dict with the number of *retries*, chunks given up (*gave_up*) after the last attempt or for lack of budget,
+        chunks failed with a *permanent* error, retries refused by the budget (*budget_exhausted*) and tokens *available*.
+        '''
+        return {
+            'retries': self.retries,
+            'gave_up': self.gave_up,
+            'permanent': self.permanent,
+            'budget_exhausted': self.budget.exhausted,
+            'available': self.budget.available(),
+        }
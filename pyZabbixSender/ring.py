@@ -0,0 +1,219 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import fcntl
+import mmap
+import os
+import struct
+import time
+
+import jsoncodec
+
+# Header layout: magic, capacity, write offset, read offset, records written, records dropped
+HEADER = struct.Struct('=8sQQQQQ')
+HEADER_SIZE = 64
+MAGIC = 'ZBXRING1'
+RECORD = struct.Struct('=I')
+WRAP = 0xFFFFFFFF
+
+class RingBuffer:
+    '''
+    Ring buffer of records in a shared memory mapped file, to pass data points from
+    many processes (writers) to a single process sending them (the reader).
+
+    Write and read positions are ever-growing byte offsets kept in the file header.
+    They are only accessed with an exclusive lock on the file (flock), which the system
+    releases if a process dies holding it. A writer publishes a record by moving the write
+    offset after the record is completely written, so a writer dying in the middle leaves
+    no partial record behind. The reader moves the read offset only after the records are
+    sent (see *commit*), so a reader dying in the middle makes them to be sent again.
+
+    Records which don't fit in the free space are dropped and counted.
+    '''
+    def __init__(self, path, capacity=16 << 20):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        self._fd = fd
+        self._lock()
+        try:
+            size = os.fstat(fd).st_size
+            if size < HEADER_SIZE:
+                os.ftruncate(fd, HEADER_SIZE + capacity)
+                self._map = mmap.mmap(fd, HEADER_SIZE + capacity)
+                HEADER.pack_into(self._map, 0, MAGIC, capacity, 0, 0, 0, 0)
+            else:
+                self._map = mmap.mmap(fd, size)
+                if self._map[0:8] != MAGIC:
+                    raise ValueError('%s is not a ring buffer' % path)
+            self.capacity = HEADER.unpack_from(self._map, 0)[1]
+        finally:
+            self._unlock()
+
+    def _lock(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _header(self):
+        return HEADER.unpack_from(self._map, 0)
+
+    def put(self, payload):
+        '''
+        Appends a record. Returns False if the record was dropped because the buffer is full.
+        '''
+        size = RECORD.size + len(payload)
+        self._lock()
+        try:
+            magic, capacity, write, read, written, dropped = self._header()
+            pos = write % capacity
+            skip = 0
+            if pos + size > capacity:
+                skip = capacity - pos      # The record doesn't fit at the end, it goes to the start
+            if write + skip + size - read > capacity:
+                HEADER.pack_into(self._map, 0, magic, capacity, write, read, written, dropped + 1)
+                return False
+            if skip:
+                if skip >= RECORD.size:
+                    RECORD.pack_into(self._map, HEADER_SIZE + pos, WRAP)
+                pos = 0
+            RECORD.pack_into(self._map, HEADER_SIZE + pos, len(payload))
+            start = HEADER_SIZE + pos + RECORD.size
+            self._map[start:start + len(payload)] = payload
+            HEADER.pack_into(self._map, 0, magic, capacity, write + skip + size, read, written + 1, dropped)
+            return True
+        finally:
+            self._unlock()
+
+    def read(self, max_records=None):
+        '''
+        Returns a list of *(payload, offset)* records not read yet, where *offset* is
+        the position after the record, to be passed to *commit* once it's processed.
+        Records are not removed until *commit* is called.
+        '''
+        self._lock()
+        try:
+            magic, capacity, write, read, written, dropped = self._header()
+        finally:
+            self._unlock()
+        records = []
+        while read < write and (max_records is None or len(records) < max_records):
+            pos = read % capacity
+            if capacity - pos < RECORD.size:
+                read += capacity - pos
+                continue
+            length = RECORD.unpack_from(self._map, HEADER_SIZE + pos)[0]
+            if length == WRAP:
+                read += capacity - pos
+                continue
+            if length > capacity - pos - RECORD.size:
+                # Corrupted record: a *None* payload makes the caller skip everything written so far
+                records.append((None, write))
+                break
+            start = HEADER_SIZE + pos + RECORD.size
+            read += RECORD.size + length
+            records.append((self._map[start:start + length], read))
+        return records
+
+    def commit(self, offset):
+        '''
+        Frees the space of the records before *offset* (as returned by *read*).
+        '''
+        self._lock()
+        try:
+            magic, capacity, write, read, written, dropped = self._header()
+            if read < offset <= write:
+                HEADER.pack_into(self._map, 0, magic, capacity, write, offset, written, dropped)
+        finally:
+            self._unlock()
+
+    def getStats(self):
+        '''
+        Returns a dict with the ring buffer counters.
+        '''
+        self._lock()
+        try:
+            magic, capacity, write, read, written, dropped = self._header()
+        finally:
+            self._unlock()
+        return {
+            'capacity': capacity,
+            'used': write - read,
+            'written': written,
+            'dropped': dropped,
+        }
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+class RingWriter:
+    '''
+    Producer side of the ring buffer, to be used in every worker process instead of a sender.
+    '''
+    def __init__(self, path, capacity=16 << 20):
+        self.ring = RingBuffer(path, capacity)
+
+    def addData(self, host, key, value, clock=None):
+        '''
+        #####Description:
+        Stores a data point in the ring buffer, to be sent by the flusher process. It shares the parameters of the senders' *addData* method.
+
+        #####Return:
+        It returns True if the data point was stored, and False if it was dropped because the ring buffer is full.
+        '''
+        obj = {
+            'host': host,
+            'key': key,
+            'value': value,
+        }
+        if clock:
+            obj['clock'] = clock
+        return self.ring.put(jsoncodec.dumps(obj))
+
+
+class RingFlusher:
+    '''
+    Consumer side of the ring buffer: a single process drains it into big packets sent by the *sender*
+    (an *syZabbixSender* or a *pyZabbixSender* object).
+
+    Records are moved to the internal data of the sender and sent with its *flushData* method, which keeps the data
+    of the failed chunks for the next flush. The sender keeps up to *max_records* data points: records stay in the ring
+    buffer while it's full, so data is dropped by the ring buffer when the server is down for long.
+    '''
+    def __init__(self, path, sender, max_data_per_conn=1000, max_records=100000, capacity=16 << 20):
+        self.ring = RingBuffer(path, capacity)
+        self.sender = sender
+        self.max_data_per_conn = max_data_per_conn
+        self.max_records = max_records
+
+    def flush(self):
+        '''
+        #####Description:
+        Moves the records stored in the ring buffer to the sender (up to *max_records* data points kept by the sender), frees them,
+        and sends all the data of the sender with *flushData*. The data of failed chunks is kept by the sender, to be sent by the next *flush*.
+
+        #####Return:
+        The list of results returned by the sender's *flushData*.
+        '''
+        sender = self.sender
+        room = self.max_records - sender._dataCount()
+        records = self.ring.read(room) if room > 0 else []
+        for payload, offset in records:
+            if payload is not None:     # A corrupted record, its offset skips it
+                obj = jsoncodec.loads(payload)
+                sender.addData(obj['host'], obj['key'], obj['value'], obj.get('clock'))
+        if records:
+            self.ring.commit(records[-1][1])
+        if not sender._dataCount():
+            return []
+        return sender.flushData(max_data_per_conn=self.max_data_per_conn)
+
+    def run(self, interval=1.0):
+        '''
+        Flushes the ring buffer forever, waiting *interval* seconds when it's empty.
+        '''
+        while True:
+            if not self.flush():
+                time.sleep(interval)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import random
+import threading
+import time
+
+class SelfMonitor:
+    '''
+    Observer keeping running counters about a sender, and producing them as data points
+    for the sender's own host, so its health is trended in Zabbix.
+
+    Counters (sends, items, errors, retries, bytes) are cumulative since the monitor was created.
+    Latencies (in seconds) are computed over the sends since the previous report,
+    from a bounded random sample of *samples* values.
+    '''
+    def __init__(self, host, interval=60, prefix='pyzabbixsender', samples=1024):
+        self.host = host
+        self.interval = interval
+        self.prefix = prefix
+        self.samples = samples
+        self.sends = 0
+        self.send_errors = 0
+        self.items_sent = 0
+        self.items_failed = 0
+        self.bytes_sent = 0
+        self.retries = 0
+        self._latencies = []
+        self._seen = 0
+        self._last_report = time.time()
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        self._lock.acquire()
+        try:
+            self.sends += 1
+            if record.error is not None:
+                self.send_errors += 1
+            self.items_sent += record.processed or 0
+            self.items_failed += record.failed or 0
+            self.bytes_sent += record.bytes_sent
+            # Reservoir sampling keeps the sample bounded
+            self._seen += 1
+            if len(self._latencies) < self.samples:
+                self._latencies.append(record.duration)
+            else:
+                i = random.randint(0, self._seen - 1)
+                if i < self.samples:
+                    self._latencies[i] = record.duration
+        finally:
+            self._lock.release()
+
+    def retry(self, count=1):
+        '''
+        Counts retried sends.
+        '''
+        self._lock.acquire()
+        try:
+            self.retries += count
+        finally:
+            self._lock.release()
+
+    def due(self, now=None):
+        '''
+        Returns True if the interval since the previous report is over.
+        '''
+        return (now or time.time()) - self._last_report >= self.interval
+
+    def report(self, queue_depth, now=None):
+        '''
+        Returns a list of *(key, value)* pairs with the current counters, and starts a new latency interval.
+        '''
+        now = now or time.time()
+        self._lock.acquire()
+        try:
+            values = [
+                ('sends', self.sends),
+                ('send_errors', self.send_errors),
+                ('items_sent', self.items_sent),
+                ('items_failed', self.items_failed),
+                ('bytes_sent', self.bytes_sent),
+                ('retries', self.retries),
+                ('queue_depth', queue_depth),
+            ]
+            latencies = self._latencies
+            self._latencies = []
+            self._seen = 0
+            self._last_report = now
+        finally:
+            self._lock.release()
+        if latencies:
+            latencies.sort()
+            values.extend([
+                ('latency_avg', sum(latencies) / len(latencies)),
+                ('latency_p50', percentile(latencies, 0.50)),
+                ('latency_p99', percentile(latencies, 0.99)),
+                ('latency_max', latencies[-1]),
+            ])
+        return [('%s.%s' % (self.prefix, key), value) for key, value in values]
+
+
+def percentile(values, fraction):
+    '''
+    Returns the *fraction* percentile of the sorted *values* list (nearest rank).
+    '''
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import jsoncodec
+
+# array.array type codes of numbers
+NUMERIC_TYPECODES = tuple('bBhHiIlLqQfd')
+
+def is_numeric(values):
+    '''
+    Returns True if *values* is an array of numbers (a NumPy array or an array.array),
+    so its JSON encoding can't contain commas.
+    '''
+    dtype = getattr(values, 'dtype', None)
+    if dtype is not None:
+        return dtype.kind in 'biuf'
+    return getattr(values, 'typecode', None) in NUMERIC_TYPECODES
+
+def tolist(values):
+    '''
+    Converts an array to a list of Python objects at once (in C for NumPy arrays, array.array and memoryview objects).
+    '''
+    if hasattr(values, 'tolist'):
+        return values.tolist()
+    return list(values)
+
+def encode_values(values):
+    '''
+    Returns the list of JSON encoded *values*. Numeric arrays are encoded in a single call
+    (backends differ in the spaces around separators, and numbers have no spaces).
+    '''
+    if not len(values):
+        return []
+    dumps = jsoncodec.dumps
+    if is_numeric(values):
+        return dumps(tolist(values))[1:-1].replace(' ', '').split(',')
+    return map(dumps, tolist(values))
+
+def encode_series(host, key, values, clocks=None):
+    '''
+    Encodes the data points of a series as JSON objects separated by commas,
+    to be inserted in the "data" list of a packet.
+    '''
+    dumps = jsoncodec.dumps
+    prefix = '{"host": %s, "key": %s, "value": ' % (dumps(host), dumps(key))
+    encoded = encode_values(values)
+    if clocks is not None:
+        clocks = map(str, map(int, tolist(clocks)))
+        encoded = map(', "clock": '.join, zip(encoded, clocks))
+    return prefix + ('}, ' + prefix).join(encoded) + '}'
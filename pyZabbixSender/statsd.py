@@ -0,0 +1,232 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+from twisted.internet import protocol, reactor, task, threads, defer
+from twisted.python import log
+
+import re
+import socket
+import time
+
+from selfmon import percentile
+from tx import txZabbixSender
+
+class StatsdAggregator:
+    '''
+    Aggregates StatsD metrics ("name:value|type[|@rate]", several per datagram separated by new lines)
+    over a flush interval:
+    * **counters** (c): the sum of the values, corrected by the sample rate
+    * **gauges** (g): the last value, or the value changed by "+n"/"-n"; gauges are kept between intervals
+    * **timers** (ms, h): count (corrected by the sample rate), avg, min, max and the 90th percentile
+    * **sets** (s): the number of unique values
+
+    Metric names are mapped to Zabbix hosts and keys by *rules*, a list of *(pattern, host, key)*,
+    where the first regular expression *pattern* matching the name gives the host and key,
+    which may contain group references (like "\\1" or "\\g<name>"). Names not matching any rule
+    are sent to *default_host* with the name as key, or ignored if there is no *default_host*.
+    '''
+    TIMER_STATS = ('count', 'avg', 'min', 'max', 'p90')
+
+    def __init__(self, rules=(), default_host=None, timer_format='%s.%s', max_names=100000):
+        self.rules = [(re.compile(pattern), host, key) for pattern, host, key in rules]
+        self.default_host = default_host
+        self.timer_format = timer_format
+        self.max_names = max_names
+        self._names = {}
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self.timer_counts = {}
+        self.sets = {}
+        self.metrics = 0
+        self.bad_lines = 0
+        self.unmapped = 0
+
+    def lookup(self, name):
+        '''
+        Returns the *(host, key)* the metric *name* is mapped to, or None. Results are cached.
+        '''
+        try:
+            return self._names[name]
+        except KeyError:
+            pass
+        target = None
+        for pattern, host, key in self.rules:
+            m = pattern.match(name)
+            if m:
+                target = (m.expand(host), m.expand(key))
+                break
+        else:
+            if self.default_host is not None:
+                target = (self.default_host, name)
+        if len(self._names) >= self.max_names:
+            self._names.clear()     # Protects from unbounded growth with random names
+        self._names[name] = target
+        return target
+
+    def feed(self, datagram):
+        '''
+        Aggregates the metrics in a datagram.
+        '''
+        counters = self.counters
+        for line in datagram.split('\n'):
+            if not line:
+                continue
+            try:
+                name, rest = line.split(':', 1)
+                fields = rest.split('|')
+                raw = fields[0]
+                kind = fields[1]
+                if kind == 's':
+                    value = None    # Set members aren't numbers
+                else:
+                    value = float(raw)
+                rate = 1.0
+                if len(fields) > 2 and fields[2][:1] == '@':
+                    rate = float(fields[2][1:])
+            except (ValueError, IndexError):
+                self.bad_lines += 1
+                continue
+            self.metrics += 1
+            if kind == 'c':
+                counters[name] = counters.get(name, 0.0) + (value / rate if rate else value)
+            elif kind == 'ms' or kind == 'h':
+                try:
+                    self.timers[name].append(value)
+                except KeyError:
+                    self.timers[name] = [value]
+                if rate != 1.0:
+                    # A sampled timing stands for 1/rate timings: the others are added to the count only
+                    timer_counts = self.timer_counts
+                    timer_counts[name] = timer_counts.get(name, 0.0) + (1.0 / rate if rate else 1.0) - 1.0
+            elif kind == 'g':
+                if raw[0] in '+-':
+                    value += self.gauges.get(name, 0.0)
+                self.gauges[name] = value
+            elif kind == 's':
+                try:
+                    self.sets[name].add(raw)
+                except KeyError:
+                    self.sets[name] = set([raw])
+            else:
+                self.bad_lines += 1
+
+    def flush(self, sender, clock=None):
+        '''
+        Adds the metrics aggregated during the interval to the *sender* and starts a new interval.
+        Returns the number of data points added.
+        '''
+        clock = clock or int(time.time())
+        counters, self.counters = self.counters, {}
+        timers, self.timers = self.timers, {}
+        timer_counts, self.timer_counts = self.timer_counts, {}
+        sets, self.sets = self.sets, {}
+        added = 0
+        for values in (counters, self.gauges):
+            for name, value in values.iteritems():
+                target = self.lookup(name)
+                if target is None:
+                    self.unmapped += 1
+                    continue
+                sender.addData(target[0], target[1], value, clock)
+                added += 1
+        for name, values in sets.iteritems():
+            target = self.lookup(name)
+            if target is None:
+                self.unmapped += 1
+                continue
+            sender.addData(target[0], target[1], len(values), clock)
+            added += 1
+        for name, values in timers.iteritems():
+            target = self.lookup(name)
+            if target is None:
+                self.unmapped += 1
+                continue
+            values.sort()
+            stats = (len(values) + timer_counts.get(name, 0), sum(values) / len(values), values[0], values[-1], percentile(values, 0.90))
+            for stat, value in zip(self.TIMER_STATS, stats):
+                sender.addData(target[0], self.timer_format % (target[1], stat), value, clock)
+                added += 1
+        return added
+
+
+class StatsdProtocol(protocol.DatagramProtocol):
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+
+    def datagramReceived(self, datagram, address):
+        self.aggregator.feed(datagram)
+
+
+class StatsdGateway:
+    '''
+    Receives StatsD metrics over UDP, and sends them aggregated to Zabbix using the *sender* every *interval* seconds.
+
+    The *sender* may be a *txZabbixSender*, or a blocking sender (*syZabbixSender*, *pyZabbixSender*),
+    which is run in a thread not to block the reactor.
+    '''
+    def __init__(self, sender, aggregator, interval=10.0, max_data_per_conn=1000):
+        self.sender = sender
+        self.aggregator = aggregator
+        self.interval = interval
+        self.max_data_per_conn = max_data_per_conn
+        self.flushing = False
+        self.port = None
+        self._loop = None
+
+    def listen(self, port=8125, interface='', max_throughput=4 << 20, receive_buffer_size=8 << 20):
+        '''
+        Starts listening and flushing. Datagrams are read in batches up to *max_throughput* bytes each
+        time the socket is readable, and the socket receive buffer is set to *receive_buffer_size* bytes
+        to absorb bursts.
+        '''
+        self.port = reactor.listenUDP(port, StatsdProtocol(self.aggregator), interface=interface, maxPacketSize=65535)
+        self.port.maxThroughput = max_throughput
+        if receive_buffer_size:
+            try:
+                self.port.getHandle().setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+            except socket.error:
+                pass    # The system limit is lower, keep the default
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.start(self.interval, now=False)
+        return self.port
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        if self.port is not None:
+            return self.port.stopListening()
+
+    def flush(self):
+        '''
+        Sends the metrics aggregated since the previous flush. Returns a deferred fired when done.
+        '''
+        if self.flushing:
+            return defer.succeed(None)
+        sender = self.sender
+        sender.clearData()
+        if not self.aggregator.flush(sender):
+            return defer.succeed(None)
+        self.flushing = True
+        try:
+            if isinstance(sender, txZabbixSender):
+                d = sender.sendData(max_data_per_conn=self.max_data_per_conn)
+                sender.clearData()  # Packets are built already
+            else:
+                def send():
+                    try:
+                        return sender.sendData(max_data_per_conn=self.max_data_per_conn)
+                    finally:
+                        sender.clearData()
+                d = threads.deferToThread(send)
+        except Exception:
+            # Failing now would stop the flush loop, or leave the gateway flushing for ever
+            sender.clearData()
+            d = defer.fail()
+        d.addErrback(log.err)
+        d.addBoth(self._flushed)
+        return d
+
+    def _flushed(self, result):
+        self.flushing = False
+        return result
@@ -8,11 +8,13 @@
 
 import socket
 import struct
+import os
 import time
 import sys
 import re
 
 from pyZabbixSenderBase import *
+from net import open_connection, read_at, send_file
 
 class syZabbixSender(pyZabbixSenderBase):
     '''
@@ -22,31 +24,95 @@ class syZabbixSender(pyZabbixSenderBase):
     It uses exceptions to report errors.
     '''
 
-    def send_packet(self, packet):
+    def send_packet(self, packet, expires=None, data_to_send=None):
         '''
         This is the method that actually sends the data to the zabbix server.
+        The whole operation is limited by the *expires* time (as returned by time.time()) if given.
+        The packet is encoded unless it's given already framed in *data_to_send*.
         '''
-        mydata = json.dumps(packet)
-        socket.setdefaulttimeout(self.timeout)
-        data_length = len(mydata)
-        data_header = str(struct.pack('q', data_length))
-        data_to_send = 'ZBXD\1' + str(data_header) + str(mydata)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self.zserver, self.zport))
-        sock.send(data_to_send)
+        record = self._newRecord(packet)
+        return self._observe(record, self._send_packet, packet, expires, record, data_to_send)
 
-        response_header = sock.recv(5)
-        if not response_header == 'ZBXD\1':
-            raise InvalidResponse('Wrong magic: %s' % response_header)
-
-        response_data_header = sock.recv(8)
-        response_data_header = response_data_header[:4]
-        response_len = struct.unpack('i', response_data_header)[0]
-        response_raw = sock.recv(response_len)
-        sock.close()
-        return recognize_response_raw(response_raw)
-
-    def sendData(self, packet_clock=None, max_data_per_conn=None):
+    def _observe(self, record, function, *args):
+        '''
+        Calls *function*, and passes the *record* completed with the result to the observers.
+        '''
+        if record is None:
+            return function(*args)
+        try:
+            response = function(*args)
+        except Exception, ex:
+            self._finishRecord(record, error=ex)
+            raise
+        self._finishRecord(record, response)
+        return response
+
+    def _send_packet(self, packet, expires=None, record=None, data_to_send=None):
+        '''
+        Sends the packet, measuring every phase in the *record* if given.
+        '''
+        if data_to_send is None:
+            data_to_send = frame(encode_packet(packet))
+        if record is not None:
+            record.mark('encode')
+            record.bytes_sent = len(data_to_send)
+        def write(sock, io_timeout):
+            sock.sendall(data_to_send)
+        return self._transmit(packet, packet_size(packet), len(data_to_send), write, expires, record)
+
+    def _transmit(self, packet, items, nbytes, write, expires=None, record=None):
+        '''
+        Connects to the server, writes the packet calling *write(sock, io_timeout)*, and returns the parsed response.
+        *items* and *nbytes* are the size of the packet for the rate limiter.
+        '''
+        self._checkCircuit(packet)
+        limiter = self._acquireLimiter(items, nbytes, expires, record)
+        try:
+            try:
+                connect_timeout, io_timeout = self._timeouts(expires)
+            except DeadlineExceeded:
+                self._abandonCircuit()
+                raise
+            cache = self._addressCache()
+            try:
+                sock = open_connection(cache.resolve(), connect_timeout, self.tcp_nodelay, self.send_buffer_size)
+                if self.tls is not None:
+                    sock.settimeout(connect_timeout)
+                    sock = self.tls.wrap(sock, self.zserver)
+            except socket.error:
+                cache.invalidate()
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.failure()
+                raise
+            except Exception:
+                self._abandonCircuit()
+                raise
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.success()
+            if record is not None:
+                record.mark('connect')
+            try:
+                sock.settimeout(io_timeout)
+                write(sock, io_timeout)
+                if record is not None:
+                    record.mark('write')
+
+                on_header = (lambda: record.mark('wait')) if record is not None else None
+                response_raw = read_frame(sock, io_timeout, expires, on_header=on_header)
+                if self.tls is not None:
+                    self.tls.remember(sock)
+            finally:
+                sock.close()
+        finally:
+            if limiter is not None:
+                limiter.release()
+        response = recognize_response_raw(response_raw)
+        if record is not None:
+            record.mark('parse')
+            record.bytes_received = HEADER_SIZE + len(response_raw)
+        return response
+
+    def sendData(self, packet_clock=None, max_data_per_conn=None, deadline=None):
         '''
         #####Description:
         Sends data stored using *addData* method, to the Zabbix server.
@@ -67,6 +133,9 @@ class syZabbixSender(pyZabbixSenderBase):
 
             If omitted, all data points will be sent in one single connection. *Default value: None*
 
+        * **deadline**: [in] [float] [optional] Limits the time of the whole operation, in seconds. When the time is over, the current "send" is interrupted
+          and the remaining ones are not performed, their results are *(False, DeadlineExceeded)*. *Default value: None*
+
         Please note that **internal data is not deleted after *sendData* is executed**. You need to call *clearData* after sending it, if you want to remove currently stored data.
 
         #####Return:
@@ -77,32 +146,102 @@ class syZabbixSender(pyZabbixSenderBase):
         contains counters for *processed* and *failed* (ignored) data items. Note that even if processed
         data counter is 0 and all data items have been failed, it does not mean the error condition.
         '''
-        if not max_data_per_conn or max_data_per_conn > len(self._data):
-            max_data_per_conn = len(self._data)
-
+        self._prepareFlush()
+        expires = time.time() + deadline if deadline is not None else None
         responses = []
-        i = 0
-        while i*max_data_per_conn < len(self._data):
-
-            sender_data = {
-                "request": "sender data",
-                "data": [],
-            }
-            if packet_clock:
-                sender_data['clock'] = packet_clock
-
-            sender_data['data'] = self._data[i*max_data_per_conn:(i+1)*max_data_per_conn]
+        for sender_data, data_to_send in self._framedPackets(packet_clock, max_data_per_conn):
             try:
-                response = self.send_packet(sender_data)
+                response = self.send_packet(sender_data, expires, data_to_send)
             except Exception,ex:
                 responses.append((False,ex))
             else:
                 responses.append((True,response))
-            i += 1
 
         return responses
 
-    def sendDataOneByOne(self):
+    def flushData(self, packet_clock=None, max_data_per_conn=None, deadline=None):
+        '''
+        #####Description:
+        Sends data stored using *addData* method like *sendData*, retrying the chunks which failed with a retryable error (see *useRetries*),
+        and removes the data sent from the internal data, so it drains chunk by chunk. The data of chunks still failing after the last retry
+        (or when the retry budget or the *deadline* is exhausted) is kept, to be sent by the next call. Chunks failed with a permanent error
+        (like a malformed response) are removed, as sending them again won't help.
+
+        #####Parameters:
+        The same as *sendData*.
+
+        #####Return:
+        A list of *(result, msg)* associated to each chunk, like *sendData*, with the result of its last attempt.
+        '''
+        expires = time.time() + deadline if deadline is not None else None
+        policy = self._retryPolicy()
+        packets = self._takePackets(packet_clock, max_data_per_conn)
+        def send(packet, expires, data_to_send):
+            try:
+                return DELIVERED, (True, self.send_packet(packet, expires, data_to_send))
+            except Exception,ex:
+                return policy.classify(ex), (False, ex)
+        return self._deliver(self._framedPackets(packets=packets), send, expires)
+
+    def sendFramedFile(self, path_or_fd, offsets=None, deadline=None):
+        '''
+        #####Description:
+        Sends packets already encoded and framed (with the "ZBXD" header) stored in a file, for example produced ahead of time for a big backfill.
+        Packets are sent with the *sendfile* system call when available (*os.sendfile*, or the *pysendfile* package with old Python versions),
+        so they are not copied into the process memory. Otherwise they are copied by blocks.
+
+        Every packet is sent in its own connection, like the chunks of *sendData*. When the circuit breaker is open, the *on_open* callback
+        receives a dict with the *file*, *offset* and *length* of the packet not sent.
+
+        #####Parameters:
+        * **path_or_fd**: [in] [string|integer|file] [mandatory] The path of the file, or an open file (object or descriptor).
+        * **offsets**: [in] [list] [optional] Offsets of the packets to send in the file. If omitted, all packets in the file are sent,
+          and ValueError is raised before sending anything when data not framed is found. *Default value: None*
+        * **deadline**: [in] [float] [optional] Limits the time of the whole operation, in seconds, like in *sendData*. *Default value: None*
+
+        #####Return:
+        A list of *(result, msg)* associated to each packet, like the one returned by *sendData*.
+        '''
+        if isinstance(path_or_fd, basestring):
+            name = path_or_fd
+            fd = os.open(path_or_fd, os.O_RDONLY)
+        else:
+            name = getattr(path_or_fd, 'name', None)
+            fd = path_or_fd.fileno() if hasattr(path_or_fd, 'fileno') else path_or_fd
+        expires = time.time() + deadline if deadline is not None else None
+        responses = []
+        try:
+            if offsets is None:
+                # Scanned before sending, so a corrupted file fails without sending part of it
+                offsets = list(framed_offsets(fd))
+            for offset in offsets:
+                try:
+                    length = framed_length(read_at(fd, offset, HEADER_SIZE))
+                    packet = {'file': name, 'offset': offset, 'length': length}
+                    record = self._newRecord({})
+                    response = self._observe(record, self._send_framed_file, packet, fd, expires, record)
+                except Exception,ex:
+                    responses.append((False,ex))
+                else:
+                    responses.append((True,response))
+        finally:
+            if isinstance(path_or_fd, basestring):
+                os.close(fd)
+        return responses
+
+    def _send_framed_file(self, packet, fd, expires=None, record=None):
+        '''
+        Sends the framed packet at *packet['offset']* in the file *fd*.
+        '''
+        offset = packet['offset']
+        length = packet['length']
+        if record is not None:
+            record.bytes_sent = length
+        def write(sock, io_timeout):
+            send_file(sock, fd, offset, length, io_timeout, expires)
+        return self._transmit(packet, 0, length, write, expires, record)
+
+    def sendDataOneByOne(self, deadline=None):
         '''
         #####Description:
         You can use this method to send all stored data, one by one, to determine which traps are not being handled correctly by the server.
@@ -114,7 +253,7 @@ class syZabbixSender(pyZabbixSenderBase):
         This is primarily intended for debugging purposes.
 
         #####Parameters:
-        None
+        * **deadline**: [in] [float] [optional] Limits the time of the whole operation, in seconds, like in *sendData*. *Default value: None*
 
         #####Return:
         A list of *(result, msg)* associated to each "send" operation, where *result* is a boolean meaning success of the operation,
@@ -124,7 +263,7 @@ class syZabbixSender(pyZabbixSenderBase):
         contains counters for *processed* and *failed* (ignored) data items. Note that even if processed
         data counter is 0 and all data items have been failed, it does not mean the error condition.
         '''
-        return self.sendData(max_data_per_conn=1)
+        return self.sendData(max_data_per_conn=1, deadline=deadline)
 
     def sendSingle(self, host, key, value, clock=None):
         '''
@@ -0,0 +1,296 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+import binascii
+import errno
+import select
+import socket
+import ssl
+import threading
+
+# The ssl module of Python 2 can't resume sessions: pyOpenSSL is used instead when it's installed, see openssl().
+# PSK is done by the sslpsk package, without session resumption.
+try:
+    import sslpsk
+except ImportError:
+    sslpsk = None
+
+SEND_BLOCK_SIZE = 1 << 16   # Data passed to every TLS write of the pyOpenSSL socket
+
+_openssl = []
+
+def openssl():
+    '''
+    Returns the OpenSSL.SSL module of pyOpenSSL, or None if it's not installed. It's imported on first use only.
+    '''
+    if not _openssl:
+        try:
+            from OpenSSL import SSL
+        except ImportError:
+            SSL = None
+        _openssl.append(SSL)
+    return _openssl[0]
+
+def sessions_supported():
+    '''
+    Returns True if the connections of the blocking senders can resume TLS sessions (with a certificate).
+    '''
+    return openssl() is not None
+
+def session_reused(connection):
+    '''
+    Returns True if the pyOpenSSL *connection* resumed a session. Connection.session_reused is missing
+    from most pyOpenSSL versions, then SSL_session_reused is called through its OpenSSL binding.
+    '''
+    reused = getattr(connection, 'session_reused', None)
+    if reused is not None:
+        return bool(reused())
+    from OpenSSL._util import lib
+    return bool(lib.SSL_session_reused(connection._ssl))
+
+def certificate_names(x509):
+    '''
+    Returns the names of the pyOpenSSL certificate *x509*, like ssl.SSLSocket.getpeercert(), for ssl.match_hostname.
+    '''
+    cert = {'subject': tuple([(('commonName', value),) for name, value in x509.get_subject().get_components() if name == 'CN'])}
+    alt_names = []
+    for i in xrange(x509.get_extension_count()):
+        extension = x509.get_extension(i)
+        if extension.get_short_name() == 'subjectAltName':
+            for entry in str(extension).split(', '):
+                kind, sep, value = entry.partition(':')
+                if kind == 'DNS':
+                    alt_names.append(('DNS', value))
+                elif kind == 'IP Address':
+                    alt_names.append(('IP Address', value))
+    if alt_names:
+        cert['subjectAltName'] = tuple(alt_names)
+    return cert
+
+
+class OpenSSLSocket:
+    '''
+    Blocking socket interface over a pyOpenSSL connection, used by the blocking senders. pyOpenSSL doesn't
+    wait when the socket has a timeout (it raises WantReadError or WantWriteError), so the socket is kept
+    non-blocking and the timeout is waited here, raising socket.timeout like a socket.
+    OpenSSL errors are raised as ssl.SSLError, a socket.error like with the ssl module.
+    '''
+    def __init__(self, connection, sock):
+        self.connection = connection
+        self.sock = sock
+        self._timeout = sock.gettimeout()
+        sock.setblocking(False)
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def gettimeout(self):
+        return self._timeout
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setsockopt(self, *args):
+        return self.sock.setsockopt(*args)
+
+    def _io(self, function, *args):
+        '''
+        Calls *function* with *args* until it doesn't need to wait for the socket, waiting for it up to the timeout.
+        '''
+        SSL = openssl()
+        while True:
+            try:
+                return function(*args)
+            except SSL.WantReadError:
+                readable, writable = [self.sock], []
+            except SSL.WantWriteError:
+                readable, writable = [], [self.sock]
+            except SSL.SysCallError, ex:
+                code, message = ex.args
+                if code == -1:
+                    raise socket.error(errno.ECONNRESET, 'Connection closed by the server')
+                raise socket.error(code, message)
+            except SSL.Error, ex:
+                raise ssl.SSLError(str(ex))
+            ready = select.select(readable, writable, [], self._timeout)
+            if not ready[0] and not ready[1]:
+                raise socket.timeout('timed out')
+
+    def do_handshake(self):
+        self.connection.set_connect_state()
+        self._io(self.connection.do_handshake)
+
+    def recv(self, size):
+        try:
+            return self._io(self.connection.recv, size)
+        except openssl().ZeroReturnError:
+            return ''
+
+    def send(self, data):
+        return self._io(self.connection.send, data[:SEND_BLOCK_SIZE])
+
+    def sendall(self, data):
+        pos = 0
+        while pos < len(data):
+            # A write waiting for the socket is retried with the same block, as OpenSSL requires
+            pos += self._io(self.connection.send, data[pos:pos + SEND_BLOCK_SIZE])
+
+    def close(self):
+        # OpenSSL doesn't resume the session of a connection closed without a TLS shutdown
+        try:
+            self.connection.shutdown()
+        except openssl().Error:
+            pass
+        self.sock.close()
+
+
+class TLSConfig:
+    '''
+    TLS settings of the connections to a Zabbix server, with a certificate or a pre-shared key (PSK).
+
+    With a certificate and pyOpenSSL, the last session is kept and resumed by the next connections, so the chunks
+    of a "send" don't do a full handshake each. The *handshakes* and *resumed* counters tell how many connections
+    did a full handshake or resumed a session. PSK connections use the sslpsk package, and always do a full handshake.
+    '''
+    def __init__(self, ca_file=None, cert_file=None, key_file=None, psk_identity=None, psk=None,
+            server_hostname=None, check_hostname=False, ciphers=None, session_reuse=True):
+        if psk is not None and cert_file is not None:
+            raise ValueError('Use either a certificate or a PSK')
+        if psk is not None and sslpsk is None:
+            raise ValueError('PSK needs the sslpsk package')
+        self.ca_file = ca_file
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.psk_identity = psk_identity
+        self.psk = binascii.unhexlify(psk) if psk is not None else None  # Hexadecimal, like in Zabbix PSK files
+        self.server_hostname = server_hostname
+        self.check_hostname = check_hostname
+        self.ciphers = ciphers
+        self.session_reuse = session_reuse
+        self.handshakes = 0
+        self.resumed = 0
+        self._context = None
+        self._openssl_context = None
+        self._openssl_session = None
+        self._lock = threading.Lock()
+
+    def context(self):
+        '''
+        Returns the ssl.SSLContext of the certificate connections without pyOpenSSL, created once.
+        '''
+        if self._context is not None:
+            return self._context
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+        context.verify_mode = ssl.CERT_REQUIRED
+        if self.ca_file:
+            context.load_verify_locations(self.ca_file)
+        else:
+            context.load_default_certs()
+        context.check_hostname = self.check_hostname
+        if self.cert_file:
+            context.load_cert_chain(self.cert_file, self.key_file)
+        if self.ciphers:
+            context.set_ciphers(self.ciphers)
+        self._context = context
+        return context
+
+    def wrap(self, sock, server_hostname=None):
+        '''
+        Does the TLS handshake on the connected socket *sock*, and returns the TLS socket.
+        With a certificate, pyOpenSSL is used when it's installed to resume the last session, as the ssl module
+        of Python 2 can't resume sessions.
+        '''
+        if self.psk is not None:
+            tls_sock = sslpsk.wrap_socket(sock, psk=(self.psk, self.psk_identity),
+                ciphers=self.ciphers or 'PSK', ssl_version=ssl.PROTOCOL_TLSv1_2)
+        elif openssl() is not None:
+            return self._wrapOpenSSL(sock, server_hostname)
+        else:
+            tls_sock = self.context().wrap_socket(sock, server_hostname=self.server_hostname or server_hostname)
+        self._count(False)
+        return tls_sock
+
+    def _wrapOpenSSL(self, sock, server_hostname=None):
+        '''
+        Does the TLS handshake with pyOpenSSL, and returns an OpenSSLSocket.
+        '''
+        hostname = self.server_hostname or server_hostname
+        tls_sock = OpenSSLSocket(self.openSSLConnection(None, hostname, sock), sock)
+        tls_sock.do_handshake()
+        if self.check_hostname:
+            ssl.match_hostname(certificate_names(tls_sock.connection.get_peer_certificate()), hostname)
+        self._count(session_reused(tls_sock.connection))
+        return tls_sock
+
+    def remember(self, tls_sock):
+        '''
+        Keeps the session of the connection, to be resumed by the next ones.
+        It's called after the reply is read, as TLS 1.3 servers send session tickets after the handshake.
+        '''
+        if isinstance(tls_sock, OpenSSLSocket) and self.session_reuse:
+            self._openssl_session = tls_sock.connection.get_session()
+
+    def openSSLContext(self):
+        '''
+        Returns the pyOpenSSL context of the certificate connections, created once.
+        '''
+        if self._openssl_context is not None:
+            return self._openssl_context
+        from OpenSSL import SSL
+        context = SSL.Context(SSL.SSLv23_METHOD)
+        context.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+        if self.ca_file:
+            context.load_verify_locations(self.ca_file)
+        else:
+            context.set_default_verify_paths()
+        context.set_verify(SSL.VERIFY_PEER, lambda connection, cert, errnum, depth, ok: ok)
+        if self.cert_file:
+            context.use_certificate_chain_file(self.cert_file)
+            context.use_privatekey_file(self.key_file or self.cert_file)
+        if self.ciphers:
+            context.set_cipher_list(self.ciphers)
+        context.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        self._openssl_context = context
+        return context
+
+    def openSSLConnection(self, app_data, server_hostname=None, sock=None):
+        '''
+        Returns a pyOpenSSL connection over the socket *sock* (or memory BIOs if None), resuming the last session if possible.
+        '''
+        from OpenSSL import SSL
+        connection = SSL.Connection(self.openSSLContext(), sock)
+        connection.set_app_data(app_data)
+        hostname = self.server_hostname or server_hostname
+        if hostname:
+            connection.set_tlsext_host_name(hostname.encode('ascii'))
+        if self.session_reuse and self._openssl_session is not None:
+            connection.set_session(self._openssl_session)
+        return connection
+
+    def rememberOpenSSL(self, connection):
+        '''
+        Keeps the session of the pyOpenSSL *connection*, like *remember*.
+        '''
+        self._count(session_reused(connection))
+        if self.session_reuse:
+            self._openssl_session = connection.get_session()
+
+    def _count(self, resumed):
+        self._lock.acquire()
+        try:
+            if resumed:
+                self.resumed += 1
+            else:
+                self.handshakes += 1
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        '''
+        Returns a dict with the numbers of full handshakes and resumed sessions.
+        '''
+        return {
+            'handshakes': self.handshakes,
+            'resumed': self.resumed,
+        }
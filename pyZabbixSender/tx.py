@@ -13,8 +13,10 @@ from twisted.python import log, failure
 
 from twisted.internet import protocol, reactor
 from zope.interface import implements
-from twisted.internet import interfaces,error
+from twisted.internet import interfaces,error,task
 
+import logging
+import socket
 import struct
 import time
 import sys
@@ -22,79 +24,91 @@ import re
 
 from pyZabbixSenderBase import *
 
-class SenderProtocol(protocol.Protocol):
-    def __init__(self,factory):
-        self.factory = factory
-        self.reset()
+# Messages of the protocol below this level are skipped before anything is formatted.
+# Debug messages are logged with a truncated preview of the packets, see set_log_level().
+log_level = logging.INFO
+PREVIEW_SIZE = 256
 
-    def reset(self):
-        self.tail = ''
-        self.state = 'magic'
+def set_log_level(level, preview_size=None):
+    '''
+    Sets the level of the messages logged by the protocol (a *logging* level), and the size of the packet previews.
+    '''
+    global log_level, PREVIEW_SIZE
+    log_level = level
+    if preview_size is not None:
+        PREVIEW_SIZE = preview_size
 
-    def dataReceived(self, data):
-        log.msg("RECEIVED DATA: %s" % len(data))
-        while len(data):
-            l = self.parseData(data)
-            log.msg("PARSED DATA: %s" % l)
-            if l:
-                data = data[l:]
-            else:
-                self.error_happens(failure.Failure(InvalidResponse("Unknown data chunk")))
-                self.transport.loseConnection()
-                break
+def debug(format, **kwargs):
+    '''
+    Logs a structured debug message: *format* is only applied to the keyword arguments when an observer renders it.
+    '''
+    if log_level <= logging.DEBUG:
+        log.msg(format=format, logLevel=logging.DEBUG, **kwargs)
 
-    def parseData(self,data):
-        d = self.tail + data
-        l = self._expected_length()
-        if len(d) < l:
-            self.tail = d
-            return len(data)
+class Preview(object):
+    '''
+    Truncated representation of a packet, computed only when the message is rendered.
+    Only the first items of a packet not serialized yet are encoded.
+    '''
+    __slots__ = ('packet', 'size')
 
-        self._expected_parse(d[0:l])
-        taill = len(self.tail)
-        self.tail = ''
-        return l - taill
+    def __init__(self, packet, size=None):
+        self.packet = packet
+        self.size = size or PREVIEW_SIZE
+
+    def __str__(self):
+        packet = self.packet
+        if isinstance(packet, basestring):
+            if len(packet) <= self.size:
+                return packet
+            return '%s... (%d bytes)' % (packet[:self.size], len(packet))
+        head = dict(packet)
+        data = head.get('data') or []
+        head['data'] = data[:self.size // 32 + 1]
+        text = jsoncodec.dumps(head)
+        items = len(data) + getattr(packet, 'series_count', 0)
+        if len(text) <= self.size and len(head['data']) == items:
+            return text
+        return '%s... (%d items)' % (text[:self.size], items)
 
-    def _expected_length(self):
-        m = getattr(self,'_expected_length_'+self.state)
-        return m()
+class SenderProtocol(protocol.Protocol):
+    record = None   # SendRecord measuring the exchange, if somebody observes it
 
-    def _expected_parse(self,data):
-        m = getattr(self,'_expected_parse_'+self.state)
-        return m(data)
+    def __init__(self,factory):
+        self.factory = factory
+        self.reset()
 
-    def _expected_length_magic(self):
-        return 5
+    def reset(self):
+        self.decoder = FrameDecoder()
+        self.done = False
 
-    def _expected_parse_magic(self,data):
-        if not data == 'ZBXD\1':
-            self.error_happens(failure.Failure(InvalidResponse("Wrong magic: %s" % data)))
+    def dataReceived(self, data):
+        debug("Received %(size)d bytes", size=len(data))
+        if self.done:
+            return
+        try:
+            frames = self.decoder.feed(data)
+        except FrameError,ex:
+            self.error_happens(failure.Failure())
+            self.done = True
             self.transport.loseConnection()
             return
-        self.state = 'header'
-
-    def _expected_length_header(self):
-        return 8
-
-    def _expected_parse_header(self,data):
-        self._data_length, = struct.unpack('i',data[:4])
-        log.msg("Received length: %s" % self._data_length)
-        self.state = 'data'
-
-    def _expected_length_data(self):
-        return self._data_length
+        debug("%(pending)d bytes pending", pending=self.decoder.pending())
+        for data in frames:
+            self.frameReceived(data)
+            if self.done:
+                break
 
-    def _expected_parse_data(self,data):
-        packet = {}
-        self.state = 'header'
+    def frameReceived(self,data):
+        self.done = True
         try:
-            packet = json.loads(data)
+            packet = jsoncodec.loads(data)
         except Exception,ex:
             f = failure.Failure()
             self.error_happens(f)
             self.transport.loseConnection()
             return
-        log.msg("Received packet: %s" % packet)
+        debug("Received packet (%(size)d bytes): %(preview)s", size=len(data), preview=Preview(data))
         try:
             self.packet_received(packet)
         except Exception,ex:
@@ -102,7 +116,6 @@ class SenderProtocol(protocol.Protocol):
             self.error_happens(f)
             self.transport.loseConnection()
             return
-        self.state = 'done'
         self.transport.loseConnection() # Normally the Zabbix expects closing connection from the sender
 
     def packet_received(self,packet):
@@ -112,52 +125,142 @@ class SenderProtocol(protocol.Protocol):
         log.err(fail)
 
     def send_packet(self,packet):
-        '''sends a packet in form of json'''
-        log.msg("Sending a packet: %s" % packet)
+        '''sends a packet in form of json, the packet may be already serialized'''
+        debug("Sending a packet: %(preview)s", preview=Preview(packet))
         try:
-            data = json.dumps(packet)
+            if isinstance(packet,basestring):
+                data = packet
+            else:
+                data = encode_packet(packet)
         except Exception,ex:
             f = failure.Failure()
             self.error_happens(f)
             self.transport.loseConnection()
             return
-        data_length = len(data)
-        data_header = str(struct.pack('q', data_length))
-        data_to_send = 'ZBXD\1' + str(data_header) + data
+        data_to_send = frame(data)
+        if self.record is not None:
+            self.record.mark('encode')
+            self.record.bytes_sent = len(data_to_send)
         self.transport.write(data_to_send)
-        log.msg("Packet sent: %s bytes" % len(data_to_send))
+        if self.record is not None:
+            self.record.mark('write')
+        debug("Packet sent: %(size)d bytes", size=len(data_to_send))
 
 class SenderProcessor(SenderProtocol):
     def __init__(self,factory,packet,deferred):
         SenderProtocol.__init__(self,factory)
         self.deferred = deferred
         self.packet = packet
+        self.record = factory.record
 
     def connectionMade(self):
+        if self.record is not None:
+            self.record.mark('connect')
+        if self.factory.nodelay:
+            self.transport.setTcpNoDelay(True)
+        if self.factory.send_buffer_size:
+            transport = self.transport
+            if self.factory.tls is not None:
+                transport = transport.transport     # The TCP transport under TLS
+            transport.getHandle().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.factory.send_buffer_size)
+        self._timer = None
+        io_timeout = self.factory.io_timeout
+        if self.factory.expires is not None:
+            remaining = max(0, self.factory.expires - time.time())
+            if io_timeout is None or io_timeout > remaining:
+                io_timeout = remaining
+        if io_timeout is not None:
+            self._timer = reactor.callLater(io_timeout, self.timeout_happens)
         self.send_packet(self.packet)
+    def connectionLost(self,reason):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+    def timeout_happens(self):
+        self._timer = None
+        if self.factory.expires is not None and time.time() >= self.factory.expires:
+            ex = DeadlineExceeded('Deadline exceeded while waiting for the server response')
+        else:
+            ex = error.TimeoutError('Timeout while waiting for the server response')
+        self.error_happens(failure.Failure(ex))
+        self.transport.abortConnection()
+    def dataReceived(self,data):
+        if self.record is not None:
+            if not self.record.bytes_received:
+                self.record.mark('wait')
+            self.record.bytes_received += len(data)
+        SenderProtocol.dataReceived(self,data)
     def packet_received(self,packet):
+        if self.factory.tls is not None:
+            self.factory.tls.rememberOpenSSL(self.transport.getHandle())
         response = recognize_response(packet)
-        self.deferred.callback(response)
+        if self.record is not None:
+            self.record.mark('parse')
+        if not self.deferred.called:
+            self.deferred.callback(response)
     def error_happens(self,fail):
-        self.deferred.errback(fail)
+        if not self.deferred.called:
+            self.deferred.errback(fail)
+
+class TLSConnectionCreator:
+    '''
+    Creates the TLS connections of txZabbixSender, resuming the last TLS session.
+    '''
+    implements(interfaces.IOpenSSLClientConnectionCreator)
+
+    def __init__(self,tls,hostname):
+        self.tls = tls
+        self.hostname = hostname
+
+    def clientConnectionForTLS(self,tlsProtocol):
+        return self.tls.openSSLConnection(tlsProtocol,self.hostname)
 
 class SenderFactory(protocol.ClientFactory):
-    def __init__(self,packet,deferred):
+    def __init__(self,packet,deferred,nodelay=True,send_buffer_size=None,breaker=None,io_timeout=None,expires=None,record=None,tls=None,
+            addresses=(),connect_timeout=None,cache=None):
         self.deferred = deferred
         self.packet = packet
+        self.nodelay = nodelay
+        self.send_buffer_size = send_buffer_size
+        self.breaker = breaker
+        self.io_timeout = io_timeout
+        self.expires = expires
+        self.record = record
+        self.tls = tls
+        self.addresses = list(addresses)    # Next addresses to try when connecting fails
+        self.connect_expires = time.time() + connect_timeout if connect_timeout is not None else None
+        self.cache = cache
     def buildProtocol(self,addr):
+        if self.breaker is not None:
+            self.breaker.success()
         return SenderProcessor(self,self.packet,self.deferred)
 
     def clientConnectionFailed(self, connector, reason):
+        if self.addresses:
+            # The connect timeout limits all the attempts, like with the blocking senders
+            timeout = None
+            if self.connect_expires is not None:
+                timeout = self.connect_expires - time.time()
+            if timeout is None or timeout > 0:
+                connector.host = self.addresses.pop(0)
+                if timeout is not None:
+                    connector.timeout = timeout
+                connector.connect()
+                return
+        if self.cache is not None:
+            self.cache.invalidate()
+        if self.breaker is not None:
+            self.breaker.failure()
         if not self.deferred.called:
             log.err("ERROR: connecting has been failed because of:%s, sending data has been skipped" % reason)
             self.deferred.errback(reason)
 
     def clientConnectionLost(self, connector, reason):
-        if not isinstance(reason.value,error.ConnectionDone):
-            if not self.deferred.called:
-                log.err("ERROR: connecting has been lost because of:%s, sending data has been skipped" % reason)
-                self.deferred.errback(reason)
+        if not self.deferred.called:
+            if isinstance(reason.value,error.ConnectionDone):
+                # Closed by the server before the response
+                reason = failure.Failure(error.ConnectionLost('Connection closed before the server response'))
+            log.err("ERROR: connecting has been lost because of:%s, sending data has been skipped" % reason)
+            self.deferred.errback(reason)
 
 class txZabbixSender(pyZabbixSenderBase):
     '''
@@ -165,13 +268,135 @@ class txZabbixSender(pyZabbixSenderBase):
     protocol used by the zabbix_server binary distributed by Zabbix.
     '''
 
-    def _send(self,packet):
-        '''This method creates a connection, sends data and returns deferred to get a result'''
+    def _send(self,packet,expires=None):
+        '''
+        This method creates a connection, sends data and returns deferred to get a result.
+        The whole operation is limited by the *expires* time (as returned by time.time()) if given.
+        When the rate limiter is used, the connection is delayed until the limiter allows it.
+        '''
+        limiter = self.rate_limiter
+        if limiter is None:
+            return self._connect(packet,expires)
+        record = self._newRecord(packet)
+        try:
+            data = encode_packet(packet)
+        except Exception:
+            return defer.fail()
+        if record is not None:
+            record.mark('encode')
+        deferred = defer.Deferred()
+        def start():
+            if record is not None:
+                record.mark('throttle')
+            d = self._connect(packet,expires,data,record)
+            d.addBoth(finish)
+            d.chainDeferred(deferred)
+        def finish(result):
+            limiter.release()
+            return result
+        def dispatch():
+            delay = limiter.reserve(packet_size(packet), len(data) + HEADER_SIZE)
+            reactor.callLater(delay,start)
+        limiter.enter(lambda: reactor.callFromThread(dispatch))
+        return deferred
+
+    def _connect(self,packet,expires=None,data=None,record=None):
+        '''
+        This method creates a connection right now, sending the *data* (packet serialized before) if given
+        '''
+        if record is None:
+            record = self._newRecord(packet)
+        try:
+            connect_timeout, io_timeout = self._timeouts(expires)
+            self._checkCircuit(packet)
+        except (CircuitOpen, DeadlineExceeded), ex:
+            if record is not None:
+                self._finishRecord(record, error=ex)
+            return defer.fail()
+        addresses = self._serverAddresses()
+        deferred = defer.Deferred()
+        if record is not None:
+            deferred.addCallbacks(self._recordResponse, self._recordFailure, callbackArgs=(record,), errbackArgs=(record,))
+        factory = SenderFactory(data if data is not None else packet,deferred,
+            nodelay=self.tcp_nodelay,
+            send_buffer_size=self.send_buffer_size,
+            breaker=self.circuit_breaker,
+            io_timeout=io_timeout,
+            expires=expires,
+            record=record,
+            tls=self.tls,
+            addresses=addresses[1:],
+            connect_timeout=connect_timeout,
+            cache=self._addressCache(),
+        )
+        if self.tls is not None:
+            try:
+                from twisted.protocols.tls import TLSMemoryBIOFactory   # Needs pyOpenSSL
+                factory = TLSMemoryBIOFactory(TLSConnectionCreator(self.tls,self.zserver),True,factory)
+            except Exception:
+                self._abandonCircuit()
+                deferred.errback()
+                return deferred
+        connection = reactor.connectTCP(addresses[0],self.zport,factory,connect_timeout)
+        return deferred
+
+    def _recordResponse(self,response,record):
+        self._finishRecord(record,response)
+        return response
+
+    def _recordFailure(self,fail,record):
+        self._finishRecord(record,error=fail.value)
+        return fail
+
+    def _serverAddresses(self):
+        '''
+        Returns the cached server addresses to avoid name resolution in the reactor thread, IPv4 and IPv6 interleaved.
+        They are tried in order until a connection is established. The server name is returned while the cache
+        is being populated in the background.
+        '''
+        addresses = []
+        for info in self._addressCache().peek() or ():
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+        return addresses or [self.zserver]
+
+    def useTLS(self, *args, **kwargs):
+        '''
+        #####Description:
+        Encrypts the connections to the server with TLS, see *pyZabbixSenderBase.useTLS*. The connections use pyOpenSSL,
+        which has no PSK support in its Python 2 versions, so ValueError is raised when a PSK is given.
+
+        #####Return:
+        The *TLSConfig* object.
+        '''
+        tls = pyZabbixSenderBase.useTLS(self, *args, **kwargs)
+        if tls.psk is not None:
+            self.tls = None
+            raise ValueError('PSK is only supported by the blocking senders')
+        return tls
+
+    def waitForCapacity(self):
+        '''
+        #####Description:
+        When the capacity of the internal data is limited (see *setCapacity*), data producers running in the reactor should not use
+        the OVERFLOW_BLOCK policy, as it would block the reactor. Instead, they can wait for this deferred before adding data.
+
+        #####Parameters:
+        None
+
+        #####Return:
+        A deferred fired immediately if there is space in the internal data, or when some space is made (by *clearData* or *removeDataPoint*).
+        '''
+        if self._space is None or not self._full(0):
+            return defer.succeed(None)
         deferred = defer.Deferred()
-        connection = reactor.connectTCP(self.zserver,self.zport,SenderFactory(packet,deferred),self.timeout)
+        def fire():
+            if not deferred.called:
+                deferred.callback(None)
+        self._space_waiters.append(fire)
         return deferred
 
-    def sendData(self, packet_clock=None, max_data_per_conn=None):
+    def sendData(self, packet_clock=None, max_data_per_conn=None, deadline=None):
         '''
         #####Description:
         Sends data stored using *addData* method, to the Zabbix server.
@@ -192,33 +417,71 @@ class txZabbixSender(pyZabbixSenderBase):
 
             If omitted, all data points will be sent in one single connection. *Default value: None*
 
+        * **deadline**: [in] [float] [optional] Limits the time of the whole operation, in seconds. When the time is over, pending "sends" are
+          interrupted and fail with *DeadlineExceeded*. *Default value: None*
+
         Please note that **internal data is not deleted after *sendData* is executed**. You need to call *clearData* after sending it, if you want to remove currently stored data.
 
         #####Return:
         A deferred list of each "send" operation results.
         '''
-        if not max_data_per_conn or max_data_per_conn > len(self._data):
-            max_data_per_conn = len(self._data)
-
+        self._prepareFlush()
+        expires = time.time() + deadline if deadline is not None else None
         responses = []
-        i = 0
-        while i*max_data_per_conn < len(self._data):
-
-            sender_data = {
-                "request": "sender data",
-                "data": [],
-            }
-            if packet_clock:
-                sender_data['clock'] = packet_clock
-
-            sender_data['data'] = self._data[i*max_data_per_conn:(i+1)*max_data_per_conn]
-            response = self._send(sender_data)
+        for sender_data in self._packets(packet_clock, max_data_per_conn):
+            response = self._send(sender_data, expires)
             responses.append(response)
-            i += 1
 
         return defer.DeferredList(responses)
 
-    def sendDataOneByOne(self):
+    # Twisted errors worth retrying, see flushData()
+    RETRYABLE_ERRORS = (error.ConnectError, error.ConnectionLost)
+
+    def flushData(self, packet_clock=None, max_data_per_conn=None, deadline=None):
+        '''
+        #####Description:
+        Sends data stored using *addData* method like *sendData*, retrying the chunks which failed with a retryable error (see *useRetries*),
+        and removes the data sent from the internal data, so it drains chunk by chunk. The data of chunks still failing after the last retry
+        (or when the retry budget or the *deadline* is exhausted) is put back in the internal data, to be sent by the next call. Chunks failed
+        with a permanent error (like a malformed response) are removed, as sending them again won't help.
+
+        #####Parameters:
+        The same as *sendData*.
+
+        #####Return:
+        A deferred list of the results of each chunk, with the result of its last attempt.
+        '''
+        expires = time.time() + deadline if deadline is not None else None
+        policy = self._retryPolicy()
+        responses = []
+        for sender_data in self._takePackets(packet_clock, max_data_per_conn):
+            policy.budget.deposit()
+            responses.append(self._sendWithRetries(sender_data, expires, policy, 1))
+
+        return defer.DeferredList(responses)
+
+    def _sendWithRetries(self, packet, expires, policy, attempts):
+        '''
+        Sends the packet, and schedules a retry if it fails with a retryable error and the policy allows it.
+        '''
+        def failed(fail):
+            outcome = policy.classify(fail.value, self.RETRYABLE_ERRORS)
+            if outcome == RETRY:
+                delay = policy.delay(attempts)
+                if (expires is None or time.time() + delay < expires) and policy.retry(attempts):
+                    if self.self_monitor is not None:
+                        self.self_monitor.retry()
+                    return task.deferLater(reactor, delay, self._sendWithRetries, packet, expires, policy, attempts + 1)
+            if outcome == PERMANENT:
+                policy.failed()
+            else:
+                self._requeue([packet])
+            return fail
+        deferred = self._send(packet, expires)
+        deferred.addErrback(failed)
+        return deferred
+
+    def sendDataOneByOne(self, deadline=None):
         '''
         #####Description:
         You can use this method to send all stored data, one by one, to determine which traps are not being handled correctly by the server.
@@ -230,20 +493,12 @@ class txZabbixSender(pyZabbixSenderBase):
         This is primarily intended for debugging purposes.
 
         #####Parameters:
-        None
+        * **deadline**: [in] [float] [optional] Limits the time of the whole operation, in seconds, like in *sendData*. *Default value: None*
 
         #####Return:
         A deferred list of each "send" operation results.
         '''
-        retarray = []
-        for i in self._data:
-            if 'clock' in i:
-                d = self.sendSingle(i['host'], i['key'], i['value'], i['clock'])
-            else:
-                d = self.sendSingle(i['host'], i['key'], i['value'])
-
-            retarray.append(d)
-        return defer.DeferredList(retarray)
+        return self.sendData(max_data_per_conn=1, deadline=deadline)
 
 
     def sendSingle(self, host, key, value, clock=None):
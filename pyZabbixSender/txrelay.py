@@ -0,0 +1,181 @@
+# -*- coding: utf-8
+# License: GNU GPLv2
+
+from twisted.internet import protocol, reactor, task, defer
+from twisted.protocols.policies import TimeoutMixin
+from twisted.python import log
+
+import time
+import sys
+
+from pyZabbixSenderBase import *
+from tx import SenderProtocol, txZabbixSender
+
+class RelayProtocol(SenderProtocol, TimeoutMixin):
+    '''
+    Server side of the trapper protocol: accepts a "sender data" packet from a client,
+    stores its data in the relay, and replies immediately as the Zabbix server would.
+    Packets bigger than the *max_frame* of the factory are refused, and connections are closed after its *timeout*.
+    '''
+    def reset(self):
+        self.decoder = FrameDecoder(self.factory.max_frame)
+        self.done = False
+
+    def connectionMade(self):
+        self.setTimeout(self.factory.timeout)
+
+    def connectionLost(self,reason):
+        self.setTimeout(None)
+
+    def packet_received(self,packet):
+        started = time.time()
+        if packet.get('request') != 'sender data':
+            self.send_packet({'response': 'failed', 'info': 'Unsupported request: %s' % packet.get('request')})
+            return
+        processed, failed = self.factory.accept(packet.get('data', []), packet.get('clock'))
+        self.send_packet({
+            'response': 'success',
+            'info': 'processed: %d; failed: %d; total: %d; seconds spent: %.6f' % (processed, failed, processed + failed, time.time() - started),
+        })
+
+class RelayFactory(protocol.Factory):
+    '''
+    Relay (aggregation) daemon: accepts data from many short-lived clients, and sends it
+    upstream in big batches using the *sender* (a *txZabbixSender* object) every *flush_interval* seconds.
+
+    Every flush moves the spool to the internal data of the sender, and sends it with *flushData*: data not sent upstream
+    (for example, when the server is down) is kept by the sender to be sent by the next flush. The spool and the data kept by
+    the sender hold up to *max_spool* data points, the oldest ones of the spool are dropped when it's full.
+
+    Clients can't make the relay buffer more than *max_frame* bytes per connection, or keep a connection
+    open more than *timeout* seconds (None to disable it).
+    '''
+    def __init__(self, sender, flush_interval=1.0, max_data_per_conn=1000, max_spool=1000000, max_frame=8 << 20, timeout=30.0):
+        self.sender = sender
+        self.flush_interval = flush_interval
+        self.max_data_per_conn = max_data_per_conn
+        self.max_spool = max_spool
+        self.max_frame = max_frame
+        self.timeout = timeout
+        self.spool = []
+        self.flushing = False
+        self.stats = {
+            'received': 0,
+            'sent': 0,
+            'resent': 0,
+            'dropped': 0,
+            'flushes': 0,
+        }
+        self._loop = None
+
+    def buildProtocol(self,addr):
+        return RelayProtocol(self)
+
+    def startFactory(self):
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.start(self.flush_interval, now=False)
+
+    def stopFactory(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+    def accept(self,data,clock=None):
+        '''
+        Stores the data received from a client. Returns the numbers of processed and failed data points.
+        '''
+        if not clock:
+            clock = int(time.time())   # Keep the time the data was received, as it's sent later
+        processed = 0
+        failed = 0
+        for obj in data:
+            if not isinstance(obj,dict) or 'host' not in obj or 'key' not in obj or 'value' not in obj:
+                failed += 1
+                continue
+            self.spool.append({
+                'host': obj['host'],
+                'key': obj['key'],
+                'value': obj['value'],
+                'clock': obj.get('clock') or clock,
+            })
+            processed += 1
+        self.stats['received'] += processed
+        self._trim()
+        return processed, failed
+
+    def _trim(self):
+        excess = min(len(self.spool), len(self.spool) + self.sender._dataCount() - self.max_spool)
+        if excess > 0:
+            del self.spool[:excess]
+            self.stats['dropped'] += excess
+
+    def flush(self):
+        '''
+        Sends the spooled data upstream, with the data kept by the sender from the previous flushes. Returns a deferred fired when done.
+        '''
+        if self.flushing:
+            return defer.succeed(None)
+        sender = self.sender
+        for obj in self.spool:
+            sender.addData(obj['host'], obj['key'], obj['value'], obj['clock'])
+        self.spool = []
+        if not sender._dataCount():
+            return defer.succeed(None)
+        self.flushing = True
+        try:
+            d = sender.flushData(max_data_per_conn=self.max_data_per_conn)
+        except Exception:
+            self.flushing = False
+            raise
+        self.stats['flushes'] += 1
+        d.addCallback(self._flushed)
+        d.addErrback(log.err)
+        return d
+
+    def _flushed(self,results):
+        '''
+        Counts the data points processed upstream, and the ones kept by the sender for the next flush.
+        '''
+        self.flushing = False
+        for success, result in results:
+            if success:
+                self.stats['sent'] += result['info']['processed'] + result['info']['failed']
+        self.stats['resent'] += self.sender._dataCount()
+        self._trim()
+
+
+def startRelay(sender, port=10051, interface='', **kwargs):
+    '''
+    #####Description:
+    Starts a relay listening for Zabbix senders on the *port*, which sends the data received upstream in batches using the *sender*.
+
+    #####Parameters:
+    * **sender**: [in] [txZabbixSender] [mandatory] The sender used to send data upstream.
+    * **port**: [in] [integer] [optional] The port to listen on. *Default value: 10051*
+    * **interface**: [in] [string] [optional] The interface to listen on. *Default value: all interfaces*
+    * Other keyword parameters (*flush_interval*, *max_data_per_conn*, *max_spool*, *max_frame*, *timeout*) are passed to *RelayFactory*.
+
+    #####Return:
+    The *RelayFactory* object.
+    '''
+    factory = RelayFactory(sender, **kwargs)
+    reactor.listenTCP(port, factory, interface=interface)
+    return factory
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] upstream-server')
+    parser.add_option('-p', '--port', type='int', default=10051, help='port to listen on')
+    parser.add_option('-u', '--upstream-port', type='int', default=10051, help='port of the upstream server')
+    parser.add_option('-i', '--interval', type='float', default=1.0, help='seconds between flushes')
+    parser.add_option('-n', '--max-data-per-conn', type='int', default=1000, help='data points per upstream packet')
+    parser.add_option('-f', '--max-frame', type='int', default=8 << 20, help='maximum size of the packets received, in bytes')
+    parser.add_option('-t', '--timeout', type='float', default=30.0, help='seconds before closing the connections of the clients')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('upstream server is required')
+    log.startLogging(sys.stderr)
+    startRelay(txZabbixSender(args[0], options.upstream_port), options.port,
+        flush_interval=options.interval, max_data_per_conn=options.max_data_per_conn,
+        max_frame=options.max_frame, timeout=options.timeout)
+    reactor.run()